@@ -1,41 +1,90 @@
 import os
-from flask import Flask
+import atexit
+from Queue import Queue
+from flask import Flask, g, request
 from .errors import not_found, not_allowed
 from flask_sapb1 import SAPB1Adaptor
 from flask_jwt_extended import (
     JWTManager, create_access_token, get_jwt_identity
 )
-from werkzeug.security import safe_str_cmp
+import hashlib
+import threading
+from werkzeug.security import check_password_hash, safe_str_cmp
 import logging
 from flask_mail import Mail
+import tracing
+from profiling import Profiler
+from logpipeline import JsonFormatter, QueueHandler, QueueListener
+
+try:
+    from flask.logging import default_handler
+except ImportError:
+    default_handler = None
 
 
 class User(object):
-    def __init__(self, id, username, password):
+    def __init__(self, id, username, passwordHash):
         self.id = id
         self.username = username
-        self.password = password
+        self.passwordHash = passwordHash
 
     def __str__(self):
         return "User(id='%s')" % self.id
 
+
+# Digests of passwords that passed check_password_hash, by username, so a
+# repeated login is one SHA-256 and a constant-time comparison instead of
+# a full PBKDF2 run. A changed password simply misses and is checked again.
+_verified = {}
+_verifiedLock = threading.Lock()
+
+
+def _digest(user, password):
+    return hashlib.sha256(user.passwordHash.encode('utf-8') + b':' +
+                          password.encode('utf-8')).hexdigest()
+
+
 def authenticate(username, password):
     user = username_table.get(username, None)
-    if user and safe_str_cmp(user.password.encode('utf-8'), password.encode('utf-8')):
+    if user is None or not password or not isinstance(password, basestring):
+        return None
+    digest = _digest(user, password)
+    with _verifiedLock:
+        known = _verified.get(username)
+    if known is not None and safe_str_cmp(known, digest):
+        return user
+    if check_password_hash(user.passwordHash, password):
+        with _verifiedLock:
+            _verified[username] = digest
         return user
+    return None
 
 def identity(payload):
     user_id = payload['identity']
     return userid_table.get(user_id, None)
 
+# Password hashes as made by werkzeug.security.generate_password_hash;
+# the USERS setting replaces these.
 users = [
-    User(1, 'user1', 'abcxyz'),
-    User(2, 'user2', 'abcxyz'),
+    User(1, 'user1', 'pbkdf2:sha256:150000$MUQFnMLy$af2088086de5a78aebcb2c0fc2eddd6c4dc4683054c87da77ea87fd65261b533'),
+    User(2, 'user2', 'pbkdf2:sha256:150000$JRUgQk83$c985eb727308e591d1e9bc28067dc24ffec59fd22ffacf41ee380cc5de571e25'),
 ]
 
 username_table = {u.username: u for u in users}
 userid_table = {u.id: u for u in users}
 
+
+def load_users(entries):
+    """Replace the users by (id, username, password hash) entries.
+    """
+    loaded = [User(*entry) for entry in entries]
+    username_table.clear()
+    username_table.update((u.username, u) for u in loaded)
+    userid_table.clear()
+    userid_table.update((u.id, u) for u in loaded)
+    with _verifiedLock:
+        _verified.clear()
+
 jwt = JWTManager(authentication_handler=authenticate, identity_handler=identity)
 
 sapb1Adaptor = SAPB1Adaptor()
@@ -61,21 +110,93 @@ def create_app(config_module=None):
     #wt.init_app(app)
     jwt = JWTManager(app)
 
+    if app.config.get('USERS'):
+        load_users(app.config['USERS'])
+
     # connect to sapb1
     sapb1Adaptor.init_app(app)
 
     from api.v1 import api_v1_bp
     app.register_blueprint(api_v1_bp, url_prefix='/v1')
 
+    from api.ratelimit import init_rate_limiter
+    init_rate_limiter(app)
+    from api.auth import init_token_cache
+    init_token_cache(app)
+    from changefeed import init_changefeed
+    init_changefeed(app, sapb1Adaptor)
+
+    if app.config.get('METRICS', True):
+        from api.metrics import metrics_bp
+        app.register_blueprint(metrics_bp)
+
     # Configure logging
     handler = logging.FileHandler(app.config['LOGGING_LOCATION'])
     handler.setLevel(app.config['LOGGING_LEVEL'])
-    formatter = logging.Formatter(app.config['LOGGING_FORMAT'])
+    if app.config.get('LOGGING_JSON', True):
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(app.config['LOGGING_FORMAT'])
     handler.setFormatter(formatter)
+    if app.config.get('LOGGING_QUEUE', True):
+        # Request threads only enqueue; the file is written by a
+        # background thread.
+        listener = QueueListener(Queue(app.config.get('LOGGING_QUEUE_SIZE', 10000)), handler)
+        listener.start()
+        atexit.register(listener.stop)
+        app.extensions['log_listener'] = listener
+        handler = QueueHandler(listener.queue)
+        handler.setLevel(app.config['LOGGING_LEVEL'])
+        if default_handler is not None:
+            app.logger.removeHandler(default_handler)
+    handler.addFilter(tracing.TraceIdFilter())
     app.debug = True
     app.logger.addHandler(handler)
     app.logger.setLevel(app.config['LOGGING_LEVEL'])
 
+    if app.config.get('TRACING', True):
+        tracing.configure(app.config.get('TRACE_FILE', 'traces.jsonl'),
+                          app.config.get('TRACE_MIN_DURATION', 0.0),
+                          maxBytes=app.config.get('TRACE_MAX_BYTES', 50 * 1024 * 1024),
+                          backupCount=app.config.get('TRACE_BACKUP_COUNT', 5),
+                          queueSize=app.config.get('TRACE_QUEUE_SIZE', 10000))
+
+    profiler = None
+    if app.config.get('PROFILE', False):
+        profiler = Profiler(app.config.get('PROFILE_DIR', 'profiles'),
+                            sampleRate=app.config.get('PROFILE_SAMPLE_RATE', 0.0),
+                            slowSeconds=app.config.get('PROFILE_SLOW_SECONDS', 10.0),
+                            interval=app.config.get('PROFILE_INTERVAL', 0.01))
+
+    @app.before_request
+    def start_trace():
+        tracing.start_trace('{0} {1}'.format(request.method, request.url_rule or request.path),
+                            request.headers.get('traceparent'),
+                            {'http.method': request.method, 'http.target': request.full_path})
+        # Operations of a /v1/batch are sampled within the batch's profile.
+        if profiler is not None and not request.environ.get('sapb1.batch'):
+            g._profile = profiler.start()
+
+    @app.after_request
+    def add_trace_id(response):
+        trace = tracing.current_trace()
+        if trace is not None:
+            trace.root.attributes['http.status_code'] = response.status_code
+            response.headers['X-Trace-Id'] = trace.traceId
+        return response
+
+    @app.teardown_request
+    def end_trace(exception):
+        if profiler is not None and not request.environ.get('sapb1.batch'):
+            view = app.view_functions.get(request.endpoint)
+            resource = getattr(view, 'view_class', None)
+            resource = resource.__name__ if resource else (request.endpoint or 'unknown')
+            path = profiler.stop(g.pop('_profile', None), request.method, resource,
+                                 tracing.current_trace_id())
+            if path:
+                app.logger.info("Saved request profile %s", path)
+        tracing.end_trace(error=exception)
+
     @app.errorhandler(404)
     def not_found_error(e):
         return not_found('item not found')
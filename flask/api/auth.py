@@ -0,0 +1,115 @@
+"""Cached JWT verification for the v1 resources.
+
+Decoding and checking the signature of the same bearer token on every
+request is wasted work for clients that poll. Verified tokens are kept
+in an LRU keyed by the SHA-256 of the token, each until its expiry, so a
+repeat request only costs a hash and a dictionary lookup.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+from time import time
+from flask import current_app, request
+from flask_jwt_extended import get_raw_jwt, verify_jwt_in_request
+from flask_jwt_extended.config import config
+from .app import jwt
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+class TokenCache(object):
+    """Decoded claims of verified tokens by token hash, at most maxEntries.
+    """
+
+    def __init__(self, maxEntries=10000):
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or (entry[2] is not None and entry[2] <= now):
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, key, claims, header):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (claims, header, claims.get('exp'))
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def _header_token():
+    """The raw token of the Authorization header, or None.
+    """
+    header = request.headers.get(config.header_name, None)
+    if not header:
+        return None
+    parts = header.split()
+    if config.header_type:
+        if len(parts) != 2 or parts[0] != config.header_type:
+            return None
+        return parts[1]
+    return parts[0] if len(parts) == 1 else None
+
+
+def _cacheable():
+    return (config.jwt_in_headers and not config.blacklist_enabled and
+            getattr(jwt, '_user_loader_callback', None) is None)
+
+
+def verify_cached():
+    """verify_jwt_in_request, answered from the token cache when the same
+    token was verified before and has not expired.
+    """
+    cache = current_app.extensions.get('token_cache')
+    if cache is None or request.method in config.exempt_methods or not _cacheable():
+        return verify_jwt_in_request()
+    token = _header_token()
+    if token is None:
+        return verify_jwt_in_request()
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    entry = cache.get(key)
+    if entry is not None:
+        ctx = stack.top
+        ctx.jwt, ctx.jwt_header = entry[0], entry[1]
+        return None
+    verify_jwt_in_request()
+    cache.put(key, get_raw_jwt(), getattr(stack.top, 'jwt_header', None))
+    return None
+
+
+def jwt_required(fn):
+    """flask_jwt_extended.jwt_required with the token cache in front.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        verify_cached()
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def init_token_cache(app):
+    """Create the cache unless JWT_CACHE is off.
+    """
+    if not app.config.get('JWT_CACHE', True):
+        return None
+    cache = TokenCache(app.config.get('JWT_CACHE_SIZE', 10000))
+    app.extensions['token_cache'] = cache
+    return cache
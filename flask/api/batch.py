@@ -0,0 +1,137 @@
+"""Run a list of v1 sub-requests inside one HTTP request.
+
+Sub-requests go through the full Flask request pipeline (rate limits,
+metrics, tracing) without the HTTP round trip. Writes run in order in the
+batch's own app context, so they share its SQL connection and DI session.
+Each run of consecutive reads runs concurrently on worker threads, each in
+its own app context, as many as the SQL pool has free connections for.
+"""
+import json
+import threading
+from flask import _app_ctx_stack, current_app
+import tracing
+from .app import sapb1Adaptor
+from .readonly import ReadOnlyFilter
+
+# Reads that need neither the DI session nor a login; they may run on
+# worker threads.
+_reads = ReadOnlyFilter(None, routes=[
+    (('GET', 'HEAD'), r'^/v1/(code|items|prices|stock)(/.*)?$'),
+    (('PUT',), r'^/v1/(orders|shipments)/fetch$'),
+    (('POST',), r'^/v1/(items|prices)/batch$'),
+])
+
+METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+EXCLUDED = ('/v1/batch', '/v1/login')
+
+
+def parse(operations, maxOperations):
+    """Validate the operations; returns them normalised or raises
+    ValueError.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("operations must be a non-empty list")
+    if len(operations) > maxOperations:
+        raise ValueError("too many operations (at most {0})".format(maxOperations))
+    parsed = []
+    for i, op in enumerate(operations):
+        if not isinstance(op, dict):
+            raise ValueError("operation {0} is not an object".format(i))
+        method = str(op.get('method', 'GET')).upper()
+        path = op.get('path') or ''
+        if method not in METHODS:
+            raise ValueError("operation {0}: unsupported method {1}".format(i, method))
+        if not path.startswith('/v1/') or path.split('?')[0].rstrip('/') in EXCLUDED:
+            raise ValueError("operation {0}: path must be a /v1/ resource".format(i))
+        parsed.append({'id': op.get('id', i), 'method': method, 'path': path,
+                       'body': op.get('body', None)})
+    return parsed
+
+
+def dispatch(app, op, headers):
+    """Run one operation in a request context of its own; returns its
+    result entry.
+
+    In the batch's thread the operation shares the batch's app context,
+    so the g values and trace of the batch request are put back after it.
+    """
+    data = None if op['body'] is None else json.dumps(op['body'])
+    outer = _app_ctx_stack.top
+    saved = dict(vars(outer.g)) if outer is not None and outer.app is app else None
+    trace = tracing.current_trace()
+    try:
+        with app.test_request_context(op['path'], method=op['method'], data=data,
+                                      headers=headers, content_type='application/json',
+                                      environ_base={'sapb1.batch': True}):
+            try:
+                response = app.full_dispatch_request()
+                body = response.get_data()
+            except Exception as e:
+                app.logger.exception(e)
+                return {'id': op['id'], 'status': getattr(e, 'code', 500) or 500,
+                        'body': {'error': str(e)}}
+    finally:
+        if saved is not None:
+            vars(outer.g).clear()
+            vars(outer.g).update(saved)
+        tracing.resume_trace(trace)
+    if response.mimetype == 'application/json':
+        try:
+            body = json.loads(body)
+        except ValueError:
+            pass
+    return {'id': op['id'], 'status': response.status_code, 'body': body}
+
+
+def run(operations, headers, maxThreads=4):
+    """Run the operations; results come back in the order given.
+    """
+    app = current_app._get_current_object()
+    trace = tracing.current_trace()
+    if trace is not None:
+        # Trace the operations as children of the batch, on any thread.
+        headers = dict(headers, traceparent=tracing.traceparent(trace))
+    results = [None] * len(operations)
+    i = 0
+    while i < len(operations):
+        op = operations[i]
+        if not _reads.allowed(op['method'], op['path'].split('?')[0]):
+            results[i] = dispatch(app, op, headers)
+            i += 1
+            continue
+        group = []
+        while i < len(operations) and \
+                _reads.allowed(operations[i]['method'], operations[i]['path'].split('?')[0]):
+            group.append(i)
+            i += 1
+        _runConcurrently(app, operations, group, headers, results, maxThreads)
+    return results
+
+
+def _runConcurrently(app, operations, group, headers, results, maxThreads):
+    pool = sapb1Adaptor.sqlPool
+    if pool is not None:
+        # Each worker takes a pooled connection of its own; do not wait on
+        # connections held by this or other requests.
+        maxThreads = min(maxThreads, pool.size - pool.inUse)
+    if len(group) == 1 or maxThreads <= 1:
+        for n in group:
+            results[n] = dispatch(app, operations[n], headers)
+        return
+    pending = list(group)
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                n = pending.pop(0)
+            results[n] = dispatch(app, operations[n], headers)
+
+    threads = [threading.Thread(target=work, name='batch')
+               for _ in range(min(maxThreads, len(group)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
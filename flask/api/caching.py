@@ -0,0 +1,73 @@
+"""HTTP validators and Cache-Control for the read endpoints.
+
+Responses carry a strong ETag derived from the version of the data behind
+them (see SapB1Adaptor.getDataVersion), so a client or a reverse proxy
+revalidating with If-None-Match gets a 304 without the rows being read.
+
+The responses are marked public so that shared caches may store them
+although the requests carry an Authorization header; Vary: Authorization
+keeps one token's copy from being served to another.
+"""
+import hashlib
+from flask import current_app, request
+from werkzeug.http import http_date
+from .errors import not_modified
+from .representations import negotiate_encoding
+
+DEFAULT_CACHE_CONTROL = {
+    'InfoAPI': 'public, max-age=300',
+    'CodeAPI': 'public, max-age=300',
+    'ItemsAPI': 'public, max-age=60',
+    'PricesAPI': 'public, max-age=60',
+}
+
+
+def etag_for(resource, version):
+    """Strong ETag of a resource representation: the data version, the
+    query string and the content coding all change the entity.
+    """
+    args = sorted(request.args.items(multi=True))
+    key = repr((resource, version, args, negotiate_encoding()))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cache_headers(resource, etag=None, modified=None):
+    control = current_app.config.get('CACHE_CONTROL', {})
+    headers = {
+        'Cache-Control': control.get(resource, DEFAULT_CACHE_CONTROL.get(resource, 'no-cache')),
+        'Vary': 'Authorization',
+    }
+    if etag is not None:
+        headers['ETag'] = '"{0}"'.format(etag)
+    if modified is not None:
+        headers['Last-Modified'] = http_date(modified)
+    return headers
+
+
+def conditional(resource, versionOf, cacheable=True):
+    """Evaluate If-None-Match/If-Modified-Since for the current request.
+
+    versionOf returns the (version, modified) of the data; it is only
+    called when HTTP_CACHING is on and the request is cacheable, i.e. the
+    version covers everything it reads. Returns (response, headers):
+    response is a 304 when the client's copy is current, else None;
+    headers are to be sent with the full response.
+    """
+    if not current_app.config.get('HTTP_CACHING', True):
+        return None, {}
+    if not cacheable:
+        return None, {'Cache-Control': 'no-cache'}
+    version, modified = versionOf()
+    etag = etag_for(resource, version)
+    headers = cache_headers(resource, etag, modified)
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    elif modified is not None and request.if_modified_since is not None:
+        fresh = modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    else:
+        fresh = False
+    if not fresh:
+        return None, headers
+    response = not_modified()
+    response.headers.extend(headers)
+    return response, headers
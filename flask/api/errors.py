@@ -51,3 +51,10 @@ def too_many_requests(message='You have exceeded your request rate'):
                         'message': message})
     response.status_code = 429
     return response
+
+
+def service_unavailable(message='The service is overloaded, please retry later'):
+    response = jsonify({'status': 503, 'error': 'service unavailable',
+                        'message': message})
+    response.status_code = 503
+    return response
@@ -0,0 +1,132 @@
+import csv
+import datetime
+import itertools
+import pymssql
+from flask import Response, stream_with_context
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+FORMATS = {
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+# End-of-stream marker of the Arrow IPC streaming format.
+ARROW_EOS = b'\xff\xff\xff\xff\x00\x00\x00\x00'
+
+
+class _Buffer(object):
+    """Write target for csv.writer that hands back what was written.
+    """
+    def __init__(self):
+        self.parts = []
+
+    def write(self, value):
+        self.parts.append(value)
+
+    def drain(self):
+        value = ''.join(self.parts)
+        self.parts = []
+        if isinstance(value, bytes):
+            return value
+        return value.encode('utf-8')
+
+
+def _csvValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        return value.encode('ascii', 'ignore').decode('utf-8')
+    except AttributeError:
+        return value
+
+
+def iter_csv(description, batches):
+    """Encode the row batches of MsSqlAdaptor.fetch_batches as CSV.
+    """
+    buf = _Buffer()
+    writer = csv.writer(buf)
+    writer.writerow([name for name, typeCode in description])
+    yield buf.drain()
+    for rows in batches:
+        writer.writerows([_csvValue(v) for v in row] for row in rows)
+        yield buf.drain()
+
+
+def _arrowType(typeCode, values):
+    """Arrow type of a column from its DB-API type code.
+
+    The values of the first batch are only looked at where the code leaves
+    the type open: NUMBER covers bit, int and float columns, DECIMAL comes
+    without a scale (widened to the 6 of the B1 numeric columns) and
+    unknown codes are inferred, falling back to strings when all null.
+    """
+    present = [v for v in values if v is not None]
+    if typeCode == pymssql.STRING:
+        return pyarrow.string()
+    if typeCode == pymssql.BINARY:
+        return pyarrow.binary()
+    if typeCode == pymssql.DATETIME:
+        return pyarrow.timestamp('us')
+    if typeCode == pymssql.DECIMAL:
+        scale = max([-v.as_tuple().exponent for v in present] + [6])
+        return pyarrow.decimal128(38, scale)
+    if typeCode == pymssql.NUMBER:
+        return pyarrow.array(present).type if present else pyarrow.float64()
+    inferred = pyarrow.array(present).type if present else pyarrow.null()
+    return pyarrow.string() if inferred == pyarrow.null() else inferred
+
+
+def iter_arrow(description, batches):
+    """Encode the row batches of MsSqlAdaptor.fetch_batches as an Arrow IPC
+    stream.
+
+    The schema is fixed before the first batch is sent, from the column
+    type codes and that batch; later batches are converted to it.
+    """
+    names = [name for name, typeCode in description]
+    schema = None
+    for rows in batches:
+        values = list(zip(*rows))
+        if schema is None:
+            schema = pyarrow.schema([
+                (name, _arrowType(typeCode, column))
+                for (name, typeCode), column in zip(description, values)])
+            yield schema.serialize().to_pybytes()
+        arrays = [pyarrow.array(list(column), type=field.type)
+                  for column, field in zip(values, schema)]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, names)
+        yield batch.serialize().to_pybytes()
+    if schema is None:
+        schema = pyarrow.schema([(name, _arrowType(typeCode, []))
+                                 for name, typeCode in description])
+        yield schema.serialize().to_pybytes()
+    yield ARROW_EOS
+
+
+def export_response(fmt, batches, name):
+    """Stream column names and row batches in the requested format.
+
+    The query is run and its first batch read before the response is
+    built, so database errors reach the caller instead of cutting the
+    stream short.
+    """
+    description = next(batches)
+    first = next(batches, None)
+    if first is not None:
+        batches = itertools.chain([first], batches)
+    if fmt == 'csv':
+        body = iter_csv(description, batches)
+    else:
+        body = iter_arrow(description, batches)
+    resp = Response(stream_with_context(body), status=200,
+                    mimetype=FORMATS[fmt])
+    resp.headers['Content-Disposition'] = \
+        'attachment; filename={0}.{1}'.format(name, fmt)
+    return resp
@@ -0,0 +1,74 @@
+"""Streaming NDJSON ingestion for the order and shipment uploads.
+
+With Content-Type application/x-ndjson the body is read one line (one
+document) at a time, each document is processed as soon as it is parsed,
+and its result is written back as one NDJSON line when it finishes.
+Memory stays flat and the client sees progress on large backfills.
+"""
+import json
+from flask import Response, current_app, request, stream_with_context
+from .representations import dumps
+
+MIMETYPES = ('application/x-ndjson', 'application/jsonl', 'application/json-lines')
+
+# Keys of a processed document echoed in its result line.
+RESULT_KEYS = ('U_WebOrderId', 'order_id', 'tx_status', 'tx_note')
+
+
+def is_ndjson():
+    return request.mimetype in MIMETYPES
+
+
+def iter_documents(stream, maxLine):
+    """Yield (line number, document or None, error or None) per line.
+    """
+    number = 0
+    while True:
+        line = stream.readline(maxLine + 1)
+        if not line:
+            return
+        number += 1
+        if len(line) > maxLine and not line.endswith(b'\n'):
+            # Skip the rest of the oversized line.
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(maxLine + 1)
+            yield number, None, 'line longer than {0} bytes'.format(maxLine)
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            document = json.loads(line)
+        except ValueError as e:
+            yield number, None, 'invalid JSON: {0}'.format(e)
+            continue
+        if not isinstance(document, dict):
+            yield number, None, 'expected a JSON object'
+            continue
+        yield number, document, None
+
+
+def result_line(number, document):
+    result = {'line': number}
+    for key in RESULT_KEYS:
+        if key in document:
+            result[key] = document[key]
+    return dumps(result) + '\n'
+
+
+def stream_response(process):
+    """Answer the request by running process(document) on each NDJSON
+    line of the body; process records its outcome on the document.
+    """
+    maxLine = current_app.config.get('NDJSON_MAX_LINE', 1024 * 1024)
+
+    def generate():
+        for number, document, error in iter_documents(request.stream, maxLine):
+            if error is not None:
+                current_app.logger.warning("NDJSON line %s: %s", number, error)
+                yield result_line(number, {'tx_status': 'F', 'tx_note': error})
+                continue
+            yield result_line(number, process(document))
+
+    return Response(stream_with_context(generate()), status=200,
+                    mimetype='application/x-ndjson')
@@ -0,0 +1,307 @@
+"""Prometheus text exposition of the service metrics at /metrics.
+"""
+import threading
+from time import time
+from flask import Blueprint, Response, current_app, g, request
+from instrumentation import Histogram, registry
+from logpipeline import QueueHandler
+import tracing
+from .app import sapb1Adaptor
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+metrics_bp = Blueprint('metrics', __name__)
+
+
+class RequestMetrics(object):
+    """Request counts by (resource, method, status) and latency histograms
+    by (resource, method), plus the number of requests in flight.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.histograms = {}
+        self.inFlight = 0
+
+    def started(self):
+        with self.lock:
+            self.inFlight += 1
+
+    def finished(self):
+        with self.lock:
+            self.inFlight -= 1
+
+    def observe(self, resource, method, status, seconds):
+        with self.lock:
+            key = (resource, method, status)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            histogram = self.histograms.get((resource, method))
+            if histogram is None:
+                histogram = self.histograms[(resource, method)] = Histogram()
+            histogram.observe(seconds)
+
+
+httpRequests = RequestMetrics()
+
+# Extra metrics: (name, type, help, function returning [(labels, value)]).
+COLLECTORS = []
+
+
+def collector(name, kind, help):
+    """Register a function as the sample source of a gauge or counter.
+    """
+    def register(func):
+        COLLECTORS.append((name, kind, help, func))
+        return func
+    return register
+
+
+def resource_name():
+    """The Resource class serving the request (OrdersAPI...), else the
+    endpoint.
+    """
+    view = current_app.view_functions.get(request.endpoint)
+    view_class = getattr(view, 'view_class', None)
+    if view_class is not None:
+        return view_class.__name__
+    return request.endpoint or 'unknown'
+
+
+@metrics_bp.before_app_request
+def start_timer():
+    g._metricsStart = time()
+    httpRequests.started()
+
+
+@metrics_bp.after_app_request
+def record_request(response):
+    start = g.pop('_metricsStart', None)
+    if start is not None and request.endpoint != 'metrics.metrics':
+        httpRequests.observe(resource_name(), request.method,
+                             response.status_code, time() - start)
+    return response
+
+
+@metrics_bp.teardown_app_request
+def end_request(exception):
+    httpRequests.finished()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    items = []
+    for k, v in sorted(labels.items()):
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        items.append('{0}="{1}"'.format(k, v))
+    return '{' + ','.join(items) + '}'
+
+
+def _value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _histogram(lines, name, labels, histogram):
+    for bound, count in histogram['buckets']:
+        le = '+Inf' if bound == '+Inf' else _value(bound)
+        lines.append('{0}_bucket{1} {2}'.format(
+            name, _labels(dict(labels, le=le)), count))
+    lines.append('{0}_sum{1} {2}'.format(name, _labels(labels), _value(histogram['sum'])))
+    lines.append('{0}_count{1} {2}'.format(name, _labels(labels), histogram['count']))
+
+
+def _header(lines, name, kind, help):
+    lines.append('# HELP {0} {1}'.format(name, help))
+    lines.append('# TYPE {0} {1}'.format(name, kind))
+
+
+def render():
+    """All metrics in the Prometheus text format.
+    """
+    lines = []
+    with httpRequests.lock:
+        counts = dict(httpRequests.counts)
+        histograms = dict((k, h.to_dict()) for k, h in httpRequests.histograms.items())
+        inFlight = httpRequests.inFlight
+
+    name = 'sapb1_http_requests_total'
+    _header(lines, name, 'counter', 'HTTP requests by resource, method and status.')
+    for (resource, method, status), count in sorted(counts.items()):
+        lines.append('{0}{1} {2}'.format(name, _labels(
+            {'resource': resource, 'method': method, 'status': status}), count))
+
+    name = 'sapb1_http_request_duration_seconds'
+    _header(lines, name, 'histogram', 'HTTP request latency by resource and method.')
+    for (resource, method), histogram in sorted(histograms.items()):
+        _histogram(lines, name, {'resource': resource, 'method': method}, histogram)
+
+    name = 'sapb1_http_requests_in_flight'
+    _header(lines, name, 'gauge', 'HTTP requests being served.')
+    lines.append('{0} {1}'.format(name, inFlight))
+
+    backend = registry.snapshot()
+    name = 'sapb1_backend_call_duration_seconds'
+    _header(lines, name, 'histogram', 'DI API and SQL call latency by adaptor method and operation.')
+    for (method, op), histogram in sorted(backend['histograms'].items()):
+        _histogram(lines, name, {'method': method, 'op': op}, histogram)
+
+    name = 'sapb1_backend_errors_total'
+    _header(lines, name, 'counter', 'Failed DI API and SQL calls by adaptor method, operation and GetLastError code.')
+    for (method, op, code), count in sorted(backend['errors'].items()):
+        lines.append('{0}{1} {2}'.format(name, _labels(
+            {'method': method, 'op': op, 'code': code}), count))
+
+    for name, kind, help, func in COLLECTORS:
+        _header(lines, name, kind, help)
+        for labels, value in func():
+            lines.append('{0}{1} {2}'.format(name, _labels(labels), _value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+@metrics_bp.route('/metrics')
+def metrics():
+    return Response(render(), mimetype=None, content_type=CONTENT_TYPE)
+
+
+@collector('sapb1_cache_hits_total', 'counter', 'Cache hits since start by cache.')
+def cache_hits():
+    return [({'cache': 'contacts'}, getattr(sapb1Adaptor.contactIndex, 'hits', 0)),
+            ({'cache': 'business_partners'}, getattr(sapb1Adaptor.businessPartners, 'hits', 0)),
+            ({'cache': 'jwt'}, getattr(current_app.extensions.get('token_cache'), 'hits', 0))]
+
+
+@collector('sapb1_cache_misses_total', 'counter', 'Cache misses since start by cache.')
+def cache_misses():
+    return [({'cache': 'contacts'}, getattr(sapb1Adaptor.contactIndex, 'misses', 0)),
+            ({'cache': 'business_partners'}, getattr(sapb1Adaptor.businessPartners, 'misses', 0)),
+            ({'cache': 'jwt'}, getattr(current_app.extensions.get('token_cache'), 'misses', 0))]
+
+
+@collector('sapb1_cache_entries', 'gauge', 'Entries held by cache.')
+def cache_entries():
+    samples = []
+    if sapb1Adaptor.contactIndex is not None:
+        samples.append(({'cache': 'contacts'}, len(sapb1Adaptor.contactIndex.cards)))
+    if sapb1Adaptor.businessPartners is not None:
+        samples.append(({'cache': 'business_partners'}, len(sapb1Adaptor.businessPartners.entries)))
+    if sapb1Adaptor.stockSnapshot is not None:
+        samples.append(({'cache': 'stock'}, len(sapb1Adaptor.stockSnapshot)))
+    return samples
+
+
+@collector('sapb1_stock_snapshot_age_seconds', 'gauge', 'Seconds since the stock snapshot was refreshed.')
+def stock_snapshot_age():
+    snapshot = sapb1Adaptor.stockSnapshot
+    if snapshot is None or not snapshot.refreshedAt:
+        return []
+    return [({}, time() - snapshot.refreshedAt)]
+
+
+@collector('sapb1_open_sessions', 'gauge', 'Open DI API and SQL sessions.')
+def open_sessions():
+    return [({'kind': kind}, count)
+            for kind, count in sorted(sapb1Adaptor.sessions.items())]
+
+
+@collector('sapb1_log_records_dropped_total', 'counter', 'Log records dropped because the log queue was full.')
+def log_records_dropped():
+    return [({}, sum(h.dropped for h in current_app.logger.handlers
+                     if isinstance(h, QueueHandler)))]
+
+
+@collector('sapb1_log_queue_depth', 'gauge', 'Log records waiting to be written.')
+def log_queue_depth():
+    listener = current_app.extensions.get('log_listener')
+    if listener is None:
+        return []
+    return [({}, listener.queue.qsize())]
+
+
+@collector('sapb1_traces_dropped_total', 'counter', 'Traces dropped because the trace queue was full.')
+def traces_dropped():
+    exporter = tracing.exporter
+    return [({}, exporter.dropped)] if exporter is not None else []
+
+
+@collector('sapb1_com_sessions_in_use', 'gauge', 'DI sessions held by requests.')
+def com_sessions_in_use():
+    gate = sapb1Adaptor.comGate
+    return [({}, gate.inUse)] if gate is not None else []
+
+
+@collector('sapb1_com_queue_waiting', 'gauge', 'Requests waiting for a DI session.')
+def com_queue_waiting():
+    gate = sapb1Adaptor.comGate
+    return [({}, gate.waiting)] if gate is not None else []
+
+
+@collector('sapb1_com_queue_wait_seconds', 'gauge', 'Moving average of the wait for a DI session.')
+def com_queue_wait():
+    gate = sapb1Adaptor.comGate
+    return [({}, gate.avgWait)] if gate is not None else []
+
+
+@collector('sapb1_sql_pool_connections', 'gauge', 'Pooled SQL connections by state.')
+def sql_pool_connections():
+    pool = sapb1Adaptor.sqlPool
+    if pool is None:
+        return []
+    return [({'state': 'in_use'}, pool.inUse),
+            ({'state': 'idle'}, pool.open - pool.inUse)]
+
+
+@collector('sapb1_sql_pool_waits_total', 'counter', 'Requests that waited for a pooled SQL connection.')
+def sql_pool_waits():
+    pool = sapb1Adaptor.sqlPool
+    return [({}, pool.waits)] if pool is not None else []
+
+
+@collector('sapb1_read_queries_total', 'counter', 'Shareable reads by outcome: executed, joined an identical query in flight, or served from the read cache.')
+def read_queries():
+    flight = sapb1Adaptor.readFlight
+    if flight is None:
+        return []
+    return [({'outcome': 'executed'}, flight.executed),
+            ({'outcome': 'shared'}, flight.shared),
+            ({'outcome': 'cached'}, flight.hits)]
+
+
+@collector('sapb1_requests_rejected_total', 'counter', 'Requests answered 503 (DI or SQL overload) or 429 (rate limit).')
+def requests_rejected():
+    samples = []
+    if sapb1Adaptor.comGate is not None:
+        samples.append(({'reason': 'com_overload'}, sapb1Adaptor.comGate.rejected))
+    if sapb1Adaptor.sqlPool is not None:
+        samples.append(({'reason': 'sql_pool'}, sapb1Adaptor.sqlPool.timeouts))
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is not None:
+        samples.append(({'reason': 'rate_limit'}, limiter.limited))
+    return samples
+
+
+@collector('sapb1_changefeed_events_total', 'counter', 'Document change events queued since start by resource and type.')
+def changefeed_events():
+    feed = current_app.extensions.get('changefeed')
+    if feed is None:
+        return []
+    return [({'resource': resource, 'type': kind}, count)
+            for (resource, kind), count in sorted(feed.events.items())]
+
+
+@collector('sapb1_webhook_outbox_events', 'gauge', 'Undelivered webhook events by state.')
+def webhook_outbox():
+    feed = current_app.extensions.get('changefeed')
+    if feed is None:
+        return []
+    return [({'state': state}, count) for state, count in sorted(feed.outbox.counts().items())]
+
+
+@collector('sapb1_webhook_deliveries_total', 'counter', 'Webhook events delivered, failed and dead-lettered since start.')
+def webhook_deliveries():
+    feed = current_app.extensions.get('changefeed')
+    if feed is None:
+        return []
+    return [({'result': result}, count) for result, count in sorted(feed.deliveries.items())]
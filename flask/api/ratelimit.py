@@ -0,0 +1,157 @@
+"""Per-client rate limiting and DI admission control for the v1 API.
+"""
+import threading
+from collections import OrderedDict
+from functools import wraps
+from time import time
+from flask import current_app, request
+from flask_jwt_extended import get_jwt_identity
+from flask_sapb1 import ComBusy, SqlBusy
+from .app import sapb1Adaptor
+from .auth import verify_cached
+from .errors import service_unavailable, too_many_requests
+
+
+class TokenBucket(object):
+    """rate tokens per second, holding at most burst.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time()
+
+    def take(self):
+        """Take a token; returns 0 if one was available, else the seconds
+        until the next one.
+        """
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    """Token buckets by (client, route), at most maxBuckets kept.
+    """
+
+    def __init__(self, default, limits=None, maxBuckets=10000):
+        self.default = default
+        self.limits = limits or {}
+        self.maxBuckets = maxBuckets
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.limited = 0
+
+    def check(self, client, route):
+        """Return 0 if the request may go ahead, else the seconds to wait.
+        """
+        limit = self.limits.get(route, self.default)
+        if limit is None:
+            return 0
+        key = (client, route)
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(*limit)
+            self.buckets[key] = bucket
+            while len(self.buckets) > self.maxBuckets:
+                self.buckets.popitem(last=False)
+            wait = bucket.take()
+            if wait:
+                self.limited += 1
+            return wait
+
+
+def _retry_after(response, seconds):
+    response.headers['Retry-After'] = str(max(1, int(seconds + 0.999)))
+    return response
+
+
+def client_identity():
+    """The JWT identity of the request, else the remote address.
+    """
+    try:
+        verify_cached()
+        identity = get_jwt_identity()
+        if identity is not None:
+            return 'user:{0}'.format(identity)
+    except Exception:
+        # Missing or invalid tokens are rejected by jwt_required on the
+        # resource.
+        pass
+    return 'addr:{0}'.format(request.remote_addr)
+
+
+def route_name():
+    """Resource class and method of the request, like OrdersAPI.post.
+    """
+    view = current_app.view_functions.get(request.endpoint)
+    view_class = getattr(view, 'view_class', None)
+    name = view_class.__name__ if view_class is not None else request.endpoint
+    return '{0}.{1}'.format(name, request.method.lower())
+
+
+def limit_request():
+    """before_request hook: answer 429 when the client's bucket is empty.
+    """
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is None or request.endpoint is None:
+        return None
+    wait = limiter.check(client_identity(), route_name())
+    if wait:
+        return _retry_after(too_many_requests(), wait)
+    return None
+
+
+def init_rate_limiter(app):
+    """Create the limiter from RATE_LIMIT and RATE_LIMITS; None disables it.
+    """
+    default = app.config.get('RATE_LIMIT', None)
+    limits = app.config.get('RATE_LIMITS', {})
+    if default is None and not limits:
+        return None
+    limiter = RateLimiter(default, limits, app.config.get('RATE_LIMIT_CLIENTS', 10000))
+    app.extensions['rate_limiter'] = limiter
+    return limiter
+
+
+def overloaded(e):
+    """503 answer for a ComBusy raised while waiting for a DI session.
+    """
+    current_app.logger.warning(str(e))
+    return _retry_after(service_unavailable(str(e)), e.retryAfter)
+
+
+def uses_com(func):
+    """Take a DI session slot before the resource method runs and answer
+    503 when the DI API is overloaded.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            sapb1Adaptor.acquireCom()
+        except ComBusy as e:
+            return overloaded(e)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def uses_sql(func):
+    """Take a pooled SQL connection before the resource method runs and
+    answer 503 when none frees up in time. Without SQL_POOL_SIZE the
+    connection is opened on first use as before.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if sapb1Adaptor.sqlPool is not None:
+            try:
+                sapb1Adaptor.sql_adaptor
+            except SqlBusy as e:
+                return overloaded(e)
+        return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,45 @@
+"""WSGI filter for the read-only server.
+
+The read server answers storefront reads on its own, larger thread pool;
+every other request is refused there, so writes only reach the main
+server and its DI session.
+"""
+import json
+import re
+
+# (methods, path pattern) of the requests the read server answers.
+READ_ROUTES = [
+    (('GET', 'HEAD'), r'^/v1/(info|code|items|prices|stock)(/.*)?$'),
+    (('PUT',), r'^/v1/(orders|shipments)/fetch$'),
+    (('POST',), r'^/v1/(items|prices|stock)/batch$'),
+    (('POST',), r'^/v1/login$'),
+    (('GET',), r'^/metrics$'),
+]
+
+
+class ReadOnlyFilter(object):
+    """Pass the read routes through; refuse the rest with 405. With a
+    port, only requests to that port are filtered.
+    """
+
+    def __init__(self, app, routes=None, port=None):
+        self.app = app
+        self.port = None if port is None else str(port)
+        self.routes = [(methods, re.compile(pattern))
+                       for methods, pattern in (routes or READ_ROUTES)]
+
+    def allowed(self, method, path):
+        return any(method in methods and pattern.match(path)
+                   for methods, pattern in self.routes)
+
+    def __call__(self, environ, start_response):
+        if self.port is not None and environ.get('SERVER_PORT') != self.port:
+            return self.app(environ, start_response)
+        if self.allowed(environ['REQUEST_METHOD'], environ.get('PATH_INFO', '')):
+            return self.app(environ, start_response)
+        body = json.dumps({'status': 405, 'error': 'method not allowed',
+                           'message': 'read-only server'}).encode('utf-8')
+        start_response('405 METHOD NOT ALLOWED', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body)))])
+        return [body]
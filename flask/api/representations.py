@@ -0,0 +1,123 @@
+import zlib
+from flask import Response, current_app, request, stream_with_context
+
+try:
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj)
+except ImportError:
+    import json
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Preferred first when the client accepts several equally.
+ENCODINGS = (['br'] if brotli is not None else []) + ['gzip', 'deflate']
+
+
+def _bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def iter_json(data, chunk_rows=500):
+    """Encode a JSON document in chunks of rows.
+
+    Lists are written element by element so a large result set never has
+    to exist as one encoded string.
+    """
+    if not isinstance(data, (list, tuple)) or not data:
+        yield _bytes(dumps(data) + "\n")
+        return
+    chunk = []
+    prefix = '['
+    for row in data:
+        chunk.append(dumps(row))
+        if len(chunk) >= chunk_rows:
+            yield _bytes(prefix + ','.join(chunk))
+            chunk = []
+            prefix = ','
+    if chunk:
+        yield _bytes(prefix + ','.join(chunk) + "]\n")
+    else:
+        yield b"]\n"
+
+
+def negotiate_encoding():
+    """Pick the content coding for the current request, or None.
+    """
+    if not current_app.config.get('JSON_COMPRESS', True):
+        return None
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+class BrotliCompressor(object):
+    """zlib compressobj interface over brotli.Compressor.
+    """
+
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+        # Brotli exposes process(); brotlipy calls it compress().
+        self._process = getattr(self.compressor, 'process', None) or self.compressor.compress
+
+    def compress(self, data):
+        return self._process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+def compressor(encoding):
+    if encoding == 'br':
+        return BrotliCompressor(current_app.config.get('JSON_BROTLI_QUALITY', 5))
+    level = current_app.config.get('JSON_COMPRESS_LEVEL', 6)
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+
+
+def iter_compressed(chunks, encoding):
+    compress = compressor(encoding)
+    for chunk in chunks:
+        data = compress.compress(chunk)
+        if data:
+            yield data
+    yield compress.flush()
+
+
+def output_json(data, code, headers=None):
+    """Flask-RESTful representation for application/json.
+
+    Large lists are streamed in row chunks; bodies are compressed with
+    gzip or deflate when the client accepts it.
+    """
+    config = current_app.config
+    encoding = negotiate_encoding()
+    chunk_rows = config.get('JSON_STREAM_CHUNK_ROWS', 500)
+    if isinstance(data, (list, tuple)) and \
+            len(data) >= config.get('JSON_STREAM_MIN_ROWS', 1000):
+        body = iter_json(data, chunk_rows)
+        if encoding:
+            body = iter_compressed(body, encoding)
+        resp = Response(stream_with_context(body), status=code,
+                        mimetype='application/json')
+    else:
+        body = b''.join(iter_json(data, chunk_rows))
+        if encoding and len(body) < config.get('JSON_COMPRESS_MIN_SIZE', 1024):
+            encoding = None
+        if encoding:
+            body = b''.join(iter_compressed([body], encoding))
+        resp = Response(body, status=code, mimetype='application/json')
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    resp.headers.add('Vary', 'Accept-Encoding')
+    resp.headers.extend(headers or {})
+    return resp
@@ -1,9 +1,15 @@
 from flask import Blueprint, g, Flask, jsonify, abort, make_response, request
 from flask_restful import Api, reqparse, fields, marshal
 from ..errors import ValidationError, bad_request, not_found
+from ..representations import output_json
+from ..ratelimit import limit_request
 
 api_v1_bp = Blueprint('api_v1', __name__)
 api_v1 = Api(api_v1_bp)
+api_v1.representation('application/json')(output_json)
+
+api_v1_bp.before_request(limit_request)
+
 
 @api_v1_bp.errorhandler(ValidationError)
 def validation_error(e):
@@ -21,15 +27,19 @@ def bad_request_error(e):
 #    pass
 
 
-from .sapb1api import InfoAPI, CodeAPI, OrdersAPI, QuotesAPI, ContactsAPI, ShipmentsAPI, ItemsAPI, PricesAPI, CustomersAPI, Login
+from .sapb1api import InfoAPI, CodeAPI, OrdersAPI, QuotesAPI, ContactsAPI, ShipmentsAPI, ItemsAPI, PricesAPI, StockAPI, CustomersAPI, BatchAPI, ProfilesAPI, WebhooksAPI, Login
 
 api_v1.add_resource(InfoAPI, '/info', endpoint='info')
 api_v1.add_resource(CodeAPI, '/code', endpoint='code')
 api_v1.add_resource(OrdersAPI, '/orders/<function>')
 api_v1.add_resource(QuotesAPI, '/quotes')
 api_v1.add_resource(ContactsAPI, '/contacts/<function>')
-api_v1.add_resource(CustomersAPI, '/customers')
+api_v1.add_resource(CustomersAPI, '/customers', '/customers/<function>')
 api_v1.add_resource(ShipmentsAPI, '/shipments/<function>')
-api_v1.add_resource(ItemsAPI, '/items')
-api_v1.add_resource(PricesAPI, '/prices')
+api_v1.add_resource(ItemsAPI, '/items', '/items/<function>')
+api_v1.add_resource(PricesAPI, '/prices', '/prices/<function>')
+api_v1.add_resource(StockAPI, '/stock', '/stock/<function>')
+api_v1.add_resource(BatchAPI, '/batch')
+api_v1.add_resource(ProfilesAPI, '/profiles', '/profiles/<resource>', '/profiles/<resource>/<name>')
+api_v1.add_resource(WebhooksAPI, '/webhooks', '/webhooks/<int:id>', '/webhooks/<int:id>/<function>')
 api_v1.add_resource(Login, '/login')
@@ -1,9 +1,16 @@
 from flask import request, current_app, jsonify
-from ..app import sapb1Adaptor
-from flask_jwt_extended import jwt_required, create_access_token
+from ..app import authenticate, sapb1Adaptor
+from flask_sapb1 import ComBusy, decode_sync_token
+from ..errors import bad_request, not_found, unauthorized
+from ..auth import jwt_required
+from ..ratelimit import overloaded, uses_com, uses_sql
+from ..caching import conditional
+from .. import batch, exports, ingest
+from flask_jwt_extended import create_access_token
 from flask_restful import Resource
 import json
 import traceback
+from time import strftime
 
 class Login(Resource):
     def __init__(self):
@@ -11,29 +18,25 @@ class Login(Resource):
     
     def post(self):
         if not request.is_json:
-            print("error no json")
-            #return jsonify({"msg": "Missing JSON in request"}), 400
+            return bad_request("Missing JSON in request")
 
         username = request.json.get('username', None)
         password = request.json.get('password', None)
-        print(username)
-        print(password)
         if not username:
-            print("error user")
-            #return jsonify({"msg": "Missing username parameter"}), 400
+            return bad_request("Missing username parameter")
         if not password:
-            print("error pass")
-            #return jsonify({"msg": "Missing password parameter"}), 400
+            return bad_request("Missing password parameter")
+        if not isinstance(username, basestring) or not isinstance(password, basestring):
+            return bad_request("username and password must be strings")
 
-        if username != 'test' or password != 'test':
-            print("error both")
-            #return jsonify({"msg": "Bad username or password"}), 401
+        if authenticate(username, password) is None:
+            current_app.logger.warning("Failed login for %s", username)
+            return unauthorized("Bad username or password")
 
         # Identity can be any data that is json serializable
         access_token = create_access_token(identity=username)
         return access_token, 200
 
-
 class InfoAPI(Resource):
 
     def __init__(self):
@@ -41,8 +44,15 @@ class InfoAPI(Resource):
 
     @jwt_required
     def get(self):
+        notModified, headers = conditional('InfoAPI', lambda: sapb1Adaptor.getDataVersion('info'))
+        if notModified is not None:
+            return notModified
+        try:
+            sapb1Adaptor.acquireCom()
+        except ComBusy as e:
+            return overloaded(e)
         info = sapb1Adaptor.info()
-        return info, 201
+        return info, 200, headers
 
 class CodeAPI(Resource):
 
@@ -50,8 +60,22 @@ class CodeAPI(Resource):
         super(CodeAPI, self).__init__()
 
     @jwt_required
+    @uses_sql
     def get(self):
         type = request.args.get("type")
+        # One date for the rate and its version, so they cannot disagree
+        # around midnight or across time zones.
+        rateDate = strftime("%Y-%m-%d")
+
+        def version():
+            if type == "USDRate":
+                return sapb1Adaptor.getDataVersion(type, (rateDate,))
+            if type in ("ExpnsName", "TrnspName", "PayMethCod", "TaxCode"):
+                return sapb1Adaptor.getDataVersion(type)
+            return None, None
+        notModified, headers = conditional('CodeAPI', version)
+        if notModified is not None:
+            return notModified
         codes = []
         if type == "ExpnsName":
             codes = sapb1Adaptor.getExpnsNames()
@@ -62,8 +86,41 @@ class CodeAPI(Resource):
         elif type == "TaxCode":
             codes = sapb1Adaptor.getTaxCodes()
         elif type == "USDRate":
-            codes = sapb1Adaptor.getUSDRate()
-        return codes, 201
+            codes = sapb1Adaptor.getUSDRate(rateDate)
+        return codes, 200, headers
+
+def process_order(function, order):
+    """Insert or cancel one order and record the outcome on it.
+    """
+    try:
+        if function == "insert":
+            order["order_id"] = sapb1Adaptor.insertOrder(order)
+            order["tx_status"] = 'S'
+        else:
+            order["order_id"] = sapb1Adaptor.cancelOrder(order)
+            order["tx_status"] = 'X'
+    except Exception as e:
+        log = traceback.format_exc()
+        if function == "insert":
+            order["order_id"] = "####"
+        order["tx_status"] = 'F'
+        order["tx_note"] = log
+        current_app.logger.exception(e)
+    return order
+
+def process_shipment(order):
+    """Insert one shipment and record the outcome on it.
+    """
+    try:
+        order["order_id"] = sapb1Adaptor.insertShipment(order)
+        order["tx_status"] = 'S'
+    except Exception as e:
+        log = traceback.format_exc()
+        order["order_id"] = "####"
+        order["tx_status"] = 'F'
+        order["tx_note"] = log
+        current_app.logger.exception(e)
+    return order
 
 class OrdersAPI(Resource):
 
@@ -71,6 +128,7 @@ class OrdersAPI(Resource):
         super(OrdersAPI, self).__init__()
 
     @jwt_required
+    @uses_sql
     def put(self, function):
         try:
             if function == "fetch":
@@ -78,48 +136,37 @@ class OrdersAPI(Resource):
                 _num = 100 if _num is None else int(_num)
                 num = 100 if _num > 100 else _num
                 data = request.get_json(force=True)
-                columns = data['columns'] if 'columns' in data.keys() else {}
+                columns = data['columns'] if 'columns' in data.keys() else request.args.get("fields")
+                profile = data.get('profile', request.args.get("profile"))
                 params = data['params']
-                orders = sapb1Adaptor.getOrders(num=num, columns=columns, params=params)
+                orders = sapb1Adaptor.getOrders(num=num, columns=columns, params=params, profile=profile,
+                                                shared=True)
                 return orders, 201
             else:
                 log = "No such function({0})!!!".format(function)
                 current_app.logger.error(log)
                 raise Exception(log)
+        except ValueError as e:
+            current_app.logger.warning(e)
+            return bad_request(str(e))
         except Exception as e:
             log = traceback.format_exc()
             current_app.logger.exception(e)
             return log, 501
 
     @jwt_required
+    @uses_com
     def post(self, function):
         try:
-            orders = request.get_json(force=True)
-            if function == "insert":
-                for order in orders:
-                    try:
-                        order["order_id"] = sapb1Adaptor.insertOrder(order)
-                        order["tx_status"] = 'S'
-                    except Exception as e:
-                        log = traceback.format_exc()
-                        order["order_id"] = "####"
-                        order["tx_status"] = 'F'
-                        order["tx_note"] = log
-                        current_app.logger.exception(e)
-            elif function == "cancel":
-                for order in orders:
-                    try:
-                        order["order_id"] = sapb1Adaptor.cancelOrder(order)
-                        order["tx_status"] = 'X'
-                    except Exception as e:
-                        log = traceback.format_exc()
-                        order["tx_status"] = 'F'
-                        order["tx_note"] = log
-                        current_app.logger.exception(e)
-            else:
+            if function not in ("insert", "cancel"):
                 log = "No such function({0})!!!".format(function)
                 current_app.logger.error(log)
                 raise Exception(log)
+            if ingest.is_ndjson():
+                return ingest.stream_response(lambda order: process_order(function, order))
+            orders = request.get_json(force=True)
+            for order in orders:
+                process_order(function, order)
             return orders, 201
         except Exception as e:
             log = traceback.format_exc()
@@ -132,6 +179,7 @@ class QuotesAPI(Resource):
         super(QuotesAPI, self).__init__()
 
     @jwt_required
+    @uses_com
     def post(self):
         quotations = request.get_json(force=True)
         for quotation in quotations:
@@ -154,19 +202,28 @@ class CustomersAPI(Resource):
         return log, number
 
     @jwt_required
-    def post(self):
+    @uses_com
+    def post(self, function=None):
         data = request.get_json(force=True)
         try:
+            if function == "upsert":
+                customers = sapb1Adaptor.upsertBusinessPartners(data['customers'])
+                return customers, 201
+            elif function is not None:
+                log = "No such function({0})!!!".format(function)
+                current_app.logger.error(log)
+                raise Exception(log)
             customer = data['customer']
             cardCode = sapb1Adaptor.insertBusinessPartner(customer)
             return cardCode, 201
         except KeyError as e:
-            return error_to_json(e, 400)
+            return self.error_to_json(e, 400)
         except Exception as e:
-            return error_to_json(e, 501)
+            return self.error_to_json(e, 501)
 
     @jwt_required
-    def put(self):
+    @uses_com
+    def put(self, function=None):
         data = request.get_json(force=True)
         cardcode = request.args.get("cardcode", None)
         try:
@@ -174,9 +231,9 @@ class CustomersAPI(Resource):
             cardCode = sapb1Adaptor.updateBusinessPartner(cardcode, customer)
             return cardCode, 202
         except KeyError as e:
-            return error_to_json(e, 400)
+            return self.error_to_json(e, 400)
         except Exception as e:
-            return error_to_json(e, 501)    
+            return self.error_to_json(e, 501)    
 
 # Retrieve contacts by CardCode.
 class ContactsAPI(Resource):
@@ -185,6 +242,7 @@ class ContactsAPI(Resource):
         super(ContactsAPI, self).__init__()
 
     @jwt_required
+    @uses_sql
     def put(self, function):
         try:
             if function == "fetch":
@@ -207,14 +265,15 @@ class ContactsAPI(Resource):
             return log, 501
 
     @jwt_required
+    @uses_com
     def post(self, function):
         try:
             if function == "insert":
                 data = request.get_json(force=True)
                 cardCode = data['card_code']
                 contacts = data['contacts']
-                for contact in contacts:
-                    contactCode = sapb1Adaptor.insertContact(cardCode, contact)
+                contactCodes = sapb1Adaptor.insertContacts(cardCode, contacts)
+                for contact, contactCode in zip(contacts, contactCodes):
                     contact["contact_code"] = contactCode
                 return contacts, 201
             else:
@@ -233,24 +292,18 @@ class ShipmentsAPI(Resource):
         super(ShipmentsAPI, self).__init__()
     
     @jwt_required
+    @uses_com
     def post(self, function):
         try:
-            orders = request.get_json(force=True)
-            if function == "insert":
-                for order in orders:
-                    try:
-                        order["order_id"] = sapb1Adaptor.insertShipment(order)
-                        order["tx_status"] = 'S'
-                    except Exception as e:
-                        log = traceback.format_exc()
-                        order["order_id"] = "####"
-                        order["tx_status"] = 'F'
-                        order["tx_note"] = log
-                        current_app.logger.exception(e)
-            else:
+            if function != "insert":
                 log = "No such function({0})!!!".format(function)
                 current_app.logger.error(log)
                 raise Exception(log)
+            if ingest.is_ndjson():
+                return ingest.stream_response(process_shipment)
+            orders = request.get_json(force=True)
+            for order in orders:
+                process_shipment(order)
             return orders, 201
         except Exception as e:
             log = traceback.format_exc()
@@ -258,6 +311,7 @@ class ShipmentsAPI(Resource):
             return log, 501
 
     @jwt_required
+    @uses_sql
     def put(self, function):
         try:
             if function == "fetch":
@@ -265,15 +319,20 @@ class ShipmentsAPI(Resource):
                 _num = 100 if _num is None else int(_num)
                 num = 100 if _num > 100 else _num
                 data = request.get_json(force=True)
-                columns = data['columns'] if 'columns' in data.keys() else {}
+                columns = data['columns'] if 'columns' in data.keys() else request.args.get("fields")
                 itemColumns = data['itemcolumns'] if 'itemcolumns' in data.keys() else {}
+                profile = data.get('profile', request.args.get("profile"))
                 params = data['params']
-                shipments = sapb1Adaptor.getShipments(num=num, columns=columns, params=params, itemColumns=itemColumns)
+                shipments = sapb1Adaptor.getShipments(num=num, columns=columns, params=params,
+                                                      itemColumns=itemColumns, profile=profile)
                 return shipments, 201
             else:
                 log = "No such function({0})!!!".format(function)
                 current_app.logger.error(log)
                 raise Exception(log)
+        except ValueError as e:
+            current_app.logger.warning(e)
+            return bad_request(str(e))
         except Exception as e:
             log = traceback.format_exc()
             current_app.logger.exception(e)
@@ -286,15 +345,66 @@ class ItemsAPI(Resource):
         super(ItemsAPI, self).__init__()
 
     @jwt_required
-    def get(self):
+    @uses_sql
+    def get(self, function=None):
         try:
             limit = request.args.get("limit", 100)
             limit = int(limit)
             fields = request.args.get("fields",None)
             whs = request.args.get("whs",None)
             code = request.args.get("code",None)
-            itemslist = sapb1Adaptor.getItems(limit=limit, columns=fields, whs=whs, code=code)
-            return itemslist, 201
+            since = request.args.get("since",None)
+            if since:
+                decode_sync_token(since)
+            headers = {}
+            if since is not None:
+                headers['X-Sync-Token'] = sapb1Adaptor.getSyncToken()
+            else:
+                # OITW (whs) and columns outside the version are not covered.
+                notModified, headers = conditional(
+                    'ItemsAPI', lambda: sapb1Adaptor.getDataVersion('items'),
+                    cacheable=not whs and sapb1Adaptor.versionCovers('items', fields))
+                if notModified is not None:
+                    return notModified
+            fmt = request.args.get("format", "json")
+            if fmt in exports.FORMATS:
+                if fmt == "arrow" and exports.pyarrow is None:
+                    return bad_request("format arrow requires pyarrow")
+                size = current_app.config.get('EXPORT_BATCH_ROWS', 5000)
+                batches = sapb1Adaptor.iterItems(limit=limit, columns=fields, whs=whs, code=code, since=since, size=size)
+                resp = exports.export_response(fmt, batches, "items")
+                resp.headers.extend(headers)
+                return resp
+            elif fmt != "json":
+                return bad_request("unsupported format {0}".format(fmt))
+            itemslist = sapb1Adaptor.getItems(limit=limit, columns=fields, whs=whs, code=code, since=since)
+            if since is not None:
+                return {'since': headers['X-Sync-Token'], 'data': itemslist}, 200, headers
+            return itemslist, 200, headers
+        except ValueError as e:
+            current_app.logger.warning(e)
+            return bad_request(str(e))
+        except Exception as e:
+            log = traceback.format_exc()
+            current_app.logger.exception(e)
+            return log, 501
+
+    @jwt_required
+    @uses_sql
+    def post(self, function=None):
+        try:
+            if function == "batch":
+                data = request.get_json(force=True)
+                codes = data['codes']
+                if len(codes) > current_app.config.get('BATCH_MAX_CODES', 1000):
+                    return bad_request("too many codes")
+                fields = data.get('fields', None)
+                result = sapb1Adaptor.getItemsByCodes(codes, columns=fields)
+                return result, 201
+            else:
+                log = "No such function({0})!!!".format(function)
+                current_app.logger.error(log)
+                raise Exception(log)
         except Exception as e:
             log = traceback.format_exc()
             current_app.logger.exception(e)
@@ -307,15 +417,240 @@ class PricesAPI(Resource):
         super(PricesAPI, self).__init__()
 
     @jwt_required
-    def get(self):
+    @uses_sql
+    def get(self, function=None):
         try:
             limit = request.args.get("limit", 100)
             limit = int(limit)
             fields = request.args.get("fields",None)
             whs = request.args.get("whs",None)
             code = request.args.get("code",None)
-            pricelist = sapb1Adaptor.getPrices(limit=limit, columns=fields, whs=whs, code=code)
-            return pricelist, 201
+            since = request.args.get("since",None)
+            if since:
+                decode_sync_token(since)
+            headers = {}
+            if since is not None:
+                headers['X-Sync-Token'] = sapb1Adaptor.getSyncToken()
+            else:
+                notModified, headers = conditional('PricesAPI', lambda: (
+                    '{0}/{1}'.format(sapb1Adaptor.getDataVersion('prices')[0],
+                                     sapb1Adaptor.getDataVersion('items')[0]), None),
+                    cacheable=not whs and sapb1Adaptor.versionCovers('prices', fields))
+                if notModified is not None:
+                    return notModified
+            fmt = request.args.get("format", "json")
+            if fmt in exports.FORMATS:
+                if fmt == "arrow" and exports.pyarrow is None:
+                    return bad_request("format arrow requires pyarrow")
+                size = current_app.config.get('EXPORT_BATCH_ROWS', 5000)
+                batches = sapb1Adaptor.iterPrices(limit=limit, columns=fields, whs=whs, code=code, since=since, size=size)
+                resp = exports.export_response(fmt, batches, "prices")
+                resp.headers.extend(headers)
+                return resp
+            elif fmt != "json":
+                return bad_request("unsupported format {0}".format(fmt))
+            pricelist = sapb1Adaptor.getPrices(limit=limit, columns=fields, whs=whs, code=code, since=since)
+            if since is not None:
+                return {'since': headers['X-Sync-Token'], 'data': pricelist}, 200, headers
+            return pricelist, 200, headers
+        except ValueError as e:
+            current_app.logger.warning(e)
+            return bad_request(str(e))
+        except Exception as e:
+            log = traceback.format_exc()
+            current_app.logger.exception(e)
+            return log, 501
+
+    @jwt_required
+    @uses_sql
+    def post(self, function=None):
+        try:
+            if function == "batch":
+                data = request.get_json(force=True)
+                codes = data['codes']
+                if len(codes) > current_app.config.get('BATCH_MAX_CODES', 1000):
+                    return bad_request("too many codes")
+                fields = data.get('fields', None)
+                result = sapb1Adaptor.getPricesByCodes(codes, columns=fields)
+                return result, 201
+            else:
+                log = "No such function({0})!!!".format(function)
+                current_app.logger.error(log)
+                raise Exception(log)
+        except Exception as e:
+            log = traceback.format_exc()
+            current_app.logger.exception(e)
+            return log, 501
+
+#Retrive Stock of Products on WHS
+class StockAPI(Resource):
+
+    def __init__(self):
+        super(StockAPI, self).__init__()
+
+    @jwt_required
+    @uses_sql
+    def get(self, function=None):
+        try:
+            limit = request.args.get("limit", 100)
+            limit = int(limit)
+            fields = request.args.get("fields",None)
+            whs = request.args.get("whs",None)
+            code = request.args.get("code",None)
+            since = request.args.get("since",None)
+            if since:
+                decode_sync_token(since)
+            headers = {}
+            if since is not None:
+                headers['X-Sync-Token'] = sapb1Adaptor.getSyncToken()
+            refresh = request.args.get("refresh", "0") in ("1", "true")
+            stocklist = sapb1Adaptor.getStockNum(limit=limit, columns=fields, whs=whs, code=code, since=since, refresh=refresh)
+            if since is not None:
+                return {'since': headers['X-Sync-Token'], 'data': stocklist}, 200, headers
+            return stocklist, 200
+        except ValueError as e:
+            current_app.logger.warning(e)
+            return bad_request(str(e))
+        except Exception as e:
+            log = traceback.format_exc()
+            current_app.logger.exception(e)
+            return log, 501
+
+    @jwt_required
+    @uses_sql
+    def post(self, function=None):
+        try:
+            if function == "batch":
+                data = request.get_json(force=True)
+                codes = data['codes']
+                if len(codes) > current_app.config.get('BATCH_MAX_CODES', 1000):
+                    return bad_request("too many codes")
+                fields = data.get('fields', None)
+                result = sapb1Adaptor.getStockByCodes(codes, columns=fields, whs=data.get('whs', None), refresh=data.get('refresh', False))
+                return result, 201
+            else:
+                log = "No such function({0})!!!".format(function)
+                current_app.logger.error(log)
+                raise Exception(log)
+        except Exception as e:
+            log = traceback.format_exc()
+            current_app.logger.exception(e)
+            return log, 501
+
+#Column profiles of the document fetches
+class ProfilesAPI(Resource):
+
+    def __init__(self):
+        super(ProfilesAPI, self).__init__()
+
+    @jwt_required
+    def get(self, resource=None, name=None):
+        profiles = sapb1Adaptor.columnProfiles.all()
+        if resource is None:
+            return profiles, 200
+        if resource not in profiles:
+            return not_found("no such resource {0}".format(resource))
+        if name is None:
+            return profiles[resource], 200
+        if name not in profiles[resource]:
+            return not_found("no such profile {0}".format(name))
+        return profiles[resource][name], 200
+
+    @jwt_required
+    @uses_sql
+    def put(self, resource=None, name=None):
+        try:
+            data = request.get_json(force=True)
+            columns = data['columns'] if isinstance(data, dict) else data
+            if not columns or not isinstance(columns, list):
+                return bad_request("columns must be a non-empty list")
+            sapb1Adaptor.saveColumnProfile(resource, name, columns)
+            return {'resource': resource, 'name': name, 'columns': columns}, 201
+        except ValueError as e:
+            current_app.logger.warning(e)
+            return bad_request(str(e))
+        except Exception as e:
+            log = traceback.format_exc()
+            current_app.logger.exception(e)
+            return log, 501
+
+#Webhooks the change feed pushes document changes to
+class WebhooksAPI(Resource):
+
+    def __init__(self):
+        super(WebhooksAPI, self).__init__()
+
+    def _outbox(self):
+        feed = current_app.extensions.get('changefeed')
+        return feed.outbox if feed is not None else None
+
+    @jwt_required
+    def get(self, id=None):
+        outbox = self._outbox()
+        if outbox is None:
+            return not_found("the change feed is not enabled")
+        if id is None:
+            return {'webhooks': outbox.webhooks()}, 200
+        webhook = outbox.webhook(id)
+        if webhook is None:
+            return not_found("no such webhook {0}".format(id))
+        return webhook, 200
+
+    @jwt_required
+    def post(self, id=None, function=None):
+        outbox = self._outbox()
+        if outbox is None:
+            return not_found("the change feed is not enabled")
+        try:
+            if id is not None:
+                if function != 'redeliver':
+                    return not_found("no such function {0}".format(function))
+                if outbox.webhook(id) is None:
+                    return not_found("no such webhook {0}".format(id))
+                return {'id': id, 'requeued': outbox.redeliver(id)}, 200
+            data = request.get_json(force=True)
+            url = data.get('url') if isinstance(data, dict) else None
+            if not url or not url.startswith(('http://', 'https://')):
+                return bad_request("url must be an http or https URL")
+            feed = current_app.extensions['changefeed']
+            resources = data.get('resources') or list(feed.resources)
+            unknown = [r for r in resources if r not in feed.resources]
+            if unknown:
+                return bad_request("unknown resources {0}".format(', '.join(unknown)))
+            return outbox.addWebhook(url, resources, data.get('secret')), 201
+        except Exception as e:
+            log = traceback.format_exc()
+            current_app.logger.exception(e)
+            return log, 501
+
+    @jwt_required
+    def delete(self, id=None):
+        outbox = self._outbox()
+        if outbox is None:
+            return not_found("the change feed is not enabled")
+        if id is None or not outbox.removeWebhook(id):
+            return not_found("no such webhook {0}".format(id))
+        return {'id': id, 'deleted': True}, 200
+
+#Run several operations in one request
+class BatchAPI(Resource):
+
+    def __init__(self):
+        super(BatchAPI, self).__init__()
+
+    @jwt_required
+    def post(self):
+        try:
+            data = request.get_json(force=True)
+            operations = data.get('operations') if isinstance(data, dict) else data
+            operations = batch.parse(operations, current_app.config.get('BATCH_MAX_OPERATIONS', 20))
+            headers = {'Authorization': request.headers.get('Authorization', '')}
+            results = batch.run(operations, headers,
+                                maxThreads=current_app.config.get('BATCH_MAX_THREADS', 4))
+            return {'results': results}, 200
+        except ValueError as e:
+            current_app.logger.warning(e)
+            return bad_request(str(e))
         except Exception as e:
             log = traceback.format_exc()
             current_app.logger.exception(e)
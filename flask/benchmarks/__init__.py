@@ -0,0 +1,4 @@
+"""Offline benchmarks of the adaptor and API hot paths.
+
+Run with `python manage.py bench`; see runner.run for the options.
+"""
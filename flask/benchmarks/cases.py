@@ -0,0 +1,84 @@
+"""The benchmarked operations.
+
+Each case runs once per iteration inside its own app context, so the DI
+Connect and the SQL connection of a request are part of the measurement.
+"""
+import json
+
+
+def order(n, total=150.0, giftcard=False, giftcard_amount=0.0, items=3):
+    """A web order as posted to /v1/orders/insert.
+    """
+    return {
+        'U_WebOrderId': 'B%08d' % n,
+        'doc_due_date': '2020-01-31',
+        'shipping_first_name': 'Jane', 'shipping_last_name': 'Doe',
+        'order_first_name': 'Jane', 'order_last_name': 'Doe',
+        'order_phone': '5555555', 'shipping_phone': '5555555',
+        'order_email': 'jane@example.com',
+        'cc_last4': '4242', 'cc_type': 'VISA', 'user_id': 42,
+        'order_shipping_cost': 9.95, 'discount_percent': 0,
+        'payment_method': 'CC', 'comments': 'benchmark',
+        'billto_city': 'Austin', 'billto_country': 'US', 'billto_state': 'TX',
+        'billto_address': '1 Main St', 'billto_zipcode': '78701',
+        'shipto_city': 'Austin', 'shipto_country': 'US', 'shipto_state': 'TX',
+        'shipto_address': '1 Main St', 'shipto_zipcode': '78701',
+        'order_tax': '8.25', 'order_total': total,
+        'giftcard': giftcard, 'giftcard_amount': giftcard_amount,
+        'items': [{'itemcode': 'I%06d' % i, 'quantity': 1 + i, 'price': 10.0 + i}
+                  for i in range(items)],
+    }
+
+
+def adaptor_case(call):
+    def run(bench, n):
+        call(bench.adaptor, n)
+    return run
+
+
+def api_case(method, url, body=None, content_type='application/json'):
+    def run(bench, n):
+        data = body(n) if callable(body) else body
+        if content_type == 'application/json':
+            data = json.dumps(data)
+        resp = bench.client.open(url, method=method, data=data,
+                                 headers=bench.headers,
+                                 content_type=content_type)
+        resp.get_data()
+        if resp.status_code >= 400:
+            raise Exception('{0} {1}: {2}'.format(method, url, resp.status_code))
+    return run
+
+
+CASES = [
+    ('insertOrder.card', adaptor_case(
+        lambda a, n: a.insertOrder(order(n)))),
+    ('insertOrder.giftcard_partial', adaptor_case(
+        lambda a, n: a.insertOrder(order(n, giftcard=True, giftcard_amount=50.0)))),
+    ('insertOrder.giftcard_full', adaptor_case(
+        lambda a, n: a.insertOrder(order(n, giftcard=True, giftcard_amount=200.0)))),
+    ('insertOrder.no_payment', adaptor_case(
+        lambda a, n: a.insertOrder(order(n, total=0)))),
+    ('insertShipment', adaptor_case(
+        lambda a, n: a.insertShipment(order(n)))),
+    ('getOrders', adaptor_case(
+        lambda a, n: a.getOrders(num=100, columns=['DocEntry', 'DocNum', 'DocTotal'],
+                                 params={'CardCode': {'value': 'C105212'}}))),
+    ('getItems', adaptor_case(
+        lambda a, n: a.getItems(limit=1000))),
+    ('codes.getExpnsNames', adaptor_case(lambda a, n: a.getExpnsNames())),
+    ('codes.getTrnspNames', adaptor_case(lambda a, n: a.getTrnspNames())),
+    ('codes.getPayMethCods', adaptor_case(lambda a, n: a.getPayMethCods())),
+    ('codes.getTaxCodes', adaptor_case(lambda a, n: a.getTaxCodes())),
+    ('codes.getUSDRate', adaptor_case(lambda a, n: a.getUSDRate())),
+    ('codes.getExpnsCode', adaptor_case(lambda a, n: a.getExpnsCode('Freight 1'))),
+    ('codes.getTrnspCode', adaptor_case(lambda a, n: a.getTrnspCode('fedex_ground'))),
+    ('api.orders.insert', api_case(
+        'POST', '/v1/orders/insert', lambda n: [order(n)])),
+    ('api.orders.insert.ndjson', api_case(
+        'POST', '/v1/orders/insert', lambda n: json.dumps(order(n)) + '\n',
+        content_type='application/x-ndjson')),
+    ('api.items', api_case('GET', '/v1/items?limit=1000')),
+    ('api.items.csv', api_case('GET', '/v1/items?limit=1000&format=csv')),
+    ('api.code', api_case('GET', '/v1/code?type=TaxCode')),
+]
@@ -0,0 +1,283 @@
+"""In-process stand-ins for the SAP B1 DI API and the SQL Server driver.
+
+Both count their round trips and sleep for an injected latency on each, so
+a benchmark measures the adaptor's own work plus a known backend cost.
+"""
+import datetime
+import decimal
+import numbers
+import re
+import threading
+from time import sleep
+
+
+class Counters(object):
+    """Round trips to the fake backends, shared by all fake connections.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.di = 0
+        self.sql = 0
+
+    def count(self, kind):
+        with self.lock:
+            setattr(self, kind, getattr(self, kind) + 1)
+
+
+counters = Counters()
+
+# Seconds slept per DI round trip and per SQL statement.
+latency = {'di': 0.0, 'sql': 0.0}
+
+
+def _roundTrip(kind):
+    counters.count(kind)
+    if latency[kind]:
+        sleep(latency[kind])
+
+
+# ---------------------------------------------------------------------------
+# DI API
+
+
+class _Constants(object):
+    """Any constant name resolves to a number.
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return abs(hash(name)) % 1000
+
+
+constants = _Constants()
+
+
+class _Node(object):
+    """A DI object or sub-object (Lines, UserFields, AddressExtension...).
+
+    Properties can be set freely; unknown properties read as child nodes.
+    Only business objects from GetBusinessObject make round trips.
+    """
+
+    def __init__(self, businessObject=False):
+        self.__dict__['_businessObject'] = businessObject
+        self.__dict__['_values'] = {}
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        values = self.__dict__['_values']
+        if name not in values:
+            values[name] = _Node()
+        return values[name]
+
+    def __setattr__(self, name, value):
+        self.__dict__['_values'][name] = value
+
+    def _call(self):
+        if self.__dict__['_businessObject']:
+            _roundTrip('di')
+
+    def Add(self):
+        self._call()
+        return 0
+
+    def Update(self):
+        self._call()
+        return 0
+
+    def Cancel(self):
+        self._call()
+        return 0
+
+    def Close(self):
+        self._call()
+        return 0
+
+    def GetByKey(self, *args):
+        self._call()
+        return True
+
+    def SetCurrentLine(self, line):
+        pass
+
+    def Fields(self, name):
+        return getattr(self, 'Field_' + name)
+
+    @property
+    def Count(self):
+        return 1
+
+
+class Company(object):
+    """SAPbobsCOM.Company stand-in.
+    """
+
+    CompanyName = 'BENCHMARK'
+
+    def Connect(self):
+        _roundTrip('di')
+        return 0
+
+    def Disconnect(self):
+        pass
+
+    def GetBusinessObject(self, objectType):
+        return _Node(businessObject=True)
+
+    def GetLastError(self):
+        return 0
+
+    def GetLastErrorDescription(self):
+        return ''
+
+
+# ---------------------------------------------------------------------------
+# SQL
+
+
+def _rows(count, make):
+    return lambda sql, args: [make(i) for i in range(count)]
+
+
+def _columns(sql, args):
+    """Every column any profile or adaptor query names, for any table.
+    """
+    from flask_sapb1 import COLUMN_PROFILES
+    names = set(['DocEntry', 'DocNum', 'DocTotal', 'DocDate', 'CardCode', 'U_WebOrderId',
+                 'LineNum', 'LineTotal', 'ObjType', 'TaxCode', 'ExpnsCode'])
+    for profiles in COLUMN_PROFILES.values():
+        for columns in profiles.values():
+            names.update(c for c in columns if c != '*')
+    return [{'COLUMN_NAME': name} for name in sorted(names)]
+
+
+def default_tables(items=1000, orders=100):
+    """Responders for the statements the adaptor issues: (pattern, rows).
+    """
+    now = datetime.datetime(2020, 1, 1, 12, 0, 0)
+    money = decimal.Decimal('125.500000')
+    return [
+        (r'INFORMATION_SCHEMA\.COLUMNS', _columns),
+        (r'FROM dbo\.ORDR INNER JOIN dbo\.RDR1|FROM dbo\.ODLN INNER JOIN dbo\.DLN1',
+         _rows(1, lambda i: {'LineNum': 0})),
+        (r'FROM dbo\.ORDR', _rows(orders, lambda i: {
+            'DocEntry': 1000 + i, 'DocNum': 5000 + i, 'DocTotal': money,
+            'DocDate': now, 'CardCode': 'C105212', 'U_WebOrderId': str(i)})),
+        (r'FROM dbo\.ODPI', _rows(1, lambda i: {
+            'DocEntry': 2000, 'DocNum': 6000, 'DocTotal': money, 'DocDate': now})),
+        (r'FROM dbo\.ODLN', _rows(1, lambda i: {
+            'DocEntry': 3000, 'DocNum': 7000, 'DocTotal': money})),
+        (r'FROM dbo\.RDR3', _rows(1, lambda i: {
+            'DocEntry': 1000, 'LineTotal': money, 'ObjType': '17',
+            'TaxCode': 'FLEX', 'ExpnsCode': 1, 'LineNum': 0})),
+        (r'FROM dbo\.OITM', _rows(items, lambda i: {
+            'ItemCode': 'I%06d' % i, 'ItemName': u'Item %d' % i,
+            'ItmsGrpCod': 100, 'CreateDate': now, 'UpdateDate': now})),
+        (r'FROM dbo\.OEXD WHERE', _rows(1, lambda i: {'ExpnsCode': 1})),
+        (r'FROM dbo\.OEXD', _rows(5, lambda i: {'ExpnsName': u'Freight %d' % i})),
+        (r'RPC_WEBSHIP_MAP', _rows(1, lambda i: {'U_Service': 'FedEx Ground'})),
+        (r'FROM dbo\.OSHP', _rows(20, lambda i: {'TrnspName': u'Carrier %d' % i})),
+        (r'(?i)from opym', _rows(10, lambda i: {'PayMethCod': u'PM%d' % i})),
+        (r'(?i)from osta', _rows(10, lambda i: {
+            'Code': u'T%d' % i, 'Name': u'Tax %d' % i, 'Rate': money})),
+        (r'(?i)from ORTT', _rows(1, lambda i: {'Rate': money})),
+        (r'FROM dbo\.OADM', _rows(1, lambda i: {'MainCurncy': 'USD'})),
+    ]
+
+
+# pymssql's DB-API type codes.
+STRING, BINARY, NUMBER, DATETIME, DECIMAL = 1, 2, 3, 4, 5
+
+
+def _typeCode(values):
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, decimal.Decimal):
+            return DECIMAL
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return DATETIME
+        if isinstance(value, numbers.Number):
+            return NUMBER
+        if isinstance(value, bytearray):
+            return BINARY
+        return STRING
+    return STRING
+
+
+class Cursor(object):
+    """pymssql cursor stand-in answering from the tables' responders.
+    """
+
+    def __init__(self, tables, as_dict=False):
+        self.tables = tables
+        self.as_dict = as_dict
+        self.rows = []
+        self.description = None
+
+    def execute(self, sql, args=None):
+        _roundTrip('sql')
+        self.rows = []
+        for pattern, respond in self.tables:
+            if pattern.search(sql):
+                self.rows = respond(sql, args)
+                break
+        columns = sorted(self.rows[0]) if self.rows else []
+        self.description = [(c, _typeCode(row[c] for row in self.rows),
+                             None, None, None, None, None) for c in columns]
+        if not self.as_dict:
+            self.rows = [tuple(row[c] for c in columns) for row in self.rows]
+        self.rows = iter(self.rows)
+
+    def __iter__(self):
+        return self.rows
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchmany(self, size=1):
+        batch = []
+        for row in self.rows:
+            batch.append(row)
+            if len(batch) >= size:
+                break
+        return batch
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        pass
+
+
+class Connection(object):
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def cursor(self, as_dict=False):
+        return Cursor(self.tables, as_dict)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Driver(object):
+    """Module-like stand-in for pymssql.
+    """
+
+    def __init__(self, tables=None):
+        self.tables = [(re.compile(p), respond)
+                       for p, respond in (tables or default_tables())]
+
+    def connect(self, *args, **kwargs):
+        return Connection(self.tables)
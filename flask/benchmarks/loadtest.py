@@ -0,0 +1,107 @@
+"""Load test a running server over HTTP.
+
+Each client thread keeps one persistent connection (HTTP/1.1 keep-alive)
+unless keepalive is off, and sends its requests back to back. Run it
+against server.py with different SERVER_THREADS to see the concurrency
+gain, e.g. with 1 and with the default.
+"""
+import json
+import threading
+from time import time
+
+try:
+    from httplib import HTTPConnection, HTTPSConnection
+    from urlparse import urlsplit
+except ImportError:
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlsplit
+
+from .runner import percentile
+
+
+class Client(threading.Thread):
+
+    def __init__(self, url, requests, headers, keepalive, method='GET', body=None):
+        super(Client, self).__init__(name='loadtest')
+        self.daemon = True
+        self.url = urlsplit(url)
+        self.requests = requests
+        self.headers = headers
+        self.keepalive = keepalive
+        self.method = method
+        self.body = body
+        self.timings = []
+        self.statuses = {}
+        self.errors = 0
+        self.connections = 0
+
+    def _connect(self):
+        self.connections += 1
+        cls = HTTPSConnection if self.url.scheme == 'https' else HTTPConnection
+        return cls(self.url.hostname, self.url.port, timeout=60)
+
+    def run(self):
+        path = self.url.path + ('?' + self.url.query if self.url.query else '')
+        conn = None
+        for n in range(self.requests):
+            if conn is None or not self.keepalive:
+                conn = self._connect()
+            start = time()
+            try:
+                conn.request(self.method, path, self.body, self.headers)
+                resp = conn.getresponse()
+                resp.read()
+                self.statuses[resp.status] = self.statuses.get(resp.status, 0) + 1
+                if resp.getheader('connection', '').lower() == 'close':
+                    conn.close()
+                    conn = None
+            except Exception:
+                self.errors += 1
+                conn.close()
+                conn = None
+            self.timings.append(time() - start)
+            if not self.keepalive and conn is not None:
+                conn.close()
+        if conn is not None:
+            conn.close()
+
+
+def run(url, concurrency=8, requests=50, token=None, keepalive=True, method='GET', body=None):
+    """Run concurrency clients sending requests each; returns a report.
+    """
+    headers = {'Connection': 'keep-alive' if keepalive else 'close'}
+    if token:
+        headers['Authorization'] = 'Bearer ' + token
+    if body is not None:
+        headers['Content-Type'] = 'application/json'
+    clients = [Client(url, requests, headers, keepalive, method, body)
+               for _ in range(concurrency)]
+    started = time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time() - started
+    timings = sorted(t for client in clients for t in client.timings)
+    statuses = {}
+    for client in clients:
+        for status, count in client.statuses.items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    return {
+        'url': url,
+        'concurrency': concurrency,
+        'keepalive': keepalive,
+        'requests': len(timings),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(timings) / elapsed, 2) if elapsed else None,
+        'p50_ms': round(1000 * percentile(timings, 0.50), 2),
+        'p99_ms': round(1000 * percentile(timings, 0.99), 2),
+        'max_ms': round(1000 * timings[-1], 2) if timings else None,
+        'statuses': statuses,
+        'errors': sum(client.errors for client in clients),
+        'connections': sum(client.connections for client in clients),
+    }
+
+
+def dumps(report):
+    return json.dumps(report, indent=2, sort_keys=True)
@@ -0,0 +1,166 @@
+"""Run the benchmark cases against the fake backends and report JSON.
+"""
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+from contextlib import contextmanager
+from time import time
+
+from . import fakes
+from .cases import CASES
+
+# The DI module name SapB1ComAdaptor imports; it resolves to the fakes.
+FAKE_DIAPI = 'SAPbobsCOMBenchmark'
+
+
+class BenchConfig(object):
+    LOGGING_LOCATION = os.devnull
+    LOGGING_LEVEL = logging.WARNING
+    LOGGING_FORMAT = '%(message)s'
+    DIAPI = FAKE_DIAPI
+    SERVER = 'benchmark'
+    LICENSE_SERVER = 'benchmark:30000'
+    LANGUAGE = 'ln_English'
+    DBSERVERTYPE = 'dst_MSSQL2014'
+    DBUSERNAME = 'sa'
+    DBPASSWORD = 'benchmark'
+    COMPANYDB = 'BENCHMARK'
+    B1USERNAME = 'manager'
+    B1PASSWORD = 'benchmark'
+    USE_TRUSTED = False
+    JWT_SECRET_KEY = 'benchmark'
+    TRACING = False
+    METRICS = False
+
+
+@contextmanager
+def fake_backends():
+    """Route SapB1ComAdaptor and MsSqlAdaptor to the fakes.
+    """
+    import flask_sapb1
+    sys.modules[FAKE_DIAPI] = fakes
+    driver = flask_sapb1.pymssql
+    flask_sapb1.pymssql = fakes.Driver()
+    try:
+        yield
+    finally:
+        flask_sapb1.pymssql = driver
+        sys.modules.pop(FAKE_DIAPI, None)
+
+
+class Bench(object):
+    """The app, test client and adaptor the cases run against.
+    """
+
+    def __init__(self):
+        from api.app import create_app, sapb1Adaptor
+        from flask_jwt_extended import create_access_token
+        self.app = create_app(BenchConfig)
+        self.adaptor = sapb1Adaptor
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            token = create_access_token(identity='benchmark')
+        self.headers = {'Authorization': 'Bearer ' + token}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+def run_case(bench, run, iterations, warmup):
+    for n in range(warmup):
+        with bench.app.app_context():
+            run(bench, n)
+    fakes.counters.reset()
+    timings = []
+    started = time()
+    for n in range(warmup, warmup + iterations):
+        start = time()
+        with bench.app.app_context():
+            run(bench, n)
+        timings.append(time() - start)
+    elapsed = time() - started
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'seconds': round(elapsed, 6),
+        'throughput': round(iterations / elapsed, 3) if elapsed else None,
+        'mean_ms': round(1000 * sum(timings) / len(timings), 3),
+        'p50_ms': round(1000 * percentile(timings, 0.50), 3),
+        'p99_ms': round(1000 * percentile(timings, 0.99), 3),
+        'max_ms': round(1000 * timings[-1], 3),
+        'di_round_trips': round(float(fakes.counters.di) / iterations, 2),
+        'sql_round_trips': round(float(fakes.counters.sql) / iterations, 2),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=open(os.devnull, 'w')).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names=None, iterations=200, warmup=10, di_latency=0.0, sql_latency=0.0):
+    """Run the cases whose name starts with one of names (all by default).
+
+    Latencies are in milliseconds per DI round trip and per SQL statement.
+    """
+    fakes.latency['di'] = di_latency / 1000.0
+    fakes.latency['sql'] = sql_latency / 1000.0
+    results = {}
+    with fake_backends():
+        bench = Bench()
+        for name, case in CASES:
+            if names and not any(name.startswith(n) for n in names):
+                continue
+            results[name] = run_case(bench, case, iterations, warmup)
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'iterations': iterations,
+            'warmup': warmup,
+            'di_latency_ms': di_latency,
+            'sql_latency_ms': sql_latency,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current):
+    """Text table of p50, p99 and throughput changes against a baseline.
+    """
+    lines = ['{0:<30} {1:>12} {2:>12} {3:>12}'.format(
+        'case', 'p50 %', 'p99 %', 'ops/s %')]
+
+    def change(old, new):
+        if not old or new is None:
+            return '-'
+        return '{0:+.1f}'.format(100.0 * (new - old) / old)
+
+    for name, result in sorted(current['results'].items()):
+        old = baseline.get('results', {}).get(name)
+        if old is None:
+            lines.append('{0:<30} {1:>12}'.format(name, 'new'))
+            continue
+        lines.append('{0:<30} {1:>12} {2:>12} {3:>12}'.format(
+            name, change(old['p50_ms'], result['p50_ms']),
+            change(old['p99_ms'], result['p99_ms']),
+            change(old['throughput'], result['throughput'])))
+    return '\n'.join(lines)
+
+
+def dumps(report):
+    return json.dumps(report, indent=2, sort_keys=True)
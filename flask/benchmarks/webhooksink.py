@@ -0,0 +1,74 @@
+"""A local HTTP stand-in for a webhook receiver.
+
+It prints one line per received event, checks the X-Webhook-Signature
+when given the secret, and can answer 500 to the first batches to
+exercise the change feed's retries.
+"""
+import json
+import sys
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from changefeed import verify
+
+
+class Sink(HTTPServer):
+
+    def __init__(self, port, secret=None, fail=0, output=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.secret = secret
+        self.fail = fail
+        self.output = output
+        self.lock = threading.Lock()
+        self.batches = []
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        sink = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if sink.secret and not verify(sink.secret, self.headers.get('X-Webhook-Signature'), body):
+            return self._answer(401, 'bad signature')
+        with sink.lock:
+            if sink.fail > 0:
+                sink.fail -= 1
+                return self._answer(500, 'failing on purpose')
+            batch = json.loads(body.decode('utf-8'))
+            sink.batches.append(batch)
+            for event in batch['events']:
+                line = json.dumps(event, sort_keys=True)
+                if sink.output is not None:
+                    sink.output.write(line + '\n')
+                    sink.output.flush()
+                sys.stdout.write('{0} {1}\n'.format(event['type'], event['id']))
+            sys.stdout.flush()
+        self._answer(204)
+
+    def _answer(self, status, message=None):
+        if message:
+            sys.stdout.write('{0} {1}\n'.format(status, message))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=9000, secret=None, fail=0, output=None):
+    out = open(output, 'a') if output else None
+    sink = Sink(port, secret, fail, out)
+    print('Webhook sink on http://127.0.0.1:{0}/'.format(port))
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.server_close()
+        if out is not None:
+            out.close()
@@ -0,0 +1,415 @@
+"""Webhook push of changed orders, shipments and invoices.
+
+A background thread scans ORDR, ODLN and OINV for headers changed after a
+per-table (UpdateDate, UpdateTS, DocEntry) high-water mark. The events and
+the new mark are written to a local SQLite outbox in one transaction, so a
+restart neither loses nor skips changes. The same thread then POSTs the
+pending events of each registered webhook in batches, oldest first. A
+failed batch is retried with exponential backoff, and after
+WEBHOOK_MAX_ATTEMPTS attempts its events are set aside as dead so the
+webhook moves on. Delivery is at least once: receivers dedupe on the
+event id.
+"""
+import hashlib
+import hmac
+import json
+import sqlite3
+import threading
+from time import time
+from flask_sapb1 import decode_sync_token
+
+try:
+    from httplib import HTTPConnection, HTTPSConnection
+    from urlparse import urlsplit
+except ImportError:
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlsplit
+
+RESOURCES = ('orders', 'shipments', 'invoices')
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS marks (
+           resource TEXT PRIMARY KEY,
+           date TEXT NOT NULL,
+           ts INTEGER NOT NULL,
+           entry INTEGER NOT NULL,
+           maxEntry INTEGER NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS webhooks (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           url TEXT NOT NULL,
+           secret TEXT,
+           resources TEXT NOT NULL,
+           created REAL NOT NULL,
+           delivered INTEGER NOT NULL DEFAULT 0,
+           failures INTEGER NOT NULL DEFAULT 0,
+           retryAt REAL NOT NULL DEFAULT 0,
+           lastError TEXT)""",
+    """CREATE TABLE IF NOT EXISTS events (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           webhook INTEGER NOT NULL,
+           payload TEXT NOT NULL,
+           attempts INTEGER NOT NULL DEFAULT 0,
+           dead INTEGER NOT NULL DEFAULT 0,
+           created REAL NOT NULL)""",
+    """CREATE INDEX IF NOT EXISTS events_webhook ON events (webhook, dead, id)""",
+)
+
+
+def sign(secret, timestamp, body):
+    """X-Webhook-Signature value: HMAC-SHA256 of '<timestamp>.<body>'.
+    """
+    message = str(timestamp).encode('ascii') + b'.' + body
+    digest = hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+    return 't={0},sha256={1}'.format(timestamp, digest)
+
+
+def verify(secret, header, body, tolerance=300):
+    """Check an X-Webhook-Signature header on the receiving side.
+    """
+    try:
+        fields = dict(part.split('=', 1) for part in header.split(','))
+        timestamp = int(fields['t'])
+    except (AttributeError, KeyError, ValueError):
+        return False
+    if tolerance and abs(time() - timestamp) > tolerance:
+        return False
+    expected = sign(secret, timestamp, body)
+    return hmac.compare_digest(expected.encode('ascii'), header.encode('ascii'))
+
+
+def event(resource, row, maxEntry):
+    """The event of a changed document header: created if its DocEntry is
+    above the highest one seen before, else updated.
+    """
+    entry = int(row['DocEntry'])
+    date = str(row['UpdateDate'])[:10]
+    ts = int(row['UpdateTS'] or 0)
+    return {
+        'id': '{0}:{1}:{2}.{3:06d}'.format(resource, entry, date, ts),
+        'type': '{0}.{1}'.format(resource, 'created' if entry > maxEntry else 'updated'),
+        'resource': resource,
+        'docEntry': entry,
+        'occurredAt': '{0}T{1:02d}:{2:02d}:{3:02d}'.format(date, ts // 10000, ts // 100 % 100, ts % 100),
+        'data': row,
+    }
+
+
+class Outbox(object):
+    """The marks, webhooks and undelivered events in a SQLite file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            if path != ':memory:':
+                self.conn.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def mark(self, resource):
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM marks WHERE resource = ?',
+                                    (resource,)).fetchone()
+        return dict(row) if row else None
+
+    def _setMark(self, resource, mark):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO marks (resource, date, ts, entry, maxEntry) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (resource, mark['date'], mark['ts'], mark['entry'], mark['maxEntry']))
+
+    def setMark(self, resource, mark):
+        with self.lock, self.conn:
+            self._setMark(resource, mark)
+
+    def enqueue(self, resource, payloads, mark):
+        """Queue the event payloads for every webhook subscribed to the
+        resource and move its mark, atomically.
+        """
+        now = time()
+        with self.lock, self.conn:
+            for webhook in self.conn.execute('SELECT id, resources FROM webhooks').fetchall():
+                if resource not in json.loads(webhook['resources']):
+                    continue
+                self.conn.executemany(
+                    'INSERT INTO events (webhook, payload, created) VALUES (?, ?, ?)',
+                    [(webhook['id'], payload, now) for payload in payloads])
+            self._setMark(resource, mark)
+
+    def _webhook(self, row):
+        webhook = dict(row)
+        webhook['resources'] = json.loads(webhook['resources'])
+        webhook['signed'] = bool(webhook.pop('secret'))
+        return webhook
+
+    def addWebhook(self, url, resources, secret=None):
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                'INSERT INTO webhooks (url, secret, resources, created) VALUES (?, ?, ?, ?)',
+                (url, secret, json.dumps(list(resources)), time()))
+            id = cursor.lastrowid
+        return self.webhook(id)
+
+    def removeWebhook(self, id):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM events WHERE webhook = ?', (id,))
+            return self.conn.execute('DELETE FROM webhooks WHERE id = ?', (id,)).rowcount > 0
+
+    def webhook(self, id):
+        """A webhook with its pending and dead event counts, secret left out.
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM webhooks WHERE id = ?', (id,)).fetchone()
+            if row is None:
+                return None
+            counts = dict(self.conn.execute(
+                'SELECT dead, COUNT(*) FROM events WHERE webhook = ? GROUP BY dead', (id,)).fetchall())
+        webhook = self._webhook(row)
+        webhook['pending'] = counts.get(0, 0)
+        webhook['dead'] = counts.get(1, 0)
+        return webhook
+
+    def webhooks(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT * FROM webhooks ORDER BY id').fetchall()
+        return [self._webhook(row) for row in rows]
+
+    def secret(self, id):
+        with self.lock:
+            row = self.conn.execute('SELECT secret FROM webhooks WHERE id = ?', (id,)).fetchone()
+        return row['secret'] if row else None
+
+    def pending(self, webhook, limit):
+        """[(event id, payload)] of the oldest undelivered events.
+        """
+        with self.lock:
+            return [(row['id'], row['payload']) for row in self.conn.execute(
+                'SELECT id, payload FROM events WHERE webhook = ? AND dead = 0 '
+                'ORDER BY id LIMIT ?', (webhook, limit)).fetchall()]
+
+    def delivered(self, webhook, ids):
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM events WHERE id = ?', [(id,) for id in ids])
+            self.conn.execute(
+                'UPDATE webhooks SET delivered = delivered + ?, failures = 0, retryAt = 0, '
+                'lastError = NULL WHERE id = ?', (len(ids), webhook))
+
+    def failed(self, webhook, ids, error, retryAt, maxAttempts):
+        """Count a failed attempt of the events; those out of attempts are
+        set aside as dead and the webhook may go on at once. Returns the
+        number of dead events.
+        """
+        with self.lock, self.conn:
+            self.conn.executemany('UPDATE events SET attempts = attempts + 1 WHERE id = ?',
+                                  [(id,) for id in ids])
+            dead = self.conn.execute(
+                'UPDATE events SET dead = 1 WHERE webhook = ? AND dead = 0 AND attempts >= ?',
+                (webhook, maxAttempts)).rowcount
+            if dead:
+                self.conn.execute('UPDATE webhooks SET failures = 0, retryAt = 0, lastError = ? '
+                                  'WHERE id = ?', (error, webhook))
+            else:
+                self.conn.execute('UPDATE webhooks SET failures = failures + 1, retryAt = ?, '
+                                  'lastError = ? WHERE id = ?', (retryAt, error, webhook))
+        return dead
+
+    def redeliver(self, webhook):
+        """Queue the dead events of a webhook again; returns their number.
+        """
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE webhooks SET failures = 0, retryAt = 0 WHERE id = ?', (webhook,))
+            return self.conn.execute('UPDATE events SET dead = 0, attempts = 0 '
+                                     'WHERE webhook = ? AND dead = 1', (webhook,)).rowcount
+
+    def counts(self):
+        """Undelivered events by state.
+        """
+        with self.lock:
+            counts = dict(self.conn.execute(
+                'SELECT dead, COUNT(*) FROM events GROUP BY dead').fetchall())
+        return {'pending': counts.get(0, 0), 'dead': counts.get(1, 0)}
+
+
+def post(url, body, headers, timeout):
+    """POST body; returns None on a 2xx answer, else the error.
+    """
+    parts = urlsplit(url)
+    cls = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    conn = cls(parts.netloc, timeout=timeout)
+    try:
+        conn.request('POST', path, body, headers)
+        response = conn.getresponse()
+        response.read()
+        if 200 <= response.status < 300:
+            return None
+        return 'HTTP {0} {1}'.format(response.status, response.reason)
+    except Exception as e:
+        return '{0}: {1}'.format(type(e).__name__, e)
+    finally:
+        conn.close()
+
+
+class ChangeFeed(object):
+    """Scan for document changes and deliver them every interval seconds.
+    """
+
+    def __init__(self, adaptor, app, outbox, resources=RESOURCES, interval=10,
+                 scanLimit=500, batchSize=100, profile=None, secret=None,
+                 maxAttempts=10, retryBase=5, retryMax=900, timeout=10):
+        self.adaptor = adaptor
+        self.app = app
+        self.outbox = outbox
+        self.resources = resources
+        self.interval = interval
+        self.scanLimit = scanLimit
+        self.batchSize = batchSize
+        self.profile = profile
+        self.secret = secret
+        self.maxAttempts = maxAttempts
+        self.retryBase = retryBase
+        self.retryMax = retryMax
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.events = {}
+        self.deliveries = {'delivered': 0, 'failed': 0, 'dead': 0}
+        self.scannedAt = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='ChangeFeed')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.runOnce()
+            except Exception as e:
+                self.app.logger.exception(e)
+            self.stopped.wait(self.interval)
+
+    def runOnce(self):
+        """Scan every resource, then deliver what is due. Returns the
+        number of events queued and of events delivered.
+        """
+        with self.lock:
+            queued = 0
+            for resource in self.resources:
+                queued += self.scan(resource)
+            self.scannedAt = time()
+            return queued, self.dispatch()
+
+    def scan(self, resource):
+        """Queue the changes of one resource past its mark; the first scan
+        only sets the mark to now.
+        """
+        with self.app.app_context():
+            mark = self.outbox.mark(resource)
+            if mark is None:
+                token, maxEntry = self.adaptor.getDocumentMark(resource)
+                date, ts = decode_sync_token(token)
+                self.outbox.setMark(resource, {'date': date, 'ts': ts, 'entry': 0,
+                                               'maxEntry': maxEntry})
+                return 0
+            queued = 0
+            while True:
+                rows = self.adaptor.getDocumentChanges(
+                    resource, mark['date'], mark['ts'], mark['entry'],
+                    limit=self.scanLimit, profile=self.profile)
+                if not rows:
+                    return queued
+                payloads = []
+                for row in rows:
+                    e = event(resource, row, mark['maxEntry'])
+                    payloads.append(json.dumps(e, sort_keys=True, default=str))
+                    key = (resource, e['type'].split('.')[1])
+                    self.events[key] = self.events.get(key, 0) + 1
+                last = rows[-1]
+                mark = {'date': str(last['UpdateDate'])[:10],
+                        'ts': int(last['UpdateTS'] or 0),
+                        'entry': int(last['DocEntry']),
+                        'maxEntry': max([mark['maxEntry']] + [int(r['DocEntry']) for r in rows])}
+                self.outbox.enqueue(resource, payloads, mark)
+                queued += len(rows)
+                if len(rows) < self.scanLimit:
+                    return queued
+
+    def dispatch(self):
+        """POST the due batches of every webhook; returns the number of
+        events delivered.
+        """
+        delivered = 0
+        for id in [webhook['id'] for webhook in self.outbox.webhooks()]:
+            while not self.stopped.is_set():
+                webhook = self.outbox.webhook(id)
+                if webhook is None or webhook['retryAt'] > time():
+                    break
+                events = self.outbox.pending(id, self.batchSize)
+                if not events:
+                    break
+                if self.deliver(webhook, events):
+                    delivered += len(events)
+        return delivered
+
+    def deliver(self, webhook, events):
+        ids = [id for id, payload in events]
+        body = ('{"webhook": ' + str(webhook['id']) + ', "events": [' +
+                ', '.join(payload for id, payload in events) + ']}').encode('utf-8')
+        headers = {'Content-Type': 'application/json',
+                   'User-Agent': 'sapb1-changefeed',
+                   'X-Webhook-Id': str(webhook['id'])}
+        secret = self.outbox.secret(webhook['id']) or self.secret
+        if secret:
+            headers['X-Webhook-Signature'] = sign(secret, int(time()), body)
+        error = post(webhook['url'], body, headers, self.timeout)
+        if error is None:
+            self.outbox.delivered(webhook['id'], ids)
+            self.deliveries['delivered'] += len(ids)
+            return True
+        delay = min(self.retryMax, self.retryBase * 2 ** webhook['failures'])
+        dead = self.outbox.failed(webhook['id'], ids, error, time() + delay, self.maxAttempts)
+        self.deliveries['failed'] += len(ids)
+        self.deliveries['dead'] += dead
+        self.app.logger.warning("Webhook %s delivery of %s events failed: %s",
+                                webhook['id'], len(ids), error)
+        return False
+
+
+def init_changefeed(app, adaptor):
+    """Create the outbox and the feed when CHANGEFEED is on; server.py
+    starts it, so manage.py commands never scan.
+    """
+    if not app.config.get('CHANGEFEED', False):
+        return None
+    feed = ChangeFeed(
+        adaptor, app, Outbox(app.config.get('CHANGEFEED_DB', 'changefeed.db')),
+        resources=app.config.get('CHANGEFEED_RESOURCES', RESOURCES),
+        interval=app.config.get('CHANGEFEED_INTERVAL', 10),
+        scanLimit=app.config.get('CHANGEFEED_SCAN_LIMIT', 500),
+        batchSize=app.config.get('WEBHOOK_BATCH_SIZE', 100),
+        profile=app.config.get('CHANGEFEED_PROFILE', None),
+        secret=app.config.get('WEBHOOK_SECRET', None),
+        maxAttempts=app.config.get('WEBHOOK_MAX_ATTEMPTS', 10),
+        retryBase=app.config.get('WEBHOOK_RETRY_BASE', 5),
+        retryMax=app.config.get('WEBHOOK_RETRY_MAX', 900),
+        timeout=app.config.get('WEBHOOK_TIMEOUT', 10))
+    app.extensions['changefeed'] = feed
+    return feed
+
@@ -1,11 +1,19 @@
 from flask import current_app, g
 import pymssql
+import base64
 import datetime
-from time import time, strftime
+import json
+import os
+from time import time, strftime, sleep
 import decimal
+import re
+import threading
+from collections import OrderedDict
+from array import array
 from pythoncom import CoInitialize
 import win32com.client.dynamic
 from flask_mail import Message
+from instrumentation import ComProxy, current_method, instrumented, registry, timed
 
 
 try:
@@ -14,6 +22,186 @@ except ImportError:
     from flask import _request_ctx_stack as stack
 
 
+# Database time as the (UpdateDate, UpdateTS) pair used by OITM.
+SYNC_MARK_SQL = """DECLARE @now datetime
+                   SET @now = GETDATE()
+                   SELECT CONVERT(char(10), @now, 120) AS UpdateDate,
+                          DATEPART(hour, @now) * 10000
+                          + DATEPART(minute, @now) * 100
+                          + DATEPART(second, @now) AS UpdateTS"""
+
+# Items changed in the item master since a sync mark.
+ITEMS_CHANGED = """(UpdateDate > %(since_date)s
+                    OR (UpdateDate = %(since_date)s
+                        AND ISNULL(UpdateTS, 0) >= %(since_ts)s))"""
+
+# Items whose warehouse quantities may have changed since a sync mark:
+# item master updates, inventory postings and sales order commitments.
+# The last two are only tracked by day.
+STOCK_CHANGED = """(ItemCode IN (SELECT ItemCode FROM dbo.OITM
+                                 WHERE """ + ITEMS_CHANGED + """)
+                    OR ItemCode IN (SELECT ItemCode FROM dbo.OINM
+                                    WHERE CreateDate >= %(since_date)s)
+                    OR ItemCode IN (SELECT T1.ItemCode FROM dbo.RDR1 T1
+                                    INNER JOIN dbo.ORDR T0
+                                    ON T0.DocEntry = T1.DocEntry
+                                    WHERE T0.UpdateDate >= %(since_date)s))"""
+
+# Cheap fingerprints of the data behind the read endpoints, used as HTTP
+# cache validators: the row count and an aggregate checksum of the columns
+# served, plus the last change time of the item master.
+DATA_VERSION_SQL = {
+    'items': """SELECT COUNT(*) AS Rows,
+                       CHECKSUM_AGG(CHECKSUM(ItemCode, ItemName, ItmsGrpCod,
+                                             UpdateDate, UpdateTS)) AS Version,
+                       MAX(DATEADD(second,
+                                   (ISNULL(UpdateTS, 0) / 10000) * 3600
+                                   + (ISNULL(UpdateTS, 0) / 100 % 100) * 60
+                                   + ISNULL(UpdateTS, 0) % 100,
+                                   UpdateDate)) AS Modified
+                FROM dbo.OITM""",
+    'prices': """SELECT COUNT(*) AS Rows,
+                        CHECKSUM_AGG(BINARY_CHECKSUM(ItemCode, PriceList, Price,
+                                                     Currency, Ovrwritten, Factor)) AS Version
+                 FROM dbo.ITM1""",
+    'ExpnsName': """SELECT COUNT(*) AS Rows,
+                           CHECKSUM_AGG(BINARY_CHECKSUM(ExpnsName)) AS Version
+                    FROM dbo.OEXD""",
+    'TrnspName': """SELECT COUNT(*) AS Rows,
+                           CHECKSUM_AGG(BINARY_CHECKSUM(TrnspName)) AS Version
+                    FROM dbo.OSHP""",
+    'PayMethCod': """SELECT COUNT(*) AS Rows,
+                            CHECKSUM_AGG(BINARY_CHECKSUM(PayMethCod)) AS Version
+                     FROM dbo.OPYM""",
+    'TaxCode': """SELECT COUNT(*) AS Rows,
+                         CHECKSUM_AGG(BINARY_CHECKSUM(Code, Name, Rate)) AS Version
+                  FROM dbo.OSTA""",
+    'USDRate': """SELECT COUNT(*) AS Rows,
+                         CHECKSUM_AGG(BINARY_CHECKSUM(Rate)) AS Version
+                  FROM dbo.ORTT WHERE RateDate = %s""",
+}
+
+# Columns each data version changes with: reads selecting other columns
+# cannot be validated by it.
+DATA_VERSION_COLUMNS = {
+    'items': ('ItemCode', 'ItemName', 'ItmsGrpCod', 'CreateDate', 'UpdateDate', 'UpdateTS'),
+    'prices': ('ItemCode', 'PriceList', 'Price', 'Currency', 'Ovrwritten', 'Factor'),
+}
+
+# Tables behind the document fetches and their built-in column profiles.
+# 'full' is every column; 'summary' is what integrations usually read.
+FETCH_TABLES = {
+    'orders': 'ORDR',
+    'shipments': 'ODLN',
+    'shipmentItems': 'DLN1',
+    'orderShipInfo': 'RDR3',
+    'invoices': 'OINV',
+}
+
+COLUMN_PROFILES = {
+    'orders': {
+        'summary': ['DocEntry', 'DocNum', 'DocDate', 'DocDueDate', 'DocStatus', 'CANCELED',
+                    'CardCode', 'CardName', 'NumAtCard', 'DocTotal', 'VatSum', 'DocCur',
+                    'TrnspCode', 'U_WebOrderId'],
+        'full': ['*'],
+    },
+    'shipments': {
+        'summary': ['DocEntry', 'DocNum', 'DocDate', 'DocDueDate', 'DocStatus', 'CANCELED',
+                    'CardCode', 'CardName', 'NumAtCard', 'DocTotal', 'DocCur',
+                    'TrnspCode', 'TrackNo', 'U_WebOrderId'],
+        'full': ['*'],
+    },
+    'shipmentItems': {
+        'summary': ['DocEntry', 'LineNum', 'ItemCode', 'Dscription', 'Quantity', 'Price',
+                    'LineTotal', 'WhsCode', 'BaseEntry', 'BaseLine'],
+        'full': ['*'],
+    },
+    'orderShipInfo': {
+        'summary': ['DocEntry', 'LineNum', 'ExpnsCode', 'LineTotal', 'TaxCode', 'ObjType'],
+        'full': ['*'],
+    },
+    'invoices': {
+        'summary': ['DocEntry', 'DocNum', 'DocDate', 'DocDueDate', 'DocStatus', 'CANCELED',
+                    'CardCode', 'CardName', 'NumAtCard', 'DocTotal', 'VatSum', 'PaidToDate',
+                    'DocCur', 'U_WebOrderId'],
+        'full': ['*'],
+    },
+}
+
+# Document headers changed after a (UpdateDate, UpdateTS, DocEntry) mark
+# and before the current database second, oldest first. Rows of the
+# current second are left for the next scan, when no more can commit
+# with that timestamp.
+DOCUMENTS_CHANGED = """SELECT TOP {limit} {columns} FROM dbo.{table}
+                        WHERE (UpdateDate > %(date)s
+                               OR (UpdateDate = %(date)s
+                                   AND (ISNULL(UpdateTS, 0) > %(ts)s
+                                        OR (ISNULL(UpdateTS, 0) = %(ts)s
+                                            AND DocEntry > %(entry)s))))
+                          AND (UpdateDate < %(until_date)s
+                               OR (UpdateDate = %(until_date)s
+                                   AND ISNULL(UpdateTS, 0) < %(until_ts)s))
+                        ORDER BY UpdateDate, ISNULL(UpdateTS, 0), DocEntry"""
+
+# Columns a change scan needs whatever the profile.
+MARK_COLUMNS = ('DocEntry', 'UpdateDate', 'UpdateTS')
+
+# Operators accepted in the params of a fetch.
+PARAM_OPS = ('=', '<>', '!=', '<', '<=', '>', '>=', 'LIKE', 'NOT LIKE')
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def encode_sync_token(date, ts):
+    """Build the opaque change token for a (UpdateDate, UpdateTS) mark.
+    """
+    mark = '{0}.{1:06d}'.format(date, int(ts))
+    return base64.urlsafe_b64encode(mark.encode('ascii')).decode('ascii')
+
+
+def decode_sync_token(token):
+    """Return the (UpdateDate, UpdateTS) mark of a change token.
+    """
+    try:
+        mark = base64.urlsafe_b64decode(str(token)).decode('ascii')
+        date, ts = mark.split('.')
+        datetime.datetime.strptime(date, '%Y-%m-%d')
+        return date, int(ts)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid since token {0}".format(token))
+
+
+def as_text(value):
+    """unicode of a request or driver value, '' for None; byte strings are
+    read as UTF-8 so they compare equal to the same text from the driver.
+    """
+    if value is None:
+        return u''
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+def code_key(code):
+    """A code as SQL Server compares it under the company collation:
+    case-insensitive and without trailing blanks.
+    """
+    return as_text(code).strip().upper()
+
+
+if os.name == 'nt':
+    import win32api
+    import win32con
+
+    def replace_file(src, dst):
+        """Rename src over dst in one step, as os.replace does on Python 3.
+        """
+        win32api.MoveFileEx(src, dst, win32con.MOVEFILE_REPLACE_EXISTING |
+                            win32con.MOVEFILE_WRITE_THROUGH)
+else:
+    replace_file = os.rename
+
+
 class SapB1ComAdaptor(object):
     """Adaptor contains SAP B1 COM object.
     """
@@ -30,10 +218,11 @@ class SapB1ComAdaptor(object):
         company.Password = config['B1PASSWORD']
         company.Language = getattr(self.constants, config['LANGUAGE'])
         company.UseTrusted = config['USE_TRUSTED']
-        result = company.Connect()
+        result = timed('Connect', company.Connect)
         if result != 0:
             raise Exception("Not connected to COM %s" % result)
-        print('Connected to COM')
+        self.company = ComProxy(company)
+        current_app.logger.debug("Connected to COM")
         
 
     def __del__(self):
@@ -73,7 +262,7 @@ class MsSqlAdaptor(object):
 
         if len(kwargs):
             args = kwargs
-        self.cursor.execute(sql, args)
+        timed('execute', self.cursor.execute, sql, args)
 
     def fetch_all(self, sql, args=None, **kwargs):
         self.execute(sql, args, **kwargs)
@@ -92,10 +281,699 @@ class MsSqlAdaptor(object):
                 item[k] = value
             yield item
 
+    def fetch_raw(self, sql, args=None, **kwargs):
+        """Like fetch_all, but the values are left as returned by the
+        driver; unicode text keeps its non-ASCII characters.
+        """
+        self.execute(sql, args, **kwargs)
+        for row in self.cursor:
+            yield row
+
     def fetchone(self, sql, args=None, **kwargs):
         self.execute(sql, args, **kwargs)
         return self.cursor.fetchone()
 
+    def fetch_batches(self, sql, args=None, size=1000, **kwargs):
+        """Yield the (name, type code) of each column first, then lists of
+        row tuples.
+
+        Values are left as returned by the driver (None, Decimal and
+        datetime included) so the caller can choose their representation.
+        """
+        if isinstance(args, list):
+            args = tuple(args)
+        if len(kwargs):
+            args = kwargs
+        cursor = self.conn.cursor()
+        try:
+            timed('execute', cursor.execute, sql, args)
+            yield [column[:2] for column in cursor.description or []]
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+
+class StockSnapshot(object):
+    """In-memory OnHand/IsCommited per (ItemCode, WhsCode).
+
+    Quantities are kept in two array('d') columns addressed by slot; the
+    slots are found through an (ItemCode, WhsCode) index, keyed the way the
+    database compares codes (case-insensitive, trailing blanks ignored). A
+    background thread pulls the OITW rows changed since the last change
+    token, and every reloadInterval seconds reads them all again so rows deleted
+    from OITW are dropped.
+    """
+
+    def __init__(self, adaptor, app, interval=30, maxAge=120, reloadInterval=3600):
+        self.adaptor = adaptor
+        self.app = app
+        self.interval = interval
+        self.maxAge = maxAge
+        self.reloadInterval = reloadInterval
+        self.lock = threading.Lock()
+        self.refreshLock = threading.Lock()
+        self.keys = []
+        self.index = {}
+        self.byItem = {}
+        self.onHand = array('d')
+        self.isCommited = array('d')
+        self.token = None
+        self.refreshedAt = 0
+        self.loadedAt = 0
+        self.thread = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    normalize = staticmethod(code_key)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='StockSnapshot')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                self.app.logger.exception(e)
+            sleep(self.interval)
+
+    def refresh(self, after=None):
+        """Apply the OITW rows changed since the last refresh. The first
+        refresh, and the first one reloadInterval seconds after a full read, reads
+        all rows and replaces the snapshot. Skipped if another refresh
+        finished after the given time.
+        """
+        with self.refreshLock:
+            if after is not None and self.refreshedAt >= after:
+                return 0
+            full = self.token is None or time() - self.loadedAt >= self.reloadInterval
+            with self.app.app_context():
+                token = self.adaptor.getSyncToken()
+                rows = self.adaptor.getStockNum(
+                    columns='ItemCode, WhsCode, OnHand, IsCommited',
+                    since='' if full else self.token)
+            if full:
+                # Built aside so lookups keep the old snapshot meanwhile.
+                state = ([], {}, {}, array('d'), array('d'))
+                self._apply(rows, *state)
+                with self.lock:
+                    self.keys, self.index, self.byItem, self.onHand, self.isCommited = state
+                    self.token = token
+                    self.refreshedAt = self.loadedAt = time()
+            else:
+                with self.lock:
+                    self._apply(rows, self.keys, self.index, self.byItem,
+                                self.onHand, self.isCommited)
+                    self.token = token
+                    self.refreshedAt = time()
+            return len(rows)
+
+    def _apply(self, rows, keys, index, byItem, onHand, isCommited):
+        for row in rows:
+            item = self.normalize(row['ItemCode'])
+            key = (item, self.normalize(row['WhsCode']))
+            slot = index.get(key)
+            if slot is None:
+                slot = len(keys)
+                keys.append((row['ItemCode'], row['WhsCode']))
+                onHand.append(float(row['OnHand'] or 0))
+                isCommited.append(float(row['IsCommited'] or 0))
+                index[key] = slot
+                byItem.setdefault(item, []).append(slot)
+            else:
+                onHand[slot] = float(row['OnHand'] or 0)
+                isCommited[slot] = float(row['IsCommited'] or 0)
+
+    def lookup(self, limit=1, whs=None, code=None, refresh=False):
+        """Return stock rows shaped like getStockNum from memory.
+
+        The snapshot is refreshed first if asked to, or if it is older
+        than maxAge seconds.
+        """
+        self.start()
+        now = time()
+        if refresh or now - self.refreshedAt > self.maxAge:
+            self.refresh(after=now)
+        if whs:
+            whs = self.normalize(whs)
+        with self.lock:
+            if code:
+                slots = self.byItem.get(self.normalize(code), [])
+            else:
+                slots = range(len(self.keys))
+            result = []
+            for slot in slots:
+                itemCode, whsCode = self.keys[slot]
+                if whs and self.normalize(whsCode) != whs:
+                    continue
+                result.append({
+                    'ItemCode': itemCode,
+                    'WhsCode': whsCode,
+                    'OnHand': '%.6f' % self.onHand[slot],
+                    'IsCommited': '%.6f' % self.isCommited[slot]
+                })
+                if not code and len(result) >= limit:
+                    break
+            return result
+
+
+class CardCodeAllocator(object):
+    """Hands out customer CardCodes from blocks reserved in a local file.
+
+    The current block is persisted as {"start": n, "end": m} when it is
+    reserved. On first use the file is read back and checked against the
+    highest numeric CardCode in OCRD, so codes used before a restart are
+    never handed out again.
+    """
+
+    def __init__(self, path, blockSize=100, prefix='C', width=5):
+        self.path = path
+        self.blockSize = blockSize
+        self.prefix = prefix
+        self.width = width
+        self.lock = threading.Lock()
+        self.next = None
+        self.end = None
+
+    def _lastCode(self, adaptor):
+        # The CASE keeps the CAST away from non-numeric codes whatever
+        # order the optimizer evaluates the WHERE clause in.
+        sql = """SELECT MAX(CASE WHEN SUBSTRING(CardCode, {0}, 50) <> ''
+                                  AND SUBSTRING(CardCode, {0}, 50) NOT LIKE '%%[^0-9]%%'
+                                  AND LEN(SUBSTRING(CardCode, {0}, 50)) <= 18
+                             THEN CAST(SUBSTRING(CardCode, {0}, 50) AS bigint)
+                             END) AS LastCode
+                 FROM dbo.OCRD
+                 WHERE CardType = 'C'
+                 AND LEFT(CardCode, {1}) = %(prefix)s""".format(
+            len(self.prefix) + 1, len(self.prefix))
+        row = adaptor.sql_adaptor.fetchone(sql, {'prefix': self.prefix})
+        return int(row['LastCode'] or 0)
+
+    def _reserve(self, start):
+        self.next = start
+        self.end = start + self.blockSize
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'start': self.next, 'end': self.end}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(tmp, self.path)
+
+    def _start(self, adaptor):
+        start = end = 0
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                block = json.load(f)
+            start, end = block['start'], block['end']
+        following = self._lastCode(adaptor) + 1
+        if start <= following < end:
+            self.next, self.end = following, end
+        else:
+            self._reserve(max(end, following))
+
+    def allocate(self, adaptor):
+        """Return the next free CardCode.
+        """
+        with self.lock:
+            if self.next is None:
+                self._start(adaptor)
+            elif self.next >= self.end:
+                self._reserve(self.end)
+            code = self.next
+            self.next += 1
+        return '%s%0*d' % (self.prefix, self.width, code)
+
+
+class ContactIndex(object):
+    """CntctCode of the contacts of recently used business partners.
+
+    The contacts of a CardCode are loaded from OCPR on first lookup and
+    kept by (E_MailL, FirstName, LastName), the fields an order is matched
+    on, for ttl seconds so contacts edited in SAP B1 are picked up. At
+    most maxCards business partners are kept.
+    """
+
+    FIELDS = ('E_MailL', 'FirstName', 'LastName')
+
+    def __init__(self, maxCards=10000, ttl=600):
+        self.maxCards = maxCards
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, contact):
+        return tuple(as_text(contact.get(k)).strip().lower() for k in self.FIELDS)
+
+    def _load(self, adaptor, cardCode):
+        sql = """SELECT CntctCode, E_MailL, FirstName, LastName FROM dbo.OCPR
+                 WHERE CardCode = %s ORDER BY CntctCode DESC"""
+        # Walk from the newest contact so the oldest duplicate wins, as the
+        # first match of getContacts would. Raw rows keep non-ASCII names,
+        # which fetch_all would strip.
+        contacts = {}
+        for row in adaptor.sql_adaptor.fetch_raw(sql, cardCode):
+            contacts[self.key(row)] = row['CntctCode']
+        return contacts
+
+    def lookup(self, adaptor, cardCode, contact):
+        """Return (CntctCode or None, loaded) of a contact under cardCode;
+        loaded is True when the contacts were just read from OCPR, so a
+        miss needs no confirmation.
+        """
+        now = time()
+        with self.lock:
+            entry = self.cards.pop(cardCode, None)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self.cards[cardCode] = entry
+            else:
+                entry = None
+        if entry is None:
+            self.misses += 1
+            entry = (self._load(adaptor, cardCode), now)
+            with self.lock:
+                self.cards[cardCode] = entry
+                while len(self.cards) > self.maxCards:
+                    self.cards.popitem(last=False)
+            loaded = True
+        else:
+            self.hits += 1
+            loaded = False
+        return entry[0].get(self.key(contact)), loaded
+
+    def add(self, cardCode, contact, contactCode):
+        """Record a new contact if its business partner is loaded.
+        """
+        with self.lock:
+            entry = self.cards.get(cardCode)
+            if entry is not None:
+                entry[0].setdefault(self.key(contact), contactCode)
+
+
+class BusinessPartnerCache(object):
+    """Fields of OCRD/CRD1 that the customer endpoints write, by CardCode.
+
+    Used to skip COM updates of business partners that would not change.
+    """
+
+    FIELDS = ('Phone', 'Email')
+    ADDRESS_FIELDS = ('Street', 'StreetNo', 'Block', 'County', 'City',
+                      'State', 'ZipCode')
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def fingerprint(self, customer):
+        address = customer.get('Address') or {}
+        values = [customer.get(k) for k in self.FIELDS] + \
+                 [address.get(k) for k in self.ADDRESS_FIELDS]
+        return tuple(as_text(v).strip() for v in values)
+
+    def load(self, adaptor, cardCodes):
+        """Refresh the entries of cardCodes from OCRD/CRD1 in one query and
+        return the CardCodes found.
+        """
+        adaptor._loadCodes('#CardCodes', cardCodes)
+        sql = """SELECT T0.CardCode, T0.Phone1 AS Phone, T0.E_Mail AS Email,
+                        T1.Street, T1.StreetNo, T1.Block, T1.County, T1.City,
+                        T1.State, T1.ZipCode
+                 FROM dbo.OCRD T0
+                 LEFT JOIN dbo.CRD1 T1
+                 ON T1.CardCode = T0.CardCode AND T1.Address = 'Direccion'
+                 WHERE T0.CardCode IN (SELECT Code FROM #CardCodes)"""
+        found = {}
+        for row in adaptor.sql_adaptor.fetch_raw(sql):
+            if row['CardCode'] not in found:
+                found[row['CardCode']] = self.fingerprint(dict(row, Address=row))
+        now = time()
+        with self.lock:
+            for cardCode, fingerprint in found.items():
+                self.entries[cardCode] = (fingerprint, now)
+        return set(found)
+
+    def unchanged(self, cardCode, customer):
+        """True if the cached business partner already has these values.
+        """
+        with self.lock:
+            entry = self.entries.get(cardCode)
+        if entry is None or time() - entry[1] > self.ttl:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return entry[0] == self.fingerprint(customer)
+
+    def matches(self, cardCode, customer):
+        """Like unchanged, whatever the age of the entry and uncounted.
+        """
+        with self.lock:
+            entry = self.entries.get(cardCode)
+        return entry is not None and entry[0] == self.fingerprint(customer)
+
+    def store(self, cardCode, customer):
+        """Remember the values just written. Called after the write is
+        committed, so it never raises; the entry is dropped instead.
+        """
+        try:
+            fingerprint = self.fingerprint(customer)
+        except Exception as e:
+            current_app.logger.warning("Not caching business partner %s: %s", cardCode, e)
+            with self.lock:
+                self.entries.pop(cardCode, None)
+            return
+        with self.lock:
+            self.entries[cardCode] = (fingerprint, time())
+
+
+class VersionCache(object):
+    """Values computed on demand and reused for ttl seconds.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def get(self, key, compute):
+        now = time()
+        with self.lock:
+            entry = self.values.get(key)
+        if entry is not None and now - entry[1] < self.ttl:
+            return entry[0]
+        value = compute()
+        with self.lock:
+            self.values[key] = (value, now)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Run concurrent calls with the same key once and hand every caller
+    the result; with a ttl the result is also reused for ttl seconds.
+    """
+
+    def __init__(self, ttl=0, maxEntries=256):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.results = OrderedDict()
+        self.executed = 0
+        self.shared = 0
+        self.hits = 0
+
+    def do(self, key, func):
+        with self.lock:
+            if self.ttl:
+                cached = self.results.get(key)
+                if cached is not None and time() - cached[1] < self.ttl:
+                    self.hits += 1
+                    return cached[0]
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+                self.executed += 1
+            else:
+                self.shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+                if self.ttl and flight.error is None:
+                    self.results.pop(key, None)
+                    self.results[key] = (flight.value, time())
+                    while len(self.results) > self.maxEntries:
+                        self.results.popitem(last=False)
+            flight.done.set()
+        return flight.value
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+
+class ColumnProfiles(object):
+    """Named column lists per fetch resource: the built-in ones in
+    COLUMN_PROFILES plus custom profiles saved to a JSON file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.custom = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.custom = json.load(f)
+
+    def get(self, resource, name):
+        custom = self.custom.get(resource, {})
+        if name in custom:
+            return custom[name]
+        return COLUMN_PROFILES.get(resource, {}).get(name)
+
+    def all(self):
+        profiles = {}
+        for resource in FETCH_TABLES:
+            profiles[resource] = dict(COLUMN_PROFILES.get(resource, {}))
+            profiles[resource].update(self.custom.get(resource, {}))
+        return profiles
+
+    def save(self, resource, name, columns):
+        if name in COLUMN_PROFILES.get(resource, {}):
+            raise ValueError("profile {0} is built in".format(name))
+        if not self.path:
+            raise ValueError("COLUMN_PROFILES_FILE is not set")
+        with self.lock:
+            self.custom.setdefault(resource, {})[name] = list(columns)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.custom, f, indent=2, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            replace_file(tmp, self.path)
+
+
+class ComBusy(Exception):
+    """No DI session could be had within the allowed queue wait.
+    """
+
+    def __init__(self, message, retryAfter):
+        super(ComBusy, self).__init__(message)
+        self.retryAfter = retryAfter
+
+
+class SqlBusy(ComBusy):
+    """Raised when no pooled SQL connection frees up in time.
+    """
+
+
+class SqlPool(object):
+    """Share up to size SQL Server connections between request threads.
+
+    A request takes a connection when it first needs one and gives it back
+    at teardown, rolled back to end any open transaction. Connections idle
+    for more than maxIdle seconds are closed instead of reused.
+    """
+
+    def __init__(self, connect, size=4, timeout=5.0, maxIdle=300):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.maxIdle = maxIdle
+        self.cond = threading.Condition()
+        self.idle = []
+        self.open = 0
+        self.inUse = 0
+        self.waits = 0
+        self.timeouts = 0
+
+    def acquire(self):
+        deadline = time() + self.timeout
+        stale = []
+        with self.cond:
+            waited = False
+            while True:
+                while self.idle:
+                    sql, released = self.idle.pop()
+                    if time() - released <= self.maxIdle:
+                        self.inUse += 1
+                        break
+                    self.open -= 1
+                    stale.append(sql)
+                else:
+                    sql = None
+                if sql is not None or self.open < self.size:
+                    break
+                remaining = deadline - time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise SqlBusy("No SQL connection within {0}s".format(self.timeout),
+                                  max(1, int(self.timeout)))
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                self.cond.wait(remaining)
+            if sql is None:
+                self.open += 1
+                self.inUse += 1
+        for conn in stale:
+            self._close(conn)
+        if sql is not None:
+            return sql
+        try:
+            return self.connect()
+        except Exception:
+            with self.cond:
+                self.open -= 1
+                self.inUse -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, sql, discard=False):
+        if not discard:
+            try:
+                sql.conn.rollback()
+            except Exception:
+                discard = True
+        with self.cond:
+            self.inUse -= 1
+            if discard:
+                self.open -= 1
+            else:
+                self.idle.append((sql, time()))
+            self.cond.notify()
+        if discard:
+            self._close(sql)
+
+    def _close(self, sql):
+        try:
+            sql.conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.open -= len(idle)
+        for sql, released in idle:
+            self._close(sql)
+
+
+class ComGate(object):
+    """Limit the concurrent DI sessions and shed load when the queue for
+    them gets too long.
+
+    Waits are smoothed into an exponential moving average; callers are
+    turned away at once when that average reaches admitWait (half of
+    maxWait by default), or when maxQueue are already waiting, instead of
+    joining a queue they would time out in. The admission threshold has to
+    be below maxWait: the waits are capped at maxWait, so their average
+    never gets past it.
+    """
+
+    def __init__(self, maxSessions=1, maxWait=10.0, maxQueue=20, alpha=0.2, admitWait=None):
+        self.maxSessions = maxSessions
+        self.maxWait = maxWait
+        self.admitWait = maxWait / 2.0 if admitWait is None else min(admitWait, maxWait)
+        self.maxQueue = maxQueue
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(maxSessions)
+        self.inUse = 0
+        self.waiting = 0
+        self.avgWait = 0.0
+        self.rejected = 0
+
+    def _retryAfter(self):
+        return max(1, int(self.avgWait + 0.5))
+
+    def _observe(self, wait):
+        self.avgWait += self.alpha * (wait - self.avgWait)
+
+    def acquire(self):
+        with self.lock:
+            if self.waiting >= self.maxQueue or self.avgWait >= self.admitWait:
+                self.rejected += 1
+                # Let the average decay so the gate reopens once load drops.
+                self._observe(0.0)
+                raise ComBusy("DI API overloaded, {0} requests waiting".format(self.waiting),
+                              self._retryAfter())
+            self.waiting += 1
+        start = time()
+        acquired = self._wait(self.maxWait)
+        wait = time() - start
+        with self.lock:
+            self.waiting -= 1
+            self._observe(wait)
+            if not acquired:
+                self.rejected += 1
+                raise ComBusy("No DI session within {0}s".format(self.maxWait),
+                              self._retryAfter())
+            self.inUse += 1
+        registry.observe(current_method(), 'com_wait', wait)
+        return wait
+
+    def _wait(self, timeout):
+        # Semaphore.acquire has no timeout on Python 2.
+        deadline = time() + timeout
+        delay = 0.0005
+        while not self.slots.acquire(False):
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+        return True
+
+    def release(self):
+        with self.lock:
+            self.inUse -= 1
+        self.slots.release()
+
+    def drain(self, timeout=None):
+        """Wait until no DI session is in use; returns False on timeout.
+        """
+        deadline = None if timeout is None else time() + timeout
+        while self.inUse:
+            if deadline is not None and time() >= deadline:
+                return False
+            sleep(0.05)
+        return True
+
 
 class SAPB1Adaptor(object):
     """SAP B1 Adaptor with functions.
@@ -103,6 +981,18 @@ class SAPB1Adaptor(object):
 
     def __init__(self, app=None):
         self.app = app
+        self.stockSnapshot = None
+        self.cardCodes = None
+        self.contactIndex = None
+        self.businessPartners = None
+        self.sessionLock = threading.Lock()
+        self.sessions = {'com': 0, 'sql': 0}
+        self.comGate = None
+        self.dataVersions = None
+        self.sqlPool = None
+        self.readFlight = None
+        self.columnProfiles = None
+        self.schema = None
         if app is not None:
             self.init_app(app)
 
@@ -114,14 +1004,67 @@ class SAPB1Adaptor(object):
             app.teardown_appcontext(self.teardown)
         else:
             app.teardown_request(self.teardown)
+        if app.config.get('STOCK_SNAPSHOT', False):
+            self.stockSnapshot = StockSnapshot(
+                self, app,
+                interval=app.config.get('STOCK_SNAPSHOT_INTERVAL', 30),
+                maxAge=app.config.get('STOCK_SNAPSHOT_MAX_AGE', 120),
+                reloadInterval=app.config.get('STOCK_SNAPSHOT_RELOAD', 3600))
+        self.cardCodes = CardCodeAllocator(
+            app.config.get('CARDCODE_BLOCK_FILE', 'cardcode_block.json'),
+            blockSize=app.config.get('CARDCODE_BLOCK_SIZE', 100),
+            prefix=app.config.get('CARDCODE_PREFIX', 'C'))
+        self.contactIndex = ContactIndex(app.config.get('CONTACT_INDEX_SIZE', 10000),
+                                         ttl=app.config.get('CONTACT_INDEX_TTL', 600))
+        self.businessPartners = BusinessPartnerCache(app.config.get('BP_CACHE_TTL', 600))
+        registry.enabled = app.config.get('INSTRUMENTATION', True)
+        self.comGate = ComGate(maxSessions=app.config.get('COM_MAX_SESSIONS', 1),
+                               maxWait=app.config.get('COM_MAX_QUEUE_WAIT', 10.0),
+                               maxQueue=app.config.get('COM_MAX_QUEUE', 20),
+                               admitWait=app.config.get('COM_ADMIT_WAIT', None))
+        self.dataVersions = VersionCache(app.config.get('DATA_VERSION_TTL', 30))
+        if app.config.get('SINGLE_FLIGHT', True):
+            self.readFlight = SingleFlight(ttl=app.config.get('READ_CACHE_TTL', 0),
+                                           maxEntries=app.config.get('READ_CACHE_SIZE', 256))
+        self.columnProfiles = ColumnProfiles(app.config.get('COLUMN_PROFILES_FILE', 'column_profiles.json'))
+        self.schema = VersionCache(app.config.get('SCHEMA_CACHE_TTL', 3600))
+        poolSize = app.config.get('SQL_POOL_SIZE', 0)
+        if poolSize:
+            config = app.config
+            self.sqlPool = SqlPool(lambda: MsSqlAdaptor(config), size=poolSize,
+                                   timeout=app.config.get('SQL_POOL_TIMEOUT', 5.0),
+                                   maxIdle=app.config.get('SQL_POOL_MAX_IDLE', 300))
 
     def teardown(self, exception):
         ctx = stack.top
         if hasattr(ctx, '_COM'):
             ctx._COM.disconnect()
+            self._countSession('com', -1)
+        if getattr(ctx, '_COM_SLOT', False):
+            ctx._COM_SLOT = False
+            self.comGate.release()
         if hasattr(ctx, '_SQL'):
-            ctx._SQL.disconnect()
+            if getattr(ctx, '_SQL_POOLED', False):
+                self.sqlPool.release(ctx._SQL, discard=exception is not None)
+            else:
+                ctx._SQL.disconnect()
+            self._countSession('sql', -1)
 
+    def _countSession(self, kind, delta):
+        with self.sessionLock:
+            self.sessions[kind] += delta
+
+    def shutdown(self, timeout=30):
+        """Wait for the DI transactions in flight to finish, then close the
+        pooled SQL connections. Returns False if DI sessions were still in
+        use after timeout seconds.
+        """
+        drained = self.comGate is None or self.comGate.drain(timeout)
+        if self.sqlPool is not None:
+            self.sqlPool.close()
+        return drained
+
+    @instrumented
     def info(self):
         """Show the information for the SAP B1 connection.
         """
@@ -134,14 +1077,24 @@ class SAPB1Adaptor(object):
         }
         return data
 
+    def acquireCom(self):
+        """Take a DI session slot for the current app context; it is given
+        back at teardown. Raises ComBusy when overloaded.
+        """
+        ctx = stack.top
+        if not getattr(ctx, '_COM_SLOT', False):
+            self.comGate.acquire()
+            ctx._COM_SLOT = True
+
     @property
     def com_adaptor(self):
         ctx = stack.top
         try:
             return ctx._COM
         except AttributeError:
+            self.acquireCom()
             ctx._COM = com = SapB1ComAdaptor(current_app.config)
-            print(com.company.CompanyName)
+            self._countSession('com', 1)
             log = "Open SAPB1 connection for " + com.company.CompanyName            
             current_app.logger.info(log)
             return com
@@ -152,10 +1105,78 @@ class SAPB1Adaptor(object):
         try:
             return ctx._SQL
         except AttributeError:
-            ctx._SQL = sql = MsSqlAdaptor(current_app.config)
-            current_app.logger.info("Open SAPB1 DB connection")
+            if self.sqlPool is not None:
+                ctx._SQL = sql = self.sqlPool.acquire()
+                ctx._SQL_POOLED = True
+            else:
+                ctx._SQL = sql = MsSqlAdaptor(current_app.config)
+                current_app.logger.info("Open SAPB1 DB connection")
+            self._countSession('sql', 1)
             return sql
 
+    def tableColumns(self, table):
+        """Column names of a dbo table by lower-cased name, from
+        INFORMATION_SCHEMA; cached for SCHEMA_CACHE_TTL seconds.
+        """
+        def load():
+            sql = """SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS
+                     WHERE TABLE_SCHEMA = 'dbo' AND TABLE_NAME = %s"""
+            return dict((row['COLUMN_NAME'].lower(), row['COLUMN_NAME'])
+                        for row in self.sql_adaptor.fetch_all(sql, table))
+        return self.schema.get(table, load)
+
+    def _validColumns(self, table, columns):
+        known = self.tableColumns(table)
+        valid = []
+        for column in columns:
+            column = str(column).strip()
+            if not IDENTIFIER.match(column) or column.lower() not in known:
+                raise ValueError("unknown column {0} of {1}".format(column, table))
+            valid.append(known[column.lower()])
+        return valid
+
+    def selectColumns(self, resource, columns=None, profile=None):
+        """The select list of a fetch: the requested columns checked
+        against the table, else the named profile (FETCH_DEFAULT_PROFILE
+        by default). Raises ValueError for unknown columns or profiles.
+        """
+        table = FETCH_TABLES[resource]
+        if columns:
+            if isinstance(columns, basestring):
+                columns = columns.split(',')
+            return " ,".join(self._validColumns(table, columns))
+        name = profile or current_app.config.get('FETCH_DEFAULT_PROFILE', 'summary')
+        columns = self.columnProfiles.get(resource, name)
+        if columns is None:
+            raise ValueError("unknown profile {0} for {1}".format(name, resource))
+        if columns == ['*']:
+            return '*'
+        return " ,".join(self._validColumns(table, columns))
+
+    def _whereParams(self, resource, params):
+        """WHERE clause and args of fetch params, their names checked
+        against the table and their operators against PARAM_OPS.
+        """
+        if not params:
+            return '', {}
+        names = self._validColumns(FETCH_TABLES[resource], params.keys())
+        clauses = []
+        for key, name in zip(params.keys(), names):
+            op = params[key].get('op', '=').upper()
+            if op not in PARAM_OPS:
+                raise ValueError("unsupported operator {0}".format(op))
+            clauses.append("{0} {1} %({2})s".format(name, op, name))
+        args = dict((name, params[key]['value']) for key, name in zip(params.keys(), names))
+        return ' WHERE ' + " AND ".join(clauses), args
+
+    def saveColumnProfile(self, resource, name, columns):
+        if resource not in FETCH_TABLES:
+            raise ValueError("unknown resource {0}".format(resource))
+        if not IDENTIFIER.match(name or ''):
+            raise ValueError("invalid profile name")
+        self._validColumns(FETCH_TABLES[resource], columns)
+        self.columnProfiles.save(resource, name, columns)
+
     def trimValue(self, value, maxLength):
         """Trim the value.
         """
@@ -163,20 +1184,23 @@ class SAPB1Adaptor(object):
             return value[0:maxLength-1]
         return value
 
-    def getOrders(self, num=1, columns=[], params={}):
+    @instrumented
+    def getOrders(self, num=1, columns=[], params={}, profile=None, shared=False):
         """Retrieve orders from SAP B1.
+
+        Without columns the profile's columns are selected (see
+        selectColumns). Only API reads pass shared; the read-backs after a
+        DI write must see the write, not a shared or cached result.
         """
-        cols = '*'
-        if len(columns) > 0:
-            cols = " ,".join(columns)
-        ops = {key: '=' if 'op' not in params[key].keys() else params[key]['op'] for key in params.keys()}
-        sql = """SELECT top {0} {1} FROM dbo.ORDR""".format(num, cols)
-        if len(params) > 0:
-            sql = sql + ' WHERE ' + " AND ".join(["{0} {1} %({2})s".format(k, ops[k], k) for k in params.keys()])
-        args = {key: params[key]['value'] for key in params.keys()}
-        print(sql)
+        cols = self.selectColumns('orders', columns, profile)
+        where, args = self._whereParams('orders', params)
+        sql = """SELECT top {0} {1} FROM dbo.ORDR""".format(int(num), cols) + where
+        current_app.logger.debug("getOrders: %s", sql)
+        if shared:
+            return self.fetchShared(sql, args=args)
         return list(self.sql_adaptor.fetch_all(sql, args=args))
     
+    @instrumented
     def getDownPayment(self, num=1, columns=[], params={}):
         """Retreive Down Payments from SAP B1.
         """
@@ -192,12 +1216,14 @@ class SAPB1Adaptor(object):
         sql = sql + " ORDER BY DocEntry DESC"
         return list(self.sql_adaptor.fetch_all(sql, args=args))
 
+    @instrumented
     def getMainCurrency(self):
         """Retrieve the main currency of the company from SAP B1.
         """
         sql = """SELECT MainCurncy FROM dbo.OADM"""
         return self.sql_adaptor.fetchone(sql)['MainCurncy']
 
+    @instrumented
     def getShipCode(self, code):
         if code == 'FedEx - Priority Overnight':
             return 'FedEx Priority Overnight'
@@ -226,15 +1252,12 @@ class SAPB1Adaptor(object):
         elif code == 'USPS - First-Class Package International Service':
             return 'First-Class Package International Service'
 
+    @instrumented
     def insertBusinessPartner(self, customer):
         """Insert a new business partner
         """
-        cardcode_sql = """SELECT MAX(T0.CardCode) AS CardCode FROM OCRD T0 WHERE T0.CARDTYPE = 'C' FOR BROWSE"""
-        sql_result = self.sql_adaptor.fetchone(cardcode_sql)
-        last_cardcode = sql_result.get('CardCode')
-        print('Last CardCode:%s'%last_cardcode)
-        next_cardcode = 'C%05d'%(int(last_cardcode.replace('C','').replace('c','')) + 1)
-        print('Next CardCode:%s'%next_cardcode)
+        next_cardcode = self.cardCodes.allocate(self)
+        current_app.logger.debug("Next CardCode: %s", next_cardcode)
         com = self.com_adaptor       
         busPartner = com.company.GetBusinessObject(com.constants.oBusinessPartners)
         busPartner.CardCode = next_cardcode
@@ -271,11 +1294,22 @@ class SAPB1Adaptor(object):
             log = com.company.GetLastErrorDescription()
             current_app.logger.error(log)
             raise Exception(log, customer)            
+        self.businessPartners.store(next_cardcode, customer)
         return {'CardCode':next_cardcode}
 
-    def updateBusinessPartner(self, CardCode, customer):
+    @instrumented
+    def updateBusinessPartner(self, CardCode, customer, checked=False):
         """Update business partner by CardCode
+
+        Nothing is sent to SAP B1 if the business partner already has the
+        given values. A cache hit is confirmed on OCRD first, as the
+        business partner may have been edited in SAP B1 since; checked
+        means the caller has just loaded it and found a change.
         """
+        if not checked and self.businessPartners.unchanged(CardCode, customer):
+            self.businessPartners.load(self, [CardCode])
+            if self.businessPartners.matches(CardCode, customer):
+                return {'CardCode':CardCode}
         com = self.com_adaptor       
         busPartner = com.company.GetBusinessObject(com.constants.oBusinessPartners)
         busPartner.GetByKey(CardCode);
@@ -298,8 +1332,40 @@ class SAPB1Adaptor(object):
             log = com.company.GetLastErrorDescription()
             current_app.logger.error(log)
             raise Exception(log)
+        self.businessPartners.store(CardCode, customer)
         return {'CardCode':CardCode}
 
+    @instrumented
+    def upsertBusinessPartners(self, customers):
+        """Insert or update business partners in bulk.
+
+        Customers with a CardCode found in OCRD are diffed against it and
+        only updated if something changed; the others are inserted. Each
+        customer gets CardCode, tx_status ('S' or 'F'), tx_action ('created',
+        'updated' or 'unchanged') and on failure tx_note.
+        """
+        cardCodes = [c['CardCode'] for c in customers if c.get('CardCode')]
+        existing = self.businessPartners.load(self, cardCodes) if cardCodes else set()
+        for customer in customers:
+            cardCode = customer.get('CardCode')
+            try:
+                if cardCode in existing:
+                    if self.businessPartners.unchanged(cardCode, customer):
+                        customer['tx_action'] = 'unchanged'
+                    else:
+                        self.updateBusinessPartner(cardCode, customer, checked=True)
+                        customer['tx_action'] = 'updated'
+                else:
+                    customer['CardCode'] = self.insertBusinessPartner(customer)['CardCode']
+                    customer['tx_action'] = 'created'
+                customer['tx_status'] = 'S'
+            except Exception as e:
+                customer['tx_status'] = 'F'
+                customer['tx_note'] = str(e)
+                current_app.logger.exception(e)
+        return customers
+
+    @instrumented
     def getContacts(self, num=1, columns=[], cardCode=None, contact={}):
         """Retrieve contacts under a business partner by CardCode from SAP B1.
         """
@@ -316,9 +1382,20 @@ class SAPB1Adaptor(object):
         sql = sql + ' WHERE ' + " AND ".join(["{0} = %({1})s".format(k, k) for k in params.keys()])
         return list(self.sql_adaptor.fetch_all(sql, **params))
 
+    @instrumented
     def insertContact(self, cardCode, contact):
         """Insert a new contact into a business partner by CardCode.
         """
+        return self.insertContacts(cardCode, [contact])[0]
+
+    @instrumented
+    def insertContacts(self, cardCode, contacts):
+        """Insert contacts into a business partner by CardCode with a single
+        Update, and return their CntctCodes in order (None for a contact
+        whose code could not be read back after the Update).
+        """
+        if not contacts:
+            return []
         com = self.com_adaptor
         busPartner = com.company.GetBusinessObject(com.constants.oBusinessPartners)
         busPartner.GetByKey(cardCode)
@@ -327,33 +1404,51 @@ class SAPB1Adaptor(object):
             nextLine = 0
         else:
             nextLine = current
-        busPartner.ContactEmployees.Add()
-        busPartner.ContactEmployees.SetCurrentLine(nextLine)
-        name = contact['FirstName'] + ' ' + contact['LastName']
-        name = name[0:36] + ' ' + str(time())
-        busPartner.ContactEmployees.Name = name
-        busPartner.ContactEmployees.FirstName = contact['FirstName']
-        busPartner.ContactEmployees.LastName = contact['LastName']
-        busPartner.ContactEmployees.Phone1 = contact["Tel1"]
-        busPartner.ContactEmployees.E_Mail = contact["E_MailL"]
-        address = contact['Address']
-        busPartner.ContactEmployees.Address = self.trimValue(address, 100)
+        stamp = time()
+        names = []
+        for i, contact in enumerate(contacts):
+            busPartner.ContactEmployees.Add()
+            busPartner.ContactEmployees.SetCurrentLine(nextLine + i)
+            name = contact['FirstName'] + ' ' + contact['LastName']
+            name = name[0:36] + ' ' + '%.2f' % (stamp + i * 0.01)
+            names.append(name)
+            busPartner.ContactEmployees.Name = name
+            busPartner.ContactEmployees.FirstName = contact['FirstName']
+            busPartner.ContactEmployees.LastName = contact['LastName']
+            busPartner.ContactEmployees.Phone1 = contact["Tel1"]
+            busPartner.ContactEmployees.E_Mail = contact["E_MailL"]
+            address = contact['Address']
+            busPartner.ContactEmployees.Address = self.trimValue(address, 100)
         lRetCode = busPartner.Update()
         if lRetCode != 0:
-            log = self.company.GetLastErrorDescription()
+            log = com.company.GetLastErrorDescription()
             current_app.logger.error(log)
             raise Exception(log)
 
-        cntct = {
-            "name": name,
-            "FirstName": contact['FirstName'],
-            "LastName": contact['LastName'],
-            "E_MailL": contact["E_MailL"]
-        }
-        contacts = self.getContacts(num=1, columns=['cntctcode'], cardCode=cardCode, contact=cntct)
-        contactCode = contacts[0]['cntctcode']
-        return contactCode
+        codes = self._newContactCodes(cardCode, names)
+        contactCodes = []
+        for name, contact in zip(names, contacts):
+            contactCode = codes.get(name)
+            if contactCode is None:
+                # The Update is committed; report the contact without a
+                # code rather than failing the whole request.
+                current_app.logger.warning("No CntctCode found for contact %s of %s", name, cardCode)
+            else:
+                self.contactIndex.add(cardCode, contact, contactCode)
+            contactCodes.append(contactCode)
+        return contactCodes
+
+    def _newContactCodes(self, cardCode, names):
+        """The CntctCodes of just added contacts by their unique Name, from
+        one OCPR query.
+        """
+        sql = """SELECT CntctCode, Name FROM dbo.OCPR
+                 WHERE CardCode = %s AND Name IN ({0})""".format(
+            ", ".join(["%s"] * len(names)))
+        return dict((row['Name'], row['CntctCode'])
+                    for row in self.sql_adaptor.fetch_raw(sql, [cardCode] + names))
 
+    @instrumented
     def getContactPersonCode(self, order):
         """Retrieve ContactPersonCode by an order.
         """
@@ -362,10 +1457,14 @@ class SAPB1Adaptor(object):
             'LastName': order['billto_lastname'],
             'E_MailL': order['billto_email']
         }
-        contacts = self.getContacts(num=1, columns=['cntctcode'], cardCode=order['card_code'], contact=contact)
-        contactCode = None
-        if len(contacts) == 1:
-            contactCode = contacts[0]['cntctcode']
+        contactCode, loaded = self.contactIndex.lookup(self, order['card_code'], contact)
+        if contactCode is None and not loaded:
+            # The contact may have been added in SAP B1 after the index was
+            # loaded; confirm on OCPR before inserting a duplicate.
+            contacts = self.getContacts(num=1, columns=['cntctcode'], cardCode=order['card_code'], contact=contact)
+            if len(contacts) == 1:
+                contactCode = contacts[0]['cntctcode']
+                self.contactIndex.add(order['card_code'], contact, contactCode)
         if contactCode is None:
             address = order['billto_address'] + ', ' \
                       + order['billto_city'] + ', ' \
@@ -377,6 +1476,7 @@ class SAPB1Adaptor(object):
             contactCode = self.insertContact(order['card_code'], contact)
         return contactCode
 
+    @instrumented
     def getExpnsCode(self, expnsName):
         """Retrieve expnsCode by expnsName.
         """
@@ -386,35 +1486,43 @@ class SAPB1Adaptor(object):
         expnsCode = cursor.fetchone()['ExpnsCode']
         return expnsCode
 
+    @instrumented
     def getTrnspCode(self, trnspName):
         """Retrieve TrnspCode by trnspName.  """
         sql = """SELECT [dbo].[@RPC_WEBSHIP_MAP].U_Service FROM [dbo].[@RPC_WEBSHIP_MAP] WHERE U_MagentoCode = %s"""
-        print(self.sql_adaptor.fetchone(sql, trnspName))
         return self.sql_adaptor.fetchone(sql, trnspName)['U_Service']
 
+    @instrumented
     def getExpnsNames(self):
         """Retrieve expnsNames. """
         sql = """SELECT ExpnsName FROM dbo.OEXD"""
-        return list(self.sql_adaptor.fetch_all(sql))
+        return self.fetchShared(sql)
 
+    @instrumented
     def getTrnspNames(self):
         """Retrieve TrnspNames.
         """
         sql = """SELECT TrnspName FROM dbo.OSHP"""
-        return list(self.sql_adaptor.fetch_all(sql))
+        return self.fetchShared(sql)
 
+    @instrumented
     def getPayMethCods(self):
         sql = """SELECT PayMethCod from opym"""
-        return list(self.sql_adaptor.fetch_all(sql))
+        return self.fetchShared(sql)
 
+    @instrumented
     def getTaxCodes(self):
         sql = """SELECT Code, Name, Rate from osta"""
-        return list(self.sql_adaptor.fetch_all(sql))
+        return self.fetchShared(sql)
 
-    def getUSDRate(self):
-        sql = """SELECT Rate from ORTT where RateDate='{0}'""".format(strftime("%Y-%m-%d"))
-        return list(self.sql_adaptor.fetch_all(sql))
+    @instrumented
+    def getUSDRate(self, rateDate=None):
+        """Rates of rateDate (YYYY-MM-DD), today on the app server by default.
+        """
+        sql = """SELECT Rate from ORTT where RateDate = %s"""
+        return self.fetchShared(sql, args=(rateDate or strftime("%Y-%m-%d"),))
 
+    @instrumented
     def insertOrder(self, o):
         """Insert an order into SAP B1.
         """
@@ -522,7 +1630,7 @@ class SAPB1Adaptor(object):
         if o['order_total'] > 0:
 
             if o['giftcard'] and o['giftcard_amount'] < o['order_total']:
-                print("DOUBLE DOWN PAYMENT")
+                current_app.logger.debug("Down payments for giftcard and card: %s", o['U_WebOrderId'])
                 cashDownPayment = com.company.GetBusinessObject(com.constants.oDownPayments)
                 cashDownPayment.DownPaymentType = com.constants.dptInvoice
                 cashDownPayment.DocDueDate = o['doc_due_date']
@@ -722,7 +1830,7 @@ class SAPB1Adaptor(object):
                     raise Exception(error, o['U_WebOrderId'])
 
             else:
-                print("GIFTCARD NO")   
+                current_app.logger.debug("Down payment without giftcard: %s", o['U_WebOrderId'])
                 downPayment = com.company.GetBusinessObject(com.constants.oDownPayments)
                 downPayment.DownPaymentType = com.constants.dptInvoice
                 downPayment.DocDueDate = o['doc_due_date']
@@ -797,6 +1905,7 @@ class SAPB1Adaptor(object):
 
         return orderDocEntry
         
+    @instrumented
     def insertQuotation(self, q):
         """Create a quotation into SAP B1.
         """
@@ -828,6 +1937,7 @@ class SAPB1Adaptor(object):
         quotationDocEntry = sqlresult['DocEntry']
         return quotationDocEntry
 
+    @instrumented
     def cancelOrder(self, o):
         """Cancel an order in SAP B1.
         """
@@ -886,37 +1996,50 @@ class SAPB1Adaptor(object):
 #            shipment['items'] = self._getShipmentItems(shipmentId, itemColumns)
 #        return shipments
     
-    def getShipments(self, num=1, columns=[], params={}):
-        """Retrieve orders from SAP B1.
+    @instrumented
+    def getShipments(self, num=1, columns=[], params={}, itemColumns=None, profile=None):
+        """Retrieve shipments(deliveries) from SAP B1.
+
+        Without columns the profile's columns are selected. With
+        itemColumns each shipment gets its lines, read in one query.
         """
-        cols = '*'
-        if len(columns) > 0:
-            cols = " ,".join(columns)
-        ops = {key: '=' if 'op' not in params[key].keys() else params[key]['op'] for key in params.keys()}
-        sql = """SELECT top {0} {1} FROM dbo.ODLN""".format(num, cols)
-        if len(params) > 0:
-            sql = sql + ' WHERE ' + " AND ".join(["{0} {1} %({2})s".format(k, ops[k], k) for k in params.keys()])
-        args = {key: params[key]['value'] for key in params.keys()}
-        print(sql)
-        return list(self.sql_adaptor.fetch_all(sql, args=args))
+        cols = self.selectColumns('shipments', columns, profile)
+        if itemColumns and cols != '*' and 'DocEntry' not in cols.split(' ,'):
+            cols = 'DocEntry ,' + cols
+        where, args = self._whereParams('shipments', params)
+        sql = """SELECT top {0} {1} FROM dbo.ODLN""".format(int(num), cols) + where
+        current_app.logger.debug("getShipments: %s", sql)
+        shipments = list(self.sql_adaptor.fetch_all(sql, args=args))
+        if itemColumns and shipments:
+            itemCols = self.selectColumns('shipmentItems',
+                                          None if itemColumns is True else itemColumns,
+                                          profile if itemColumns is True else None)
+            if itemCols != '*' and 'DocEntry' not in itemCols.split(' ,'):
+                itemCols = 'DocEntry ,' + itemCols
+            entries = [shipment['DocEntry'] for shipment in shipments]
+            sql = """SELECT {0} FROM dbo.DLN1 WHERE DocEntry IN ({1})
+                     ORDER BY DocEntry, LineNum""".format(itemCols, ", ".join(["%s"] * len(entries)))
+            lines = {}
+            for row in self.sql_adaptor.fetch_all(sql, tuple(entries)):
+                lines.setdefault(row['DocEntry'], []).append(row)
+            for shipment in shipments:
+                shipment['items'] = lines.get(shipment['DocEntry'], [])
+        return shipments
     
     def getLineNum(self, sql):
         return list(self.sql_adaptor.fetch_all(sql))
 
-    def getOrderShipInfo(self, num=1, columns=[], params={}):
+    @instrumented
+    def getOrderShipInfo(self, num=1, columns=[], params={}, profile=None):
         """Retrieve order shipping info from SAP B1.
         """
-        cols = '*'
-        if len(columns) > 0:
-            cols = " ,".join(columns)
-        ops = {key: '=' if 'op' not in params[key].keys() else params[key]['op'] for key in params.keys()}
-        sql = """SELECT top {0} {1} FROM dbo.RDR3""".format(num, cols)
-        if len(params) > 0:
-            sql = sql + ' WHERE ' + " AND ".join(["{0} {1} %({2})s".format(k, ops[k], k) for k in params.keys()])
-        args = {key: params[key]['value'] for key in params.keys()}
-        print(sql)
+        cols = self.selectColumns('orderShipInfo', columns, profile)
+        where, args = self._whereParams('orderShipInfo', params)
+        sql = """SELECT top {0} {1} FROM dbo.RDR3""".format(int(num), cols) + where
+        current_app.logger.debug("getOrderShipInfo: %s", sql)
         return list(self.sql_adaptor.fetch_all(sql, args=args))
 
+    @instrumented
     def insertShipment(self, o):
         """Insert shipments into SAP B1.
         """
@@ -924,7 +2047,7 @@ class SAPB1Adaptor(object):
         delivery =  com.company.GetBusinessObject(com.constants.oDeliveryNotes)
 
         params = None
-        print(str(o['U_WebOrderId']))
+        current_app.logger.debug("insertShipment: %s", o['U_WebOrderId'])
         params = {'U_WebOrderId': {'value': str(o['U_WebOrderId'])}}
         orders = self.getOrders(num=1, columns=['DocEntry', 'DocTotal', 'DocNum'], params=params)
         orderDocEntry = orders[0]['DocEntry']
@@ -1193,14 +2316,110 @@ class SAPB1Adaptor(object):
         
 
 
-    def getItems(self, limit=1, columns=None, whs=None, code=None):
-        """Retrieve items(products) from SAP B1.  """
+    @instrumented
+    def getDataVersion(self, name, args=None):
+        """Return (version, modified) of a data set in DATA_VERSION_SQL.
+
+        modified is the last change time where SAP B1 keeps one, else
+        None. args fill the placeholders of the query. Results are reused
+        for DATA_VERSION_TTL seconds. The 'info' data set is versioned by
+        the connection settings alone.
+        """
+        if name == 'info':
+            config = current_app.config
+            return ('{DIAPI}:{SERVER}:{COMPANYDB}'.format(**config), None)
+        key = name if args is None else (name,) + tuple(args)
+
+        def compute():
+            def fetch():
+                return self.sql_adaptor.fetchone(DATA_VERSION_SQL[name], args) or {}
+            # fetchone keeps Modified a datetime; fetch_all would format it.
+            row = self.readFlight.do(key, fetch) if self.readFlight else fetch()
+            return ('{0}:{1}'.format(row.get('Rows'), row.get('Version')),
+                    row.get('Modified'))
+        return self.dataVersions.get(key, compute)
+
+    def versionCovers(self, name, columns=None):
+        """True if the data version of name changes whenever a read of the
+        given columns (a comma separated select list; None for the default
+        one) would.
+        """
+        if not columns:
+            return True
+        known = set(c.lower() for c in DATA_VERSION_COLUMNS[name])
+        return all(c.strip().lower() in known for c in columns.split(','))
+
+    @instrumented
+    def getSyncToken(self):
+        """Return a change token for the current database time.
+
+        Take it before reading the changes so that rows updated while the
+        read runs are returned again by the next sync.
+        """
+        row = self.sql_adaptor.fetchone(SYNC_MARK_SQL)
+        return encode_sync_token(row['UpdateDate'].strip(), row['UpdateTS'])
+
+    @instrumented
+    def getDocumentMark(self, resource):
+        """Return (sync token, MAX(DocEntry)) of a document table: the
+        mark a change scan starts from.
+        """
+        token = self.getSyncToken()
+        row = self.sql_adaptor.fetchone(
+            "SELECT ISNULL(MAX(DocEntry), 0) AS DocEntry FROM dbo.{0}".format(FETCH_TABLES[resource]))
+        return token, int(row['DocEntry'])
+
+    @instrumented
+    def getDocumentChanges(self, resource, date, ts, entry, limit=100, profile=None):
+        """Return the document headers of orders, shipments or invoices
+        changed after the (UpdateDate, UpdateTS, DocEntry) mark, oldest
+        first, with the columns of the profile plus the mark columns.
+        """
+        columns = self.selectColumns(resource, profile=profile)
+        if columns != '*':
+            names = columns.split(' ,')
+            columns = " ,".join(names + [c for c in MARK_COLUMNS if c not in names])
+        untilDate, untilTs = decode_sync_token(self.getSyncToken())
+        sql = DOCUMENTS_CHANGED.format(limit=int(limit), columns=columns,
+                                       table=FETCH_TABLES[resource])
+        args = {'date': date, 'ts': int(ts), 'entry': int(entry),
+                'until_date': untilDate, 'until_ts': untilTs}
+        return list(self.sql_adaptor.fetch_all(sql, args))
+
+    def _sinceArgs(self, since):
+        date, ts = decode_sync_token(since)
+        return {'since_date': date, 'since_ts': ts}
+
+    def _sinceClauses(self, changed, whs=None, code=None, since=None):
+        """WHERE clauses and args of a sync read: the changed clause when
+        since is a token, then the whs and code filters.
+        """
+        clauses, args = [], {}
+        if since:
+            clauses.append(changed)
+            args.update(self._sinceArgs(since))
+        if whs:
+            clauses.append("""ItemCode in (SELECT ItemCode FROM dbo.OITW
+                                           WHERE WhsCode = %(whs)s)""")
+            args['whs'] = whs
+        if code:
+            clauses.append("ItemCode = %(code)s")
+            args['code'] = code
+        return clauses, args or None
+
+    def _itemsSql(self, limit=1, columns=None, whs=None, code=None, since=None):
         if columns:
             cols = columns
         else:
             cols = 'ItemCode, ItemName, ItmsGrpCod, CreateDate, UpdateDate'
 
-        if whs:
+        args = None
+        if since is not None:
+            clauses, args = self._sinceClauses(ITEMS_CHANGED, whs, code, since)
+            sql = """SELECT {0} FROM dbo.OITM""".format(cols)
+            if clauses:
+                sql = sql + " WHERE " + " AND ".join(clauses)
+        elif whs:
             sql = """SELECT top {0} {1} FROM dbo.OITM
                      WHERE ItemCode in
                          (SELECT ItemCode FROM dbo.OITW
@@ -1210,17 +2429,42 @@ class SAPB1Adaptor(object):
                      WHERE ItemCode = '{1}'""".format(cols, code)
         else:
             sql = """SELECT top {0} {1} FROM dbo.OITM""".format(limit, cols)
-        return list(self.sql_adaptor.fetch_all(sql))
+        return sql, args
+
+    @instrumented
+    def getItems(self, limit=1, columns=None, whs=None, code=None, since=None):
+        """Retrieve items(products) from SAP B1.
+
+        With since (a change token, or '' for a full sync) only the items
+        changed after the token are returned and limit is ignored.
+        """
+        sql, args = self._itemsSql(limit=limit, columns=columns, whs=whs, code=code, since=since)
+        if since is None:
+            return self.fetchShared(sql, args=args)
+        return list(self.sql_adaptor.fetch_all(sql, args=args))
+
+    def iterItems(self, limit=1, columns=None, whs=None, code=None, since=None, size=1000):
+        """Stream items(products) as column names followed by row batches.
+        """
+        sql, args = self._itemsSql(limit=limit, columns=columns, whs=whs, code=code, since=since)
+        return self.sql_adaptor.fetch_batches(sql, args=args, size=size)
 
-    def getPrices(self, limit=1, columns=None, whs=None, code=None):
-        """Retrieve prices(products) from SAP B1.  """
+    def _pricesSql(self, limit=1, columns=None, whs=None, code=None, since=None):
         if columns:
             cols = columns
         else:
             cols = 'ItemCode, Price, Currency, Ovrwritten, Factor'
 
         listNumber = 2  # Lista de Ventas
-        if whs:
+        args = None
+        if since is not None:
+            changed = "ItemCode in (SELECT ItemCode FROM dbo.OITM WHERE {0})".format(ITEMS_CHANGED)
+            clauses, args = self._sinceClauses(changed, whs, code, since)
+            sql = """SELECT {0} FROM dbo.ITM1
+                     WHERE PriceList = {1}""".format(cols, listNumber)
+            for clause in clauses:
+                sql = sql + " AND " + clause
+        elif whs:
             sql = """SELECT top {0} {1} FROM dbo.ITM1
                      WHERE PriceList = {2}
                      AND ItemCode in
@@ -1233,11 +2477,37 @@ class SAPB1Adaptor(object):
         else:
             sql = """SELECT top {0} {1} FROM dbo.ITM1
                      WHERE PriceList = {2}""".format(limit, cols, listNumber)
+        return sql, args
 
-        return list(self.sql_adaptor.fetch_all(sql))
+    @instrumented
+    def getPrices(self, limit=1, columns=None, whs=None, code=None, since=None):
+        """Retrieve prices(products) from SAP B1.
+
+        With since only the prices of items changed after the token are
+        returned and limit is ignored.
+        """
+        sql, args = self._pricesSql(limit=limit, columns=columns, whs=whs, code=code, since=since)
+        if since is None:
+            return self.fetchShared(sql, args=args)
+        return list(self.sql_adaptor.fetch_all(sql, args=args))
+
+    def iterPrices(self, limit=1, columns=None, whs=None, code=None, since=None, size=1000):
+        """Stream prices(products) as column names followed by row batches.
+        """
+        sql, args = self._pricesSql(limit=limit, columns=columns, whs=whs, code=code, since=since)
+        return self.sql_adaptor.fetch_batches(sql, args=args, size=size)
     
-    def getStockNum(self, limit=1, columns=None, whs=None, code=None):
-        """Retrieve stock(products) from SAP B1."""
+    @instrumented
+    def getStockNum(self, limit=1, columns=None, whs=None, code=None, since=None, refresh=False):
+        """Retrieve stock(products) from SAP B1.
+
+        With since only the stock of items changed, moved or committed
+        after the token is returned and limit is ignored. Plain lookups are
+        answered from the stock snapshot when it is enabled; refresh forces
+        it to catch up first.
+        """
+        if self.stockSnapshot is not None and not columns and since is None:
+            return self.stockSnapshot.lookup(limit=limit, whs=whs, code=code, refresh=refresh)
         if columns:
             cols = columns
         else:
@@ -1247,11 +2517,131 @@ class SAPB1Adaptor(object):
         if whs:
             wclause = """ WhsCode = '{0}' """.format(whs)
             
-        if code:
+        args = None
+        if since is not None:
+            clauses, args = self._sinceClauses(STOCK_CHANGED, None, code, since)
+            if whs:
+                clauses.insert(0, "WhsCode = %(whs)s")
+                args = dict(args or {}, whs=whs)
+            sql = """SELECT {0} FROM dbo.OITW""".format(cols)
+            if clauses:
+                sql = sql + " WHERE " + " AND ".join(clauses)
+        elif code:
             sql = """SELECT {0} FROM dbo.OITW
                      WHERE ItemCode = '{1}' {2}""".format(cols, code, (" AND " + wclause) if wclause else '')
         else:
             sql = """SELECT top {0} {1} FROM dbo.OITW {2}""".format(limit, cols, (" WHERE " + wclause) if wclause else '')
-        print sql
-        return list(self.sql_adaptor.fetch_all(sql))
+        current_app.logger.debug("getStockNum: %s", sql)
+        if since is None and not refresh:
+            return self.fetchShared(sql, args=args)
+        return list(self.sql_adaptor.fetch_all(sql, args=args))
 
+    def fetchShared(self, sql, args=None):
+        """fetch_all for reads that may be shared: identical concurrent
+        queries (same SQL text and args) run once, and with READ_CACHE_TTL
+        the rows are reused for that many seconds. Every caller gets its
+        own copy of the rows.
+        """
+        if self.readFlight is None:
+            return list(self.sql_adaptor.fetch_all(sql, args=args))
+        key = (sql, repr(sorted(args.items()) if isinstance(args, dict) else args))
+        rows = self.readFlight.do(key, lambda: list(self.sql_adaptor.fetch_all(sql, args=args)))
+        return [dict(row) for row in rows]
+
+    def _loadCodes(self, table, codes):
+        """Load codes into a temp table of the connection so a lookup for
+        many codes is one set-based query.
+        """
+        sql = self.sql_adaptor
+        sql.execute("""IF OBJECT_ID('tempdb..{0}') IS NOT NULL
+                           DROP TABLE {0}
+                       CREATE TABLE {0} (Code nvarchar(50) COLLATE DATABASE_DEFAULT PRIMARY KEY)""".format(table))
+        # A temp table takes tempdb's collation unless told otherwise, which
+        # would clash with the company database's in the IN comparisons.
+        if isinstance(codes, basestring):
+            codes = [codes]
+        # One row per code as the primary key compares them, so a100 and
+        # A100 in one batch do not collide.
+        codes = sorted(dict((code_key(code), code) for code in codes).values())
+        # SQL Server takes at most 1000 rows per VALUES list.
+        for i in range(0, len(codes), 1000):
+            chunk = codes[i:i + 1000]
+            sql.execute("INSERT INTO {0} (Code) VALUES ".format(table) +
+                        ", ".join(["(%s)"] * len(chunk)), tuple(chunk))
+
+    def _requestedCodes(self, codes):
+        """The requested codes by code_key, to key rows found by the
+        database back to the code the client sent.
+        """
+        if isinstance(codes, basestring):
+            codes = [codes]
+        requested = {}
+        for code in set(codes):
+            requested.setdefault(code_key(code), []).append(code)
+        return requested
+
+    def _withItemCode(self, columns, default):
+        cols = columns if columns else default
+        if 'itemcode' not in cols.lower():
+            cols = 'ItemCode, ' + cols
+        return cols
+
+    @instrumented
+    def getItemsByCodes(self, codes, columns=None):
+        """Retrieve items(products) for a list of ItemCodes, keyed by the
+        ItemCodes as requested.
+        """
+        cols = self._withItemCode(columns, 'ItemCode, ItemName, ItmsGrpCod, CreateDate, UpdateDate')
+        self._loadCodes('#ItemCodes', codes)
+        sql = """SELECT {0} FROM dbo.OITM
+                 WHERE ItemCode IN (SELECT Code FROM #ItemCodes)""".format(cols)
+        requested = self._requestedCodes(codes)
+        return dict((code, row) for row in self.sql_adaptor.fetch_all(sql)
+                    for code in requested.get(code_key(row['ItemCode']), []))
+
+    @instrumented
+    def getPricesByCodes(self, codes, columns=None):
+        """Retrieve prices(products) for a list of ItemCodes, keyed by the
+        ItemCodes as requested.
+        """
+        cols = self._withItemCode(columns, 'ItemCode, Price, Currency, Ovrwritten, Factor')
+        listNumber = 2  # Lista de Ventas
+        self._loadCodes('#ItemCodes', codes)
+        sql = """SELECT {0} FROM dbo.ITM1
+                 WHERE PriceList = {1}
+                 AND ItemCode IN (SELECT Code FROM #ItemCodes)""".format(cols, listNumber)
+        requested = self._requestedCodes(codes)
+        return dict((code, row) for row in self.sql_adaptor.fetch_all(sql)
+                    for code in requested.get(code_key(row['ItemCode']), []))
+
+    @instrumented
+    def getStockByCodes(self, codes, whs=None, columns=None, refresh=False):
+        """Retrieve stock(products) for a list of ItemCodes and optionally a
+        list of warehouses, as requested ItemCode -> list of warehouse rows.
+        """
+        if isinstance(codes, basestring):
+            codes = [codes]
+        whs = [whs] if isinstance(whs, basestring) else list(whs or [])
+        result = {}
+        if self.stockSnapshot is not None and not columns:
+            wanted = set(StockSnapshot.normalize(w) for w in whs)
+            for code in set(codes):
+                rows = self.stockSnapshot.lookup(code=code, refresh=refresh)
+                refresh = False
+                rows = [row for row in rows
+                        if not whs or StockSnapshot.normalize(row['WhsCode']) in wanted]
+                if rows:
+                    result[code] = rows
+            return result
+
+        cols = self._withItemCode(columns, 'ItemCode, WhsCode, OnHand, IsCommited')
+        self._loadCodes('#ItemCodes', codes)
+        sql = """SELECT {0} FROM dbo.OITW
+                 WHERE ItemCode IN (SELECT Code FROM #ItemCodes)""".format(cols)
+        if whs:
+            sql = sql + " AND WhsCode IN ({0})".format(", ".join(["%s"] * len(whs)))
+        requested = self._requestedCodes(codes)
+        for row in self.sql_adaptor.fetch_all(sql, args=whs or None):
+            for code in requested.get(code_key(row['ItemCode']), []):
+                result.setdefault(code, []).append(row)
+        return result
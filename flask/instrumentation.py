@@ -0,0 +1,193 @@
+"""Timing of SAP B1 DI API and SQL calls.
+
+Every DI call (GetBusinessObject, Add, Update, GetByKey, Cancel, Connect)
+and every MsSqlAdaptor.execute is recorded in a latency histogram keyed by
+(method, operation), where method is the outermost SAPB1Adaptor method on
+the calling thread (insertOrder, insertShipment...). Non-zero DI return
+codes and exceptions are counted per code.
+"""
+import threading
+from functools import wraps
+from time import time
+import tracing
+
+
+# Upper bounds in seconds, the Prometheus client defaults.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75,
+           1.0, 2.5, 5.0, 7.5, 10.0)
+
+# DI methods that are timed on business objects and the company.
+COM_CALLS = ('GetBusinessObject', 'Add', 'Update', 'GetByKey', 'Cancel',
+             'Close', 'Remove')
+
+_local = threading.local()
+
+
+class Histogram(object):
+    """Per-bucket counts, sum and count of observations.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class Registry(object):
+    """Histograms and error counts by (method, operation).
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.errors = {}
+
+    def observe(self, method, op, seconds, error=None):
+        key = (method, op)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+            if error is not None:
+                key = (method, op, str(error))
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'histograms': dict((k, h.to_dict())
+                                   for k, h in self.histograms.items()),
+                'errors': dict(self.errors),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.errors = {}
+
+
+registry = Registry()
+
+
+def current_method():
+    """The outermost instrumented method running on this thread.
+    """
+    stack = getattr(_local, 'stack', None)
+    return stack[0] if stack else '-'
+
+
+def error_code(e):
+    """The DI error code of a com_error (its hresult), else the class name.
+    """
+    if type(e).__name__ == 'com_error' and e.args:
+        return e.args[0]
+    return type(e).__name__
+
+
+def instrumented(func):
+    """Tag the calls made inside func with its name and time func itself
+    as the 'total' operation.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(name)
+        span = tracing.open_span(name)
+        start = time()
+        error = None
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            error = error_code(e)
+            raise
+        finally:
+            stack.pop()
+            tracing.close_span(span, error)
+            if not stack and registry.enabled:
+                registry.observe(name, 'total', time() - start, error)
+    return wrapper
+
+
+def timed(op, func, *args, **kwargs):
+    """Call func and record it as op of the current method.
+
+    Integer results other than 0 are DI error codes.
+    """
+    span = _backend_span(op, args)
+    if not registry.enabled and span is None:
+        return func(*args, **kwargs)
+    start = time()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        error = error_code(e)
+        tracing.close_span(span, error)
+        if registry.enabled:
+            registry.observe(current_method(), op, time() - start, error)
+        raise
+    error = None
+    if isinstance(result, int) and not isinstance(result, bool) and result != 0:
+        error = result
+    tracing.close_span(span, error)
+    if registry.enabled:
+        registry.observe(current_method(), op, time() - start, error)
+    return result
+
+
+def _backend_span(op, args):
+    if op == 'execute':
+        return tracing.open_span('SQL execute', tracing.KIND_CLIENT,
+                                 {'db.system': 'mssql',
+                                  'db.statement': ' '.join(args[0].split())[:1000]})
+    return tracing.open_span('DI ' + op, tracing.KIND_CLIENT)
+
+
+class ComProxy(object):
+    """Wrap a DI object so the calls in COM_CALLS are timed.
+
+    Business objects returned by GetBusinessObject are wrapped too; every
+    other attribute is passed through to the DI object.
+    """
+
+    def __init__(self, target):
+        object.__setattr__(self, '_target', target)
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name not in COM_CALLS:
+            return value
+        if name == 'GetBusinessObject':
+            def call(*args):
+                return ComProxy(timed(name, value, *args))
+        else:
+            def call(*args):
+                return timed(name, value, *args)
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
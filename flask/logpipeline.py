@@ -0,0 +1,103 @@
+"""Queued logging.
+
+Request threads only put records on a bounded queue; a background thread
+formats them and writes them to the real handlers. When the queue is full
+records are dropped and counted rather than blocking the caller.
+"""
+import datetime
+import json
+import logging
+import threading
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class QueueHandler(logging.Handler):
+    """Put records on a queue without blocking.
+    """
+
+    def __init__(self, q):
+        logging.Handler.__init__(self)
+        self.queue = q
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Resolve everything that depends on the calling thread or on
+        # objects which may change before the writer gets to the record.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Write queued records to handlers from a daemon thread.
+    """
+
+    _sentinel = None
+
+    def __init__(self, q, *handlers):
+        self.queue = q
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Write out what is queued and stop the thread.
+        """
+        if self.thread is not None:
+            self.queue.put(self._sentinel)
+            self.thread.join()
+            self.thread = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record.
+    """
+
+    FIELDS = ('trace_id',)
+
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
@@ -13,7 +13,7 @@ if os.path.exists('.env'):
         if len(var) == 2:
             os.environ[var[0]] = var[1]
 
-from flask import Flask, g, jsonify
+from flask import Flask, g, jsonify, current_app
 from flask_script import Manager
 from api.app import create_app
 
@@ -41,5 +41,67 @@ def test(coverage=False):
         print('HTML version: file://%s/index.html' % covdir)
         COV.erase()
 
+@manager.command
+def traces(path=None, top=20, name=None):
+    """Summarise the slowest spans of the trace file."""
+    import tracing
+    path = path or current_app.config.get('TRACE_FILE', 'traces.jsonl')
+    print(tracing.summarise(path, int(top), name))
+
+@manager.command
+def profiles(directory=None, name=None, merge=False, output=None):
+    """List the saved request profiles, or merge them into one collapsed stack file."""
+    import profiling
+    directory = directory or current_app.config.get('PROFILE_DIR', 'profiles')
+    if not merge:
+        for profile, samples in profiling.list_profiles(directory, name):
+            print('{0:>8}  {1}'.format(samples, profile))
+        return
+    merged = profiling.merge_profiles(directory, name)
+    lines = ['{0} {1}'.format(stack, count) for stack, count in sorted(merged.items())]
+    if output:
+        with open(output, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        print('Merged {0} stacks into {1}'.format(len(lines), output))
+    else:
+        print('\n'.join(lines))
+
+@manager.command
+def bench(cases=None, iterations=200, warmup=10, di_latency=0.0, sql_latency=0.0,
+          output=None, baseline=None):
+    """Benchmark the adaptor and API against fake DI/SQL backends; prints JSON."""
+    import json
+    from benchmarks import runner
+    names = cases.split(',') if cases else None
+    report = runner.run(names, int(iterations), int(warmup),
+                        float(di_latency), float(sql_latency))
+    if output:
+        with open(output, 'w') as f:
+            f.write(runner.dumps(report))
+    print(runner.dumps(report))
+    if baseline:
+        with open(baseline) as f:
+            print(runner.compare(json.load(f), report))
+
+@manager.command
+def loadtest(url='http://localhost:5000/v1/code?type=TaxCode', clients=8, requests=50,
+             token=None, keepalive=True, method='GET', body=None, single=False):
+    """Load test a running server; prints JSON. --single also runs one client to compare."""
+    from benchmarks import loadtest as lt
+    keepalive = keepalive not in (False, 'false', '0', 'no')
+    if single:
+        baseline = lt.run(url, 1, int(requests), token, keepalive, method, body)
+        print(lt.dumps(baseline))
+    report = lt.run(url, int(clients), int(requests), token, keepalive, method, body)
+    print(lt.dumps(report))
+    if single and baseline['throughput']:
+        print('Concurrency gain: {0:.2f}x'.format(report['throughput'] / baseline['throughput']))
+
+@manager.command
+def webhook_sink(port=9000, secret=None, fail=0, output=None):
+    """Local webhook receiver for the change feed; prints each event. --fail N answers 500 to the first N batches."""
+    from benchmarks import webhooksink
+    webhooksink.serve(int(port), secret, int(fail), output)
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,145 @@
+"""Opt-in sampling profiler for requests.
+
+While a request is profiled, a background thread reads its stack from
+sys._current_frames() every interval and counts the collapsed stacks. When
+the request is sampled, or ran longer than the slow threshold, the counts
+are saved as <dir>/<time>-<method>-<resource>-<ms>ms-<trace>.folded in the
+collapsed stack format read by flamegraph.pl and speedscope.
+"""
+import os
+import random
+import re
+import sys
+import threading
+from time import time, sleep, strftime
+
+
+class Sampler(object):
+    """Sample the stacks of the registered threads.
+    """
+
+    def __init__(self, interval=0.01, maxDepth=64):
+        self.interval = interval
+        self.maxDepth = maxDepth
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.thread = None
+
+    def _ensureThread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name='profiler')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def begin(self):
+        """Start counting the stacks of the calling thread.
+        """
+        with self.lock:
+            self.profiles[threading.current_thread().ident] = {}
+            self._ensureThread()
+
+    def end(self):
+        """Stop profiling the calling thread and return its stack counts.
+        """
+        with self.lock:
+            return self.profiles.pop(threading.current_thread().ident, None)
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            with self.lock:
+                if not self.profiles:
+                    self.thread = None
+                    return
+                frames = sys._current_frames()
+                for ident, counts in self.profiles.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = self._collapse(frame)
+                        counts[stack] = counts.get(stack, 0) + 1
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None and len(names) < self.maxDepth:
+            code = frame.f_code
+            names.append('{0}:{1}'.format(
+                os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        names.reverse()
+        return ';'.join(names)
+
+
+class Profiler(object):
+    """Decide which requests to keep and write their profiles.
+    """
+
+    def __init__(self, directory, sampleRate=0.0, slowSeconds=None, interval=0.01):
+        self.directory = directory
+        self.sampleRate = sampleRate
+        self.slowSeconds = slowSeconds
+        self.sampler = Sampler(interval)
+
+    def start(self):
+        """Begin profiling the current request; returns a token for stop().
+        """
+        sampled = random.random() < self.sampleRate
+        if not sampled and self.slowSeconds is None:
+            return None
+        self.sampler.begin()
+        return (time(), sampled)
+
+    def stop(self, token, method, resource, traceId=None):
+        """Stop profiling and save the profile if the request was sampled or
+        slow. Returns the saved path or None.
+        """
+        if token is None:
+            return None
+        counts = self.sampler.end()
+        start, sampled = token
+        elapsed = time() - start
+        slow = self.slowSeconds is not None and elapsed >= self.slowSeconds
+        if not counts or not (sampled or slow):
+            return None
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        name = '{0}-{1}-{2}-{3}ms-{4}.folded'.format(
+            strftime('%Y%m%d%H%M%S'), method, re.sub(r'[^A-Za-z0-9_.]', '_', resource),
+            int(elapsed * 1000), traceId or '-')
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            for stack, count in sorted(counts.items()):
+                f.write('{0} {1}\n'.format(stack, count))
+        return path
+
+
+def read_folded(path):
+    counts = {}
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                counts[stack] = counts.get(stack, 0) + int(count)
+    return counts
+
+
+def list_profiles(directory, match=None):
+    """Return (name, samples) of the saved profiles, newest first.
+    """
+    if not os.path.isdir(directory):
+        return []
+    names = sorted((n for n in os.listdir(directory) if n.endswith('.folded')),
+                   reverse=True)
+    if match:
+        names = [n for n in names if match in n]
+    return [(n, sum(read_folded(os.path.join(directory, n)).values()))
+            for n in names]
+
+
+def merge_profiles(directory, match=None):
+    """Sum the stack counts of the saved profiles into one collapsed profile.
+    """
+    merged = {}
+    for name, _ in list_profiles(directory, match):
+        for stack, count in read_folded(os.path.join(directory, name)).items():
+            merged[stack] = merged.get(stack, 0) + count
+    return merged
@@ -3,14 +3,58 @@
 # Example:
 
 from manage import manager
+from api.app import sapb1Adaptor
+from api.readonly import ReadOnlyFilter
 
 # Import CherryPy
 import cherrypy
 
+
+def configure(server, config, prefix, threads):
+    """Apply the SERVER_* (or READ_SERVER_*) settings to a CherryPy server.
+    """
+    server.socket_host = "0.0.0.0"
+    server.thread_pool = threads
+    server.thread_pool_max = config.get(prefix + 'THREADS_MAX', threads)
+    # HTTP/1.1 keeps client connections open between requests; an idle one
+    # is closed after SOCKET_TIMEOUT seconds.
+    server.protocol_version = 'HTTP/1.1'
+    server.socket_timeout = config.get(prefix + 'SOCKET_TIMEOUT', 30)
+    server.socket_queue_size = config.get(prefix + 'SOCKET_QUEUE_SIZE', 64)
+    # Accepted connections waiting for a free worker thread; when full,
+    # new connections are turned away after ACCEPTED_QUEUE_TIMEOUT seconds.
+    server.accepted_queue_size = config.get(prefix + 'ACCEPTED_QUEUE_SIZE', 128)
+    server.accepted_queue_timeout = config.get(prefix + 'ACCEPTED_QUEUE_TIMEOUT', 10)
+    server.max_request_body_size = config.get(prefix + 'MAX_REQUEST_BODY_SIZE', 100 * 1024 * 1024)
+    server.shutdown_timeout = config.get('SERVER_SHUTDOWN_TIMEOUT', 30)
+
+
+def drain(app):
+    """Engine 'stop' listener: after the servers have stopped taking
+    requests, stop the change feed and wait for the DI transactions still
+    running to finish.
+    """
+    timeout = app.config.get('SERVER_SHUTDOWN_TIMEOUT', 30)
+    feed = app.extensions.get('changefeed')
+    if feed is not None:
+        feed.stop(timeout)
+    app.logger.info("Draining DI transactions (up to %ss)", timeout)
+    if sapb1Adaptor.shutdown(timeout):
+        app.logger.info("Drained")
+    else:
+        app.logger.warning("DI transactions still running after %ss", timeout)
+
+
 if __name__ == '__main__':
 
     # Mount the application
-    cherrypy.tree.graft(manager(), "/")
+    application = manager()
+    config = application.config
+    readPort = config.get('READ_SERVER_PORT', None)
+    if readPort:
+        cherrypy.tree.graft(ReadOnlyFilter(application, port=readPort), "/")
+    else:
+        cherrypy.tree.graft(application, "/")
 
     # Unsubscribe the default server
     cherrypy.server.unsubscribe()
@@ -18,10 +62,12 @@ if __name__ == '__main__':
     # Instantiate a new server object
     server = cherrypy._cpserver.Server()
 
-    # Configure the server object
-    server.socket_host = "0.0.0.0"
-    server.socket_port = 5000
-    server.thread_pool = 1
+    # Configure the server object. Requests beyond the COM_MAX_SESSIONS DI
+    # sessions wait in the DI queue or are answered 503 at once, so the
+    # pool only needs those threads plus some for reads and queued writes.
+    configure(server, config, 'SERVER_',
+              config.get('SERVER_THREADS', config.get('COM_MAX_SESSIONS', 1) + 8))
+    server.socket_port = config.get('SERVER_PORT', 5000)
 
     # For SSL Support
     # server.ssl_module            = 'pyopenssl'
@@ -32,15 +78,29 @@ if __name__ == '__main__':
     # Subscribe this server
     server.subscribe()
 
-    # Example for a 2nd server (same steps as above):
-    # Remember to use a different port
+    # Read-only server: storefront reads (items, prices, stock, codes,
+    # order/shipment fetch) get their own, larger thread pool so slow
+    # queries do not queue behind writes, which stay on the server above
+    # and its DI session. The threads share SQL_POOL_SIZE connections.
+    if readPort:
+        readServer = cherrypy._cpserver.Server()
+        configure(readServer, config, 'READ_SERVER_', config.get('READ_SERVER_THREADS', 32))
+        readServer.socket_port = readPort
+        readServer.subscribe()
+
+    # Push document changes to the registered webhooks (CHANGEFEED).
+    feed = application.extensions.get('changefeed')
+    if feed is not None:
+        cherrypy.engine.subscribe('start', feed.start)
 
-    # server2             = cherrypy._cpserver.Server()
+    # Servers stop at priority 25; drain after they no longer take requests.
+    cherrypy.engine.subscribe('stop', lambda: drain(application), priority=80)
 
-    # server2.socket_host = "0.0.0.0"
-    # server2.socket_port = 8081
-    # server2.thread_pool = 30
-    # server2.subscribe()
+    # Stop gracefully on SIGTERM/SIGHUP (and Ctrl+C / console close).
+    if hasattr(cherrypy.engine, 'signals'):
+        cherrypy.engine.signals.subscribe()
+    if hasattr(cherrypy.engine, 'console_control_handler'):
+        cherrypy.engine.console_control_handler.subscribe()
 
     # Start the server engine (Option 1 *and* 2)
 
@@ -0,0 +1,58 @@
+"""DI admission: requests are turned away before they would time out.
+
+Run from the flask directory: python -m unittest discover tests
+"""
+import unittest
+from time import time
+
+from flask import Flask
+
+from flask_sapb1 import ComGate
+from api.app import sapb1Adaptor
+from api.ratelimit import uses_com
+
+
+@uses_com
+def resource():
+    return 'ok'
+
+
+class ComGateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.gate = ComGate(maxSessions=1, maxWait=0.2, maxQueue=20)
+        self.saved, sapb1Adaptor.comGate = sapb1Adaptor.comGate, self.gate
+
+    def tearDown(self):
+        sapb1Adaptor.comGate = self.saved
+
+    def test_held_session_answers_503_before_the_timeout(self):
+        self.gate.acquire()
+        try:
+            for attempt in range(10):
+                start = time()
+                with self.app.test_request_context():
+                    resp = resource()
+                elapsed = time() - start
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn('Retry-After', resp.headers)
+                if elapsed < self.gate.maxWait / 2:
+                    return
+            self.fail("every request waited out the {0}s timeout".format(self.gate.maxWait))
+        finally:
+            self.gate.release()
+
+    def test_admit_wait_stays_below_max_wait(self):
+        self.assertEqual(ComGate(maxWait=10.0).admitWait, 5.0)
+        self.assertEqual(ComGate(maxWait=10.0, admitWait=30.0).admitWait, 10.0)
+
+    def test_free_session_is_admitted(self):
+        with self.app.test_request_context():
+            self.assertEqual(resource(), 'ok')
+        self.gate.release()
+        self.assertEqual(self.gate.rejected, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,386 @@
+"""Lightweight request tracing.
+
+A trace is started per HTTP request; instrumented adaptor methods and
+timed DI/SQL calls open child spans on the same thread. Finished traces are
+queued and appended to a file as OTLP/JSON (one ExportTraceServiceRequest
+per line) by a background thread, which rotates the file by size.
+"""
+import atexit
+import json
+import logging
+import os
+import random
+import threading
+from time import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+SERVICE_NAME = 'sapb1-restful'
+
+# OTLP span kinds and status codes.
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+STATUS_ERROR = 2
+
+_local = threading.local()
+_random = random.SystemRandom()
+
+
+def _id(bits):
+    return '%0*x' % (bits // 4, _random.getrandbits(bits))
+
+
+def _nanos():
+    return int(time() * 1e9)
+
+
+class Span(object):
+
+    def __init__(self, traceId, parentId, name, kind=KIND_INTERNAL, attributes=None):
+        self.traceId = traceId
+        self.spanId = _id(64)
+        self.parentId = parentId
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.start = _nanos()
+        self.end = None
+        self.status = None
+        self.message = None
+
+    def fail(self, message):
+        self.status = STATUS_ERROR
+        self.message = message
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.traceId,
+            'spanId': self.spanId,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': [_attribute(k, v) for k, v in sorted(self.attributes.items())],
+        }
+        if self.parentId:
+            span['parentSpanId'] = self.parentId
+        if self.status is not None:
+            span['status'] = {'code': self.status}
+            if self.message:
+                span['status']['message'] = self.message
+        return span
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, (int, long)):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': unicode(value)}}
+
+
+class Trace(object):
+    """The spans of one request, the innermost open span last in stack.
+    """
+
+    def __init__(self, traceId=None, parentId=None):
+        self.traceId = traceId or _id(128)
+        self.parentId = parentId
+        self.root = None
+        self.stack = []
+        self.spans = []
+
+    def open(self, name, kind=KIND_INTERNAL, attributes=None):
+        parentId = self.stack[-1].spanId if self.stack else self.parentId
+        span = Span(self.traceId, parentId, name, kind, attributes)
+        if self.root is None:
+            self.root = span
+        self.stack.append(span)
+        return span
+
+    def close(self, span):
+        span.end = _nanos()
+        if self.stack and self.stack[-1] is span:
+            self.stack.pop()
+        else:
+            self.stack.remove(span)
+        self.spans.append(span)
+
+
+class Exporter(object):
+    """Append finished traces to a file in OTLP/JSON.
+
+    Request threads only put traces on a bounded queue; when it is full
+    the trace is dropped and counted. A daemon thread serialises and
+    writes them, and once the file reaches maxBytes it is renamed to
+    path.1 (path.1 to path.2 and so on, keeping backupCount files).
+    """
+
+    _sentinel = None
+
+    def __init__(self, path, minDuration=0.0, maxBytes=50 * 1024 * 1024,
+                 backupCount=5, queueSize=10000):
+        self.path = path
+        self.minDuration = minDuration
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.queue = queue.Queue(queueSize)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0
+
+    def export(self, trace):
+        if not trace.spans:
+            return
+        root = trace.root
+        if (root.end - root.start) / 1e9 < self.minDuration:
+            return
+        self._ensureThread()
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensureThread(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='trace-writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _line(self, trace):
+        return json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [_attribute('service.name', SERVICE_NAME)]},
+            'scopeSpans': [{
+                'scope': {'name': __name__},
+                'spans': [span.to_otlp() for span in trace.spans],
+            }],
+        }]}, separators=(',', ':'))
+
+    def _run(self):
+        f = None
+        try:
+            while True:
+                trace = self.queue.get()
+                try:
+                    if trace is self._sentinel:
+                        return
+                    if f is None:
+                        f = open(self.path, 'a')
+                    f.write(self._line(trace) + '\n')
+                    if self.queue.empty():
+                        f.flush()
+                    if self.maxBytes and f.tell() >= self.maxBytes:
+                        f.close()
+                        f = None
+                        self._rotate()
+                except Exception:
+                    logging.getLogger(__name__).exception("Failed to export a trace")
+                finally:
+                    self.queue.task_done()
+        finally:
+            if f is not None:
+                f.close()
+
+    def _rotate(self):
+        if self.backupCount <= 0:
+            os.remove(self.path)
+            return
+        for n in range(self.backupCount - 1, 0, -1):
+            src = '{0}.{1}'.format(self.path, n)
+            dst = '{0}.{1}'.format(self.path, n + 1)
+            if os.path.exists(src):
+                if os.path.exists(dst):
+                    os.remove(dst)
+                os.rename(src, dst)
+        dst = self.path + '.1'
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(self.path, dst)
+
+    def flush(self):
+        """Wait until the queued traces are written.
+        """
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        """Write out what is queued and stop the thread.
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(self._sentinel)
+            thread.join()
+
+
+exporter = None
+
+
+def configure(path, minDuration=0.0, maxBytes=50 * 1024 * 1024, backupCount=5,
+              queueSize=10000):
+    """Export finished traces to path, or disable tracing if path is None.
+    """
+    global exporter
+    if exporter is not None:
+        exporter.close()
+    exporter = Exporter(path, minDuration, maxBytes, backupCount, queueSize) if path else None
+
+
+@atexit.register
+def _close():
+    if exporter is not None:
+        exporter.close()
+
+
+def parse_traceparent(header):
+    """Return (traceId, parentId) of a W3C traceparent header, or (None, None).
+    """
+    try:
+        version, traceId, parentId, flags = header.strip().split('-')
+        int(traceId, 16)
+        int(parentId, 16)
+        if len(traceId) == 32 and len(parentId) == 16 and traceId != '0' * 32:
+            return traceId.lower(), parentId.lower()
+    except (AttributeError, ValueError):
+        pass
+    return None, None
+
+
+def start_trace(name, traceparent=None, attributes=None):
+    """Begin the trace of the current thread with a server span.
+    """
+    if exporter is None:
+        _local.trace = None
+        return None
+    traceId, parentId = parse_traceparent(traceparent)
+    trace = _local.trace = Trace(traceId, parentId)
+    trace.open(name, KIND_SERVER, attributes)
+    return trace
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def resume_trace(trace):
+    """Make trace the current thread's trace again, after a nested request
+    started and ended its own.
+    """
+    _local.trace = trace
+
+
+def traceparent(trace):
+    """W3C traceparent header continuing trace from its innermost open span.
+    """
+    span = trace.stack[-1] if trace.stack else trace.root
+    return '00-{0}-{1}-01'.format(trace.traceId, span.spanId)
+
+
+def current_trace_id():
+    trace = current_trace()
+    return trace.traceId if trace is not None else None
+
+
+def end_trace(error=None):
+    """Close the open spans of the current thread's trace and export it.
+    """
+    trace = current_trace()
+    _local.trace = None
+    if trace is None:
+        return
+    root = trace.root
+    if error is not None:
+        root.fail(str(error))
+    elif root.attributes.get('http.status_code', 0) >= 500:
+        root.fail('HTTP %s' % root.attributes['http.status_code'])
+    while trace.stack:
+        trace.close(trace.stack[-1])
+    if exporter is not None:
+        exporter.export(trace)
+
+
+def open_span(name, kind=KIND_INTERNAL, attributes=None):
+    """Open a child span of the current span, or return None when no trace
+    is running on this thread.
+    """
+    trace = current_trace()
+    if trace is None:
+        return None
+    return trace.open(name, kind, attributes)
+
+
+def close_span(span, error=None):
+    if span is None:
+        return
+    if error is not None:
+        span.fail(str(error))
+    trace = current_trace()
+    if trace is not None:
+        trace.close(span)
+
+
+class TraceIdFilter(logging.Filter):
+    """Add the trace id of the current thread to log records as trace_id.
+    """
+
+    def filter(self, record):
+        record.trace_id = current_trace_id() or '-'
+        return True
+
+
+def read_spans(path):
+    """Yield the span dicts of an OTLP/JSON lines file.
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            for resourceSpans in json.loads(line).get('resourceSpans', []):
+                for scopeSpans in resourceSpans.get('scopeSpans', []):
+                    for span in scopeSpans.get('spans', []):
+                        yield span
+
+
+def summarise(path, top=20, name=None):
+    """Text report of the slowest spans of a trace file: totals by span name
+    and the slowest individual spans with their parents.
+    """
+    if not os.path.exists(path):
+        return 'No trace file at {0}'.format(path)
+    spans = list(read_spans(path))
+    names = dict((s['spanId'], s['name']) for s in spans)
+    for span in spans:
+        span['duration'] = (int(span['endTimeUnixNano']) -
+                            int(span['startTimeUnixNano'])) / 1e6
+    if name:
+        spans = [s for s in spans if name in s['name']]
+    byName = {}
+    for span in spans:
+        byName.setdefault(span['name'], []).append(span['duration'])
+
+    lines = ['{0:<40} {1:>7} {2:>11} {3:>10} {4:>10} {5:>10}'.format(
+        'span', 'count', 'total ms', 'avg ms', 'p95 ms', 'max ms')]
+    rows = sorted(byName.items(), key=lambda item: -sum(item[1]))
+    for spanName, durations in rows[:top]:
+        durations.sort()
+        p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+        lines.append('{0:<40} {1:>7} {2:>11.1f} {3:>10.1f} {4:>10.1f} {5:>10.1f}'.format(
+            spanName[:40], len(durations), sum(durations),
+            sum(durations) / len(durations), p95, durations[-1]))
+
+    lines.append('')
+    lines.append('{0:<40} {1:>10}  {2:<32} {3}'.format('slowest spans', 'ms', 'trace', 'parent'))
+    for span in sorted(spans, key=lambda s: -s['duration'])[:top]:
+        lines.append('{0:<40} {1:>10.1f}  {2:<32} {3}'.format(
+            span['name'][:40], span['duration'], span['traceId'],
+            names.get(span.get('parentSpanId'), '-')))
+    return '\n'.join(lines)